@@ -0,0 +1,322 @@
+""" Microbenchmarks of the per-frame processing steps
+
+Usage:
+    python ihd_benchmark.py hand_extraction --capture session.leap
+    python ihd_benchmark.py hand_extraction --hands 2
+    python ihd_benchmark.py leap_attributes --capture session.leap
+    python ihd_benchmark.py stroke_detection --hands 16
+    python ihd_benchmark.py finger_detection --hands 2
+    python ihd_benchmark.py pad_lookup --capture session.leap
+    python ihd_benchmark.py midi_output --frames 20000
+    python ihd_benchmark.py sampler
+
+Frames are taken from a capture file (see ihd_replay.read_frames) or from the hand simulator. Only captures of
+serialized Leap frames measure the cost of the SWIG objects of a live session. The MIDI output benchmark plays one
+random note per frame, the sampler benchmark renders one block per frame.
+"""
+
+import os
+import sys
+import argparse
+
+from ihd_clock import host_time
+from ihd_frame import IHDHandArrayExtractor, HAND_ID, HAND_PALM_X, HAND_PALM_Y, HAND_PALM_Z
+
+
+def time_per_frame(function, frames, repetitions=10):
+    """ Mean duration (in microseconds) of function(frame) over all frames """
+    start = host_time()
+    for _ in range(repetitions):
+        for frame in frames:
+            function(frame)
+    return 1e6*(host_time() - start) / (repetitions*len(frames))
+
+
+def benchmark_hand_extraction(frames, repetitions=10):
+    """ Compare per-hand attribute access (as in the original detect_hand_stroke) with bulk extraction into an array
+    Returns:
+        results (list): List of (name, duration per frame in microseconds)
+    """
+    def per_hand_access(frame):
+        hands = frame.hands
+        if len(hands) > 0:
+            for hand in hands:
+                _id = hand.id
+                position = hand.palm_position
+                height = position[1]
+
+    extractor = IHDHandArrayExtractor()
+
+    def bulk_extraction(frame):
+        for hand in extractor.extract(frame):
+            _id = hand[HAND_ID]
+            height = hand[HAND_PALM_Y]
+
+    return [('per-hand attribute access', time_per_frame(per_hand_access, frames, repetitions)),
+            ('bulk hand array extraction', time_per_frame(bulk_extraction, frames, repetitions))]
+
+
+def time_per_call(function, objects, repetitions=10):
+    """ Mean duration (in nanoseconds) of function(obj) over all objects, corrected by the loop overhead """
+    def empty(obj):
+        pass
+    if len(objects) == 0:
+        return float('nan')
+    durations = []
+    for f in (function, empty):
+        start = host_time()
+        for _ in range(repetitions):
+            for obj in objects:
+                f(obj)
+        durations.append(host_time() - start)
+    return 1e9*(durations[0] - durations[1]) / (repetitions*len(objects))
+
+
+def benchmark_leap_attributes(frames, repetitions=10):
+    """ Per-access cost of the hot Leap.py attributes with the generated classes, with the fast path of
+        ihd_leap_fast installed, and of a direct call of the extension getter (lower bound)
+    Returns:
+        results (list): List of (name, duration per access in nanoseconds for original / fast path / direct call)
+    """
+    import Leap
+    from Leap import LeapPython
+    import ihd_leap_fast
+
+    if len(frames) == 0 or not isinstance(frames[0], Leap.Frame):
+        raise Exception('Leap attribute benchmark requires a capture of serialized Leap frames')
+
+    hands = [hand for frame in frames for hand in frame.hands]
+    vectors = [hand.palm_position for hand in hands]
+    gestures = [gesture for frame in frames for gesture in frame.gestures()]
+    swipes = [Leap.SwipeGesture(gesture) for gesture in gestures if gesture.type == Leap.Gesture.TYPE_SWIPE]
+
+    # name, objects, access, direct extension call
+    accesses = [('Vector.x', vectors, lambda v: v.x, lambda v: LeapPython.Vector_x_get(v)),
+                ('Vector[1]', vectors, lambda v: v[1], lambda v: LeapPython.Vector___getitem__(v, 1)),
+                ('Hand.id', hands, lambda h: h.id, lambda h: LeapPython.Hand_id_get(h)),
+                ('Hand.palm_position', hands, lambda h: h.palm_position,
+                 lambda h: LeapPython.Hand_palm_position_get(h)),
+                ('Gesture.type', gestures, lambda g: g.type, lambda g: LeapPython.Gesture_type_get(g)),
+                ('SwipeGesture.position', swipes, lambda s: s.position,
+                 lambda s: LeapPython.SwipeGesture_position_get(s)),
+                ('SwipeGesture(gesture)', gestures, lambda g: Leap.SwipeGesture(g),
+                 lambda g: ihd_leap_fast.swipe_gesture(g)),
+                ('iterate Frame.hands', frames, lambda f: [h for h in f.hands],
+                 lambda f: [LeapPython.HandList___getitem__(hs, i)
+                            for hs in (f.hands,) for i in range(LeapPython.HandList___len__(hs))])]
+
+    results = []
+    for name, objects, access, direct in accesses:
+        original = time_per_call(access, objects, repetitions)
+        ihd_leap_fast.install()
+        fast = time_per_call(access, objects, repetitions)
+        ihd_leap_fast.uninstall()
+        results.append((name, original, fast, time_per_call(direct, objects, repetitions)))
+    return results
+
+
+def benchmark_stroke_detection(frames, repetitions=10):
+    """ Compare per-hand stroke detection (IHDHandTrackingMemory) with the vectorized IHDStrokeStateTable
+    Returns:
+        results (list): List of (name, duration per frame in microseconds)
+    """
+    from ihd_stroke_table import IHDStrokeStateTable
+    from invisible_hand_drum import IHDHandTrackingMemory
+
+    max_hands = max([len(frame.hands) for frame in frames] + [1])
+    extractor = IHDHandArrayExtractor(max_hands=max_hands)
+    hand_arrays = [extractor.extract(frame).copy() for frame in frames]
+
+    results = []
+    for name, memory in (('per-hand memory', IHDHandTrackingMemory()),
+                         ('vectorized state table', IHDStrokeStateTable(capacity=max(16, max_hands)))):
+        # frame IDs continue over repetitions, memory state is kept
+        frame_ids = iter(range(repetitions*len(hand_arrays)))
+        # the per-hand memory prints the velocity of every stroke, terminal output is not timed
+        stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+        try:
+            results.append((name, time_per_frame(lambda hands: memory.detect_strokes(hands, next(frame_ids)),
+                                                 hand_arrays, repetitions)))
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+    return results
+
+
+def benchmark_finger_detection(frames, repetitions=10):
+    """ Extraction and stroke detection of palms and of all fingertips (one batch per frame)
+    Returns:
+        results (list): List of (name, duration per frame in microseconds)
+    """
+    from ihd_stroke_table import IHDStrokeStateTable
+
+    max_hands = max([len(frame.hands) for frame in frames] + [1])
+    results = []
+    for name, fingers in (('palms', False), ('fingertips', True)):
+        extractor = IHDHandArrayExtractor(max_hands=max_hands, fingers=fingers)
+        table = IHDStrokeStateTable(capacity=max(16, extractor.max_rows), finger_groups=fingers)
+        frame_ids = iter(range(repetitions*len(frames)))
+        results.append(('%s: extraction' % name, time_per_frame(extractor.extract, frames, repetitions)))
+        results.append(('%s: extraction + detection' % name,
+                        time_per_frame(lambda frame: table.detect_strokes(extractor.extract(frame), next(frame_ids)),
+                                       frames, repetitions)))
+    return results
+
+
+def benchmark_pad_lookup(frames, repetitions=10):
+    """ Nearest pad of the palm positions by distances to all pads and by precomputed lookup grid (see
+        ihd_pad_lookup.py), for the hexagon layout and layouts of concentric rings
+    Returns:
+        results (list): List of (name, duration per lookup in microseconds)
+    """
+    import numpy as np
+    from ihd_pad_lookup import IHDPadLookup, ring_layout
+
+    extractor = IHDHandArrayExtractor()
+    positions = [(float(hand[HAND_PALM_X]), float(hand[HAND_PALM_Z])) for frame in frames
+                 for hand in extractor.extract(frame)]
+    results = []
+    for num_pads in (7, 32, 64):
+        lookup = IHDPadLookup(ring_layout(num_pads, radius=100. if num_pads == 7 else 250.))
+        results.append(('%d pads: distances to all pads' % num_pads,
+                        1e-3*time_per_call(lambda position: lookup.nearest_brute_force(*position), positions,
+                                           repetitions)))
+        results.append(('%d pads: lookup grid' % num_pads,
+                        1e-3*time_per_call(lambda position: lookup.lookup(*position), positions, repetitions)))
+        is_equal = np.array([lookup.lookup(*position) == lookup.nearest_brute_force(*position)
+                             for position in positions])
+        if not np.all(is_equal):
+            raise Exception('Lookup differs from nearest pad for %d positions' % np.sum(~is_equal))
+    return results
+
+
+def benchmark_midi_output(frames, repetitions=10, chord_size=4):
+    """ Throughput of the MIDI output layer into a null output: messages encoded per note, voice manager with
+        single notes and with bulk chords, and output thread
+    Returns:
+        results (list): List of (name, messages per second)
+    """
+    import numpy as np
+    from ihd_replay import IHDNullMidiOut
+    from ihd_midi_messages import NOTE_ON, level_to_velocity
+    from ihd_midi_scheduler import IHDMidiScheduler
+    from ihd_voices import IHDVoiceManager
+
+    random_state = np.random.RandomState(1)
+    pitches = random_state.randint(36, 84, size=len(frames)).tolist()
+    levels = random_state.random_sample(len(frames)).tolist()
+    notes = list(zip(pitches, levels))
+
+    def encoded(note):
+        midi_out.send_message([NOTE_ON, note[0], int(122.*(.5 + .5*note[1]))])
+
+    def voice(note):
+        curr_time = next(times)
+        voices.update(curr_time)
+        voices.note_on(note[0], level_to_velocity(note[1]), curr_time)
+
+    def chord(notes):
+        curr_time = next(times)
+        voices.update(curr_time)
+        voices.note_ons([(pitch, level_to_velocity(level), None) for pitch, level in notes], curr_time)
+
+    chords = [notes[idx:idx + chord_size] for idx in range(0, len(notes), chord_size)]
+    results = []
+    for name, function, objects, output_thread in (('new list per message', encoded, notes, False),
+                                                   ('voice manager', voice, notes, False),
+                                                   ('voice manager, bulk chords of %d' % chord_size, chord, chords,
+                                                    False),
+                                                   ('voice manager + output thread', voice, notes, True),
+                                                   ('bulk chords + output thread', chord, chords, True)):
+        midi_out = IHDNullMidiOut()
+        scheduler = IHDMidiScheduler(midi_out) if output_thread else None
+        voices = IHDVoiceManager(midi_out, gate_sec=.3, scheduler=scheduler)
+        # notes (chords) every 10 ms with note-offs after 300 ms, all in the past: the output thread sends at once
+        times = iter(np.arange(repetitions*len(objects))*1e-2 - 1e6)
+        if scheduler is not None:
+            scheduler.start()
+        start = host_time()
+        for _ in range(repetitions):
+            for obj in objects:
+                function(obj)
+        if scheduler is not None:
+            # wait until all messages are sent
+            scheduler.stop()
+        results.append((name, midi_out.num_messages / (host_time() - start)))
+    return results
+
+
+def benchmark_sampler(frames, repetitions=10):
+    """ Render duration of one block of the sampler (see ihd_sampler.py) with 1, 8 and 32 sounding voices at random
+        pitches (transposed samples), notes which ended are restarted
+    Returns:
+        results (list): List of (name, duration per block in microseconds)
+    """
+    import numpy as np
+    from ihd_sampler import IHDSampler, IHDSampleBank
+
+    bank = IHDSampleBank()
+    random_state = np.random.RandomState(1)
+    results = []
+    for num_voices in (1, 8, 32):
+        sampler = IHDSampler(bank, max_voices=num_voices)
+        block_times = iter(np.arange(repetitions*len(frames))*sampler.block_sec)
+
+        def render(frame):
+            block_time = next(block_times)
+            for _ in range(num_voices - len(sampler)):
+                sampler.note_on(random_state.randint(48, 72), 100, start_time=block_time)
+            sampler.render_block(block_time)
+
+        results.append(('%d voices (block of %.2f ms)' % (num_voices, 1e3*sampler.block_sec),
+                        time_per_frame(render, frames, repetitions)))
+    return results
+
+
+BENCHMARKS = {'hand_extraction': benchmark_hand_extraction,
+              'leap_attributes': benchmark_leap_attributes,
+              'stroke_detection': benchmark_stroke_detection,
+              'finger_detection': benchmark_finger_detection,
+              'pad_lookup': benchmark_pad_lookup,
+              'midi_output': benchmark_midi_output,
+              'sampler': benchmark_sampler}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Per-frame processing microbenchmarks')
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS.keys()))
+    parser.add_argument('--capture', help='Capture file, default: simulated frames')
+    parser.add_argument('--hands', type=int, default=2, help='Number of simulated hands')
+    parser.add_argument('--frames', type=int, default=2000, help='Number of frames')
+    parser.add_argument('--repetitions', type=int, default=10)
+    args = parser.parse_args()
+
+    if args.capture:
+        from ihd_replay import read_frames
+        frames = []
+        for frame in read_frames(args.capture):
+            frames.append(frame)
+            if len(frames) == args.frames:
+                break
+    else:
+        from ihd_simulator import IHDHandSimulator
+        simulator = IHDHandSimulator(num_hands=args.hands, fingers=args.benchmark == 'finger_detection', seed=1)
+        frames = [simulator.next_frame() for _ in range(args.frames)]
+
+    print('%s (%d frames x %d repetitions)' % (args.benchmark, len(frames), args.repetitions))
+    if args.benchmark == 'leap_attributes':
+        print('%-30s %12s %12s %12s' % ('ns / access', 'original', 'fast path', 'direct'))
+        for name, original, fast, direct in BENCHMARKS[args.benchmark](frames, args.repetitions):
+            print('%-30s %12.1f %12.1f %12.1f' % (name, original, fast, direct))
+    elif args.benchmark == 'midi_output':
+        for name, messages_per_sec in BENCHMARKS[args.benchmark](frames, args.repetitions):
+            print('%-40s %12.0f messages / s' % (name, messages_per_sec))
+    else:
+        for name, duration_us in BENCHMARKS[args.benchmark](frames, args.repetitions):
+            print('%-40s %8.2f us / %s' % (name, duration_us, {'pad_lookup': 'lookup',
+                                                               'sampler': 'block'}.get(args.benchmark, 'frame')))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,197 @@
+""" Common timebase for all subsystems, derived from the Leap device frame timestamps
+
+The device timestamps (microseconds) are monotonic and taken at capture time, while the host time at which a frame
+arrives in the callback includes a variable delivery delay. IHDClock maps device timestamps onto the host clock by
+tracking the lower envelope of (arrival time - device time), i.e. the frames with the smallest delivery delay, and
+estimates the drift between both clocks by a line fit over the envelope minima of the last windows.
+"""
+
+import ctypes
+import ctypes.util
+import sys
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+# clock ID of CLOCK_MONOTONIC per platform
+CLOCK_MONOTONIC = {'linux': 1, 'darwin': 6}
+
+
+class Timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+
+def monotonic_clock():
+    """ Monotonic clock (s) for Python 2, which has no time.monotonic
+
+        clock_gettime(CLOCK_MONOTONIC) of the C library on Linux and macOS (10.12+), time.clock (performance counter)
+        on Windows. Falls back to time.time, which jumps with host clock adjustments. The clock is called from the
+        Leap callback, the frame worker and the MIDI output thread, and ctypes releases the GIL during the call,
+        therefore each thread has its own timespec.
+    """
+    if sys.platform == 'win32':
+        return time.clock
+    clock_id = CLOCK_MONOTONIC.get('linux' if sys.platform.startswith('linux') else sys.platform)
+    libc_name = ctypes.util.find_library('c')
+    if clock_id is None or libc_name is None:
+        return time.time
+    try:
+        clock_gettime = ctypes.CDLL(libc_name, use_errno=True).clock_gettime
+    except AttributeError:
+        return time.time
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(Timespec)]
+    thread_data = threading.local()
+
+    def clock():
+        try:
+            timespec = thread_data.timespec
+        except AttributeError:
+            timespec = thread_data.timespec = Timespec()
+            thread_data.timespec_ref = ctypes.byref(timespec)
+        if clock_gettime(clock_id, thread_data.timespec_ref) != 0:
+            raise OSError(ctypes.get_errno(), 'clock_gettime failed')
+        return timespec.tv_sec + timespec.tv_nsec*1e-9
+    return clock
+
+
+try:
+    host_time = time.monotonic
+except AttributeError:
+    host_time = monotonic_clock()
+
+
+class IHDClock:
+    """ Maps device frame timestamps to monotonic host time (s) """
+
+    def __init__(self,
+                 sync_to_host=True,
+                 window_sec=1.,
+                 num_windows=30,
+                 max_drift_ppm=1000.,
+                 resync_threshold_sec=.05):
+        """ Initialize clock
+        Args:
+            sync_to_host (bool): If False, the device time is used without mapping (e.g. for replay at
+                                 arbitrary speed)
+            window_sec (float): Device time span over which the minimum delivery delay is taken
+            num_windows (int): Number of window minima used for drift estimation
+            max_drift_ppm (float): Maximum accepted drift between device and host clock
+            resync_threshold_sec (float): Mapping is reset if arrival times deviate more than this from it
+                                          (device reset / host clock jump)
+        """
+        self.sync_to_host = sync_to_host
+        self.window_sec = window_sec
+        self.num_windows = num_windows
+        self.max_drift = max_drift_ppm*1e-6
+        self.resync_threshold_sec = resync_threshold_sec
+        self.num_resyncs = 0
+        self.prev_frame_time = None
+        # frame time of device time 0 without host sync, rebased if device timestamps restart
+        self.device_offset = 0.
+        self.reset()
+
+    def reset(self):
+        """ Forget mapping, the next frame is used as new reference """
+        self.offset = None
+        self.drift = 0.
+        self.reference_device_sec = None
+        self.window_start_device_sec = None
+        self.window_min = None
+        self.window_minima = deque(maxlen=self.num_windows)
+        self.prev_device_sec = None
+
+    @property
+    def drift_ppm(self):
+        return self.drift*1e6
+
+    def frame_time(self, device_timestamp, arrival_time=None):
+        """ Get time of a frame, to be used by all subsystems processing this frame
+        Args:
+            device_timestamp (int): Leap frame.timestamp (microseconds)
+            arrival_time (float): Host time (see host_time()) at which the frame was received, default: now
+        Returns:
+            frame_time (float): Frame time (s), non-decreasing between subsequent calls (except after a resync to the
+                                host clock)
+        """
+        device_sec = device_timestamp*1e-6
+
+        if self.sync_to_host:
+            if arrival_time is None:
+                arrival_time = host_time()
+            if self.prev_device_sec is not None and device_sec < self.prev_device_sec:
+                # device timestamps restarted (e.g. device reconnected)
+                self.resync()
+            self.update_mapping(device_sec, arrival_time)
+            curr_time = self.map(device_sec)
+        else:
+            if self.prev_device_sec is not None and device_sec < self.prev_device_sec:
+                # device timestamps restarted, frame time continues from the previous frame
+                self.num_resyncs += 1
+                self.device_offset = self.prev_frame_time - device_sec
+            curr_time = device_sec + self.device_offset
+        self.prev_device_sec = device_sec
+
+        if self.prev_frame_time is not None and curr_time < self.prev_frame_time:
+            curr_time = self.prev_frame_time
+        self.prev_frame_time = curr_time
+        return curr_time
+
+    def map(self, device_sec):
+        """ Map device time (s) to host time (s) """
+        return device_sec + self.offset + self.drift*(device_sec - self.reference_device_sec)
+
+    def resync(self):
+        """ Start new mapping, the frame time follows the new mapping even if it lies before the previous frame time
+            (otherwise the frame time would stand still until the host clock reaches the invalid mapping)
+        """
+        self.num_resyncs += 1
+        self.prev_frame_time = None
+        self.reset()
+
+    def update_mapping(self, device_sec, arrival_time):
+        delay = arrival_time - device_sec
+
+        if self.offset is None:
+            self.offset = delay
+            self.reference_device_sec = device_sec
+            self.window_start_device_sec = device_sec
+            self.window_min = (device_sec, delay)
+            return
+
+        residual = arrival_time - self.map(device_sec)
+        if residual < -self.resync_threshold_sec:
+            # frame arrived long before its mapped time, mapping is invalid
+            self.resync()
+            self.update_mapping(device_sec, arrival_time)
+            return
+        if residual < 0:
+            # new lower envelope
+            self.offset += residual
+
+        if delay < self.window_min[1]:
+            self.window_min = (device_sec, delay)
+
+        if device_sec - self.window_start_device_sec >= self.window_sec:
+            window_min_residual = self.window_min[1] - (self.map(self.window_min[0]) - self.window_min[0])
+            if window_min_residual > self.resync_threshold_sec:
+                # all frames of the window arrived late, e.g. host clock jumped forward
+                self.resync()
+                self.update_mapping(device_sec, arrival_time)
+                return
+            self.window_minima.append(self.window_min)
+            self.window_start_device_sec = device_sec
+            self.window_min = (device_sec, delay)
+            self.estimate_drift()
+
+    def estimate_drift(self):
+        """ Fit line through window minima of delivery delay over device time """
+        if len(self.window_minima) < 2:
+            return
+        minima = np.array(self.window_minima)
+        x = minima[:, 0] - self.reference_device_sec
+        drift, offset = np.polyfit(x, minima[:, 1], 1)
+        self.drift = max(-self.max_drift, min(self.max_drift, drift))
+        # shift line onto the lower envelope of the minima
+        self.offset = offset + np.min(minima[:, 1] - (offset + self.drift*x))
@@ -0,0 +1,326 @@
+""" Offline evaluation of stroke detectors against recordings with annotated stroke onsets
+
+A recording is a capture file (see ihd_replay.read_frames) with a sidecar annotation file <capture>.onsets:
+
+    # timestamp_us hand_id [impact_speed]
+    2081530 12 640.5
+    2350120 -1 nan
+
+with the device timestamp of every stroke onset, the ID of the playing hand (-1 if unknown, matches strokes of
+any hand) and optionally the impact speed (mm/s) as reference for the stroke velocity. Hand tracking logs (*.ihdlog)
+are read as memory-mapped hand arrays without creating hand objects.
+
+A detector is described by a spec (dict), so it can be sent to worker processes:
+    detector: 'table' (IHDStrokeStateTable), 'memory' (IHDHandTrackingMemory) or 'module.Class' of any class with
+              detect_strokes(hand_array, frame_id) and on_idle() (see IHDStrokeStateTable)
+    kwargs: further constructor arguments, e.g. {'units': 'mm_per_sec', 'thresholds': {'delta_height': 10}}
+    smoothing: smoothing method (see ihd_smoothing.py), default: raw palm positions
+    reset_after_time_sec: on_idle() is called after this time without strokes (as in IHDGestureDetector)
+
+Every onset is matched with the nearest unmatched stroke of the same hand within the tolerance. Reported are
+precision, recall, onset error (frame time of the detected stroke minus annotated onset) and detection latency
+(onset error plus processing time of the frame, i.e. when the note can be sent). Recordings are processed in parallel.
+
+Usage:
+    python ihd_evaluation.py --simulate sessions --sessions 8
+    python ihd_evaluation.py sessions/*.ihdlog --delta-height 10 --processes 4
+"""
+
+import os
+import sys
+import argparse
+import importlib
+import multiprocessing
+
+import numpy as np
+
+from ihd_clock import host_time
+from ihd_frame import IHDHandArrayExtractor, HAND_ID
+
+DEFAULT_DETECTOR = {'detector': 'table', 'kwargs': {}, 'smoothing': None, 'reset_after_time_sec': 2.}
+
+# columns of stroke arrays
+STROKE_TIMESTAMP, STROKE_HAND_ID, STROKE_VELOCITY, STROKE_DURATION = range(4)
+
+
+def onsets_fn(capture_fn):
+    return capture_fn + '.onsets'
+
+
+def read_onsets(fn):
+    """ Read onset annotations
+    Returns:
+        onsets (np.ndarray): Rows of (timestamp_us, hand_id, impact_speed), ordered by time, impact speed is nan
+                             if not annotated
+    """
+    annotations = np.loadtxt(fn, ndmin=2)
+    onsets = np.full((len(annotations), 3), np.nan)
+    onsets[:, :annotations.shape[1]] = annotations
+    return onsets[np.argsort(onsets[:, 0], kind='mergesort')]
+
+
+def write_onsets(fn, onsets):
+    """ Write onset annotations (rows of timestamp_us, hand_id and optionally impact_speed) """
+    with open(fn, 'w') as f:
+        f.write('# timestamp_us hand_id impact_speed\n')
+        for onset in onsets:
+            impact_speed = onset[2] if len(onset) > 2 else np.nan
+            f.write('%d %d %.1f\n' % (onset[0], onset[1], impact_speed))
+
+
+def load_frames(fn):
+    """ Frames of capture file, hand tracking logs as memory-mapped hand arrays """
+    if fn.endswith('.ihdlog'):
+        from ihd_hand_log import IHDHandLogReader
+        return IHDHandLogReader(fn).hand_array_frames()
+    from ihd_replay import read_frames
+    return read_frames(fn)
+
+
+def create_detector(spec):
+    """ Create detector of spec (see module docstring) """
+    detector = spec.get('detector', 'table')
+    kwargs = spec.get('kwargs', {})
+    if detector == 'table':
+        from ihd_stroke_table import IHDStrokeStateTable
+        return IHDStrokeStateTable(**kwargs)
+    if detector == 'memory':
+        from invisible_hand_drum import IHDHandTrackingMemory
+        return IHDHandTrackingMemory(**kwargs)
+    module_name, _, class_name = detector.rpartition('.')
+    if len(module_name) == 0:
+        raise Exception('Non-valid detector %s' % detector)
+    return getattr(importlib.import_module(module_name), class_name)(**kwargs)
+
+
+def run_detector(frames, spec):
+    """ Run detector over frames
+    Args:
+        frames (iterable): Frames
+        spec (dict): Detector spec
+    Returns:
+        strokes (np.ndarray): Rows of (timestamp_us, hand_id, velocity, processing duration of the frame in us)
+        durations (np.ndarray): Processing duration (us) per frame
+    """
+    from ihd_smoothing import IHDHandSmoother
+
+    detector = create_detector(spec)
+    smoothing = spec.get('smoothing')
+    smoother = IHDHandSmoother(smoothing) if smoothing is not None else None
+    reset_after_us = spec.get('reset_after_time_sec', 2.)*1e6
+    extractor = IHDHandArrayExtractor()
+
+    strokes = []
+    durations = []
+    last_event_timestamp = None
+    for frame_id, frame in enumerate(frames):
+        timestamp = frame.timestamp
+        start = host_time()
+        # idle period (see IHDGestureDetector.update_time)
+        if last_event_timestamp is None:
+            last_event_timestamp = timestamp
+        elif timestamp - last_event_timestamp > reset_after_us:
+            detector.on_idle()
+            last_event_timestamp = timestamp
+        hands = extractor.extract(frame)
+        if smoother is not None:
+            smoother.smooth(hands)
+        stroke_rows, velocities = detector.detect_strokes(hands, frame_id)
+        duration = 1e6*(host_time() - start)
+        durations.append(duration)
+        if len(stroke_rows) > 0:
+            last_event_timestamp = timestamp
+            for row, velocity in zip(stroke_rows, velocities):
+                strokes.append((timestamp, hands[row, HAND_ID], velocity, duration))
+    return np.array(strokes, dtype=float).reshape((-1, 4)), np.array(durations)
+
+
+def match_strokes(strokes, onsets, tolerance_us):
+    """ Match each onset with the nearest unmatched stroke of the same hand (in order of the onsets)
+    Args:
+        strokes (np.ndarray): Stroke array (see run_detector)
+        onsets (np.ndarray): Rows of (timestamp_us, hand_id, ...), hand_id -1 matches any hand
+        tolerance_us (float): Maximum distance between stroke and onset
+    Returns:
+        stroke_indices (np.ndarray): Index of the matched stroke per onset, -1 if none
+    """
+    is_matched = np.zeros(len(strokes), dtype=bool)
+    stroke_indices = np.full(len(onsets), -1, dtype=np.int64)
+    for onset_idx, (onset_timestamp, hand_id) in enumerate(onsets[:, :2]):
+        errors = strokes[:, STROKE_TIMESTAMP] - onset_timestamp
+        candidates = ~is_matched & (np.abs(errors) <= tolerance_us)
+        if hand_id >= 0:
+            candidates &= strokes[:, STROKE_HAND_ID] == hand_id
+        candidates = np.flatnonzero(candidates)
+        if len(candidates) > 0:
+            nearest = candidates[np.argmin(np.abs(errors[candidates]))]
+            is_matched[nearest] = True
+            stroke_indices[onset_idx] = nearest
+    return stroke_indices
+
+
+def percentiles(values, q=(5, 50, 95)):
+    return list(np.percentile(values, q)) if len(values) > 0 else [np.nan]*len(q)
+
+
+def score(strokes, onsets, durations, tolerance_us=1e5):
+    """ Detection metrics of strokes against annotated onsets
+    Returns:
+        results (dict): Counts, precision, recall, onset error and detection latency (p5 / median / p95 in ms),
+                        processing time per frame (mean / p99 in us)
+    """
+    stroke_indices = match_strokes(strokes, onsets, tolerance_us)
+    matched = stroke_indices[stroke_indices >= 0]
+    errors = (strokes[matched, STROKE_TIMESTAMP] - onsets[stroke_indices >= 0, 0])*1e-3
+    latencies = errors + strokes[matched, STROKE_DURATION]*1e-3
+    num_true = len(matched)
+    return {'onsets': len(onsets),
+            'strokes': len(strokes),
+            'true_positives': num_true,
+            'false_positives': len(strokes) - num_true,
+            'false_negatives': len(onsets) - num_true,
+            'precision': num_true / float(max(1, len(strokes))),
+            'recall': num_true / float(max(1, len(onsets))),
+            'onset_error': percentiles(errors),
+            'detection_latency': percentiles(latencies),
+            'processing': [np.mean(durations) if len(durations) > 0 else np.nan] + percentiles(durations, (99,)),
+            # raw values for aggregation over recordings
+            'stroke_indices': stroke_indices,
+            'errors': errors,
+            'latencies': latencies,
+            'durations': durations}
+
+
+def evaluate_recording(args):
+    """ Evaluate detector on one recording (worker function)
+    Args:
+        args (tuple): Capture file name, detector spec, tolerance (us)
+    Returns:
+        results (dict): See score()
+    """
+    fn, spec, tolerance_us = args
+    strokes, durations = run_detector(load_frames(fn), spec)
+    results = score(strokes, read_onsets(onsets_fn(fn)), durations, tolerance_us)
+    results['recording'] = fn
+    return results
+
+
+def aggregate(all_results):
+    """ Combine results of several recordings """
+    counts = dict((key, sum([results[key] for results in all_results]))
+                  for key in ('onsets', 'strokes', 'true_positives', 'false_positives', 'false_negatives'))
+    errors = np.concatenate([results['errors'] for results in all_results] + [np.zeros(0)])
+    latencies = np.concatenate([results['latencies'] for results in all_results] + [np.zeros(0)])
+    durations = np.concatenate([results['durations'] for results in all_results] + [np.zeros(0)])
+    counts.update({'precision': counts['true_positives'] / float(max(1, counts['strokes'])),
+                   'recall': counts['true_positives'] / float(max(1, counts['onsets'])),
+                   'onset_error': percentiles(errors),
+                   'detection_latency': percentiles(latencies),
+                   'processing': [np.mean(durations) if len(durations) > 0 else np.nan] + percentiles(durations, (99,)),
+                   'recording': 'all'})
+    return counts
+
+
+def evaluate(fns, spec=None, tolerance_sec=.1, processes=None):
+    """ Evaluate detector on recordings in a process pool
+    Args:
+        fns (list): Capture file names (with annotation files)
+        spec (dict): Detector spec, default: DEFAULT_DETECTOR
+        tolerance_sec (float): Maximum distance between detected stroke and annotated onset
+        processes (int): Number of worker processes, default: number of cores, 1: evaluate in this process
+    Returns:
+        results (list): Results per recording
+        total (dict): Results of all recordings
+    """
+    spec = spec if spec is not None else DEFAULT_DETECTOR
+    tasks = [(fn, spec, tolerance_sec*1e6) for fn in fns]
+    processes = processes if processes is not None else multiprocessing.cpu_count()
+    if processes <= 1 or len(tasks) <= 1:
+        results = [evaluate_recording(task) for task in tasks]
+    else:
+        pool = multiprocessing.Pool(min(processes, len(tasks)))
+        try:
+            results = pool.map(evaluate_recording, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    return results, aggregate(results)
+
+
+def simulate_recordings(directory, num_sessions=8, duration_sec=60., **kwargs):
+    """ Write simulated sessions as hand tracking logs with onset annotations (impacts of the simulated strokes)
+    Args:
+        directory (string): Output directory
+        num_sessions (int): Number of sessions (seeds 0 .. num_sessions-1)
+        duration_sec (float): Session duration
+        kwargs: Further arguments of IHDHandSimulator
+    Returns:
+        fns (list): Capture file names
+    """
+    from ihd_hand_log import convert_to_hand_log
+    from ihd_simulator import IHDHandSimulator
+
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    fns = []
+    for seed in range(num_sessions):
+        simulator = IHDHandSimulator(seed=seed, **kwargs)
+        fn = os.path.join(directory, 'simulated_%03d.ihdlog' % seed)
+        convert_to_hand_log(simulator.frames(duration_sec), fn)
+        impacts = simulator.impacts
+        write_onsets(onsets_fn(fn), np.column_stack((np.round(impacts[:, 1]*1e6), impacts[:, 0], impacts[:, 2])))
+        fns.append(fn)
+    return fns
+
+
+def format_results(results):
+    return ('%-28s %6d %7d %6d %6d %6.3f %6.3f %7.1f %7.1f %7.1f %7.1f %7.1f' %
+            ((os.path.basename(results['recording'])[-28:], results['onsets'], results['strokes'],
+              results['false_positives'], results['false_negatives'], results['precision'], results['recall']) +
+             tuple(results['onset_error']) + tuple(results['detection_latency'][1:2]) + (results['processing'][0],)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Evaluate stroke detection against annotated recordings')
+    parser.add_argument('recordings', nargs='*', help='Capture files with <capture>.onsets annotation files')
+    parser.add_argument('--detector', default='table', help="'table', 'memory' or module.Class")
+    parser.add_argument('--units', default='mm_per_frame', choices=['mm_per_frame', 'mm_per_sec'])
+    parser.add_argument('--delta-height', type=float, help='Stroke threshold (mm)')
+    parser.add_argument('--per-frame-threshold', type=float, help='Minimum downward movement per frame (mm)')
+    parser.add_argument('--smoothing', choices=['one_euro', 'kalman'])
+    parser.add_argument('--tolerance', type=float, default=.1, help='Maximum onset error (s) of a detected stroke')
+    parser.add_argument('--processes', type=int, help='Number of worker processes, default: number of cores')
+    parser.add_argument('--simulate', help='Write simulated annotated recordings to this directory and evaluate them')
+    parser.add_argument('--sessions', type=int, default=8, help='Number of simulated recordings')
+    parser.add_argument('--hands', type=int, default=2, help='Number of simulated hands')
+    parser.add_argument('--jitter', type=float, default=1., help='Simulated tracking noise (mm)')
+    args = parser.parse_args()
+
+    fns = list(args.recordings)
+    if args.simulate:
+        fns += simulate_recordings(args.simulate, args.sessions, num_hands=args.hands, jitter_mm=args.jitter,
+                                   stroke_rate_hz=3.)
+    if len(fns) == 0:
+        parser.error('no recordings')
+
+    thresholds = {}
+    if args.delta_height is not None:
+        thresholds['delta_height'] = args.delta_height
+    if args.per_frame_threshold is not None:
+        thresholds['delta_height_per_frame_threshold'] = args.per_frame_threshold
+    spec = dict(DEFAULT_DETECTOR, detector=args.detector, smoothing=args.smoothing,
+                kwargs={'units': args.units, 'thresholds': thresholds})
+
+    start = host_time()
+    results, total = evaluate(fns, spec, args.tolerance, args.processes)
+    print('%-28s %6s %7s %6s %6s %6s %6s %7s %7s %7s %7s %7s' % ('recording', 'onsets', 'strokes', 'FP', 'FN',
+                                                                 'prec', 'recall', 'err_p5', 'err_med', 'err_p95',
+                                                                 'lat_med', 'us/frm'))
+    for recording_results in results:
+        print(format_results(recording_results))
+    print(format_results(total))
+    print('(onset error and detection latency in ms, %d recordings in %.1f s)' % (len(fns), host_time() - start))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,210 @@
+""" Lightweight stand-ins for Leap Motion frame objects
+
+The classes mirror the small part of the Leap API the hand drum relies on (frame.hands, hand.id, hand.palm_position,
+frame.gestures(), ...) so that recorded or synthetic sessions can be fed to IHDController without the Leap service.
+
+extract_hand_array() converts the hands of a frame (Leap or stand-in) into rows of a NumPy array, which is the input
+format of the stroke detection. extract_finger_array() converts the fingertips of all hands into rows of the same
+layout (finger ID, handedness, tip position, tip velocity, timestamp), so fingertips are detected by the same stroke
+state machine.
+"""
+
+import numpy as np
+
+# columns of hand arrays
+HAND_ID, HAND_IS_LEFT, HAND_PALM_X, HAND_PALM_Y, HAND_PALM_Z, HAND_VELOCITY_X, HAND_VELOCITY_Y, HAND_VELOCITY_Z, \
+    HAND_TIMESTAMP = range(9)
+NUM_HAND_COLUMNS = 9
+NUM_FINGERS = 5
+
+
+class IHDVector(tuple):
+    """ Immutable 3D vector which can be indexed like Leap.Vector (position[1]) or accessed via x / y / z """
+
+    def __new__(cls, x=0., y=0., z=0.):
+        return tuple.__new__(cls, (float(x), float(y), float(z)))
+
+    @property
+    def x(self):
+        return self[0]
+
+    @property
+    def y(self):
+        return self[1]
+
+    @property
+    def z(self):
+        return self[2]
+
+    def to_float_array(self):
+        return [self[0], self[1], self[2]]
+
+    def to_tuple(self):
+        return tuple(self)
+
+
+class IHDFingerState:
+    """ Tracking state of a single finger within a frame (tip position is the TIP joint of the distal bone) """
+
+    def __init__(self, _id, _type, tip_position, tip_velocity=None):
+        self.id = _id
+        self.type = _type
+        self.tip_position = IHDVector(*tip_position)
+        self.tip_velocity = IHDVector(*tip_velocity) if tip_velocity is not None else IHDVector()
+        self.is_valid = True
+
+
+class IHDHandState:
+    """ Tracking state of a single hand within a frame """
+
+    def __init__(self, _id, palm_position, palm_velocity=None, is_left=False, fingers=None):
+        self.id = _id
+        self.palm_position = IHDVector(*palm_position)
+        self.palm_velocity = IHDVector(*palm_velocity) if palm_velocity is not None else IHDVector()
+        self.is_left = bool(is_left)
+        self.is_right = not self.is_left
+        self.is_valid = True
+        # list of IHDFingerState (empty for recordings without fingers)
+        self.fingers = fingers if fingers is not None else []
+
+
+class IHDFrameState:
+    """ Tracking state of all hands at one point in time (device timestamp in microseconds) """
+
+    def __init__(self, _id, timestamp, hands=None, gestures=None, swipes=None, is_valid=True, hand_array=None,
+                 finger_array=None):
+        """ Initialize frame
+        Args:
+            _id (int): Frame ID
+            timestamp (int): Device timestamp (microseconds)
+            hands (list): List of IHDHandState
+            gestures (list): Leap gestures
+            swipes (list): Swipe gestures as (dx, is_left_hand), see IHDTools.get_swipes()
+            is_valid (bool): False for invalid frames (e.g. frame history exceeded)
+            hand_array (np.ndarray): Hands as rows of hand array (alternative to hands), see extract_hand_array()
+            finger_array (np.ndarray): Fingertips as rows of finger array (snapshots of hand_array frames, which have
+                                       no finger objects), see extract_finger_array()
+        """
+        self.id = _id
+        self.timestamp = timestamp
+        self._hands = hands
+        self._gestures = gestures if gestures is not None else []
+        self.swipes = swipes if swipes is not None else []
+        self.is_valid = is_valid
+        self.hand_array = hand_array
+        self.finger_array = finger_array
+        if hands is None and hand_array is None:
+            self._hands = []
+
+    @property
+    def hands(self):
+        # hand objects are only created on demand for frames given as hand array
+        if self._hands is None:
+            self._hands = [IHDHandState(int(row[HAND_ID]),
+                                        row[HAND_PALM_X:HAND_PALM_Z + 1],
+                                        row[HAND_VELOCITY_X:HAND_VELOCITY_Z + 1],
+                                        is_left=row[HAND_IS_LEFT]) for row in self.hand_array]
+        return self._hands
+
+    def gestures(self, since_frame=None):
+        return self._gestures
+
+    def hand(self, _id):
+        for hand in self.hands:
+            if hand.id == _id:
+                return hand
+        return None
+
+    @staticmethod
+    def from_leap_frame(frame):
+        """ Copy hand state of a Leap.Frame (device frame or deserialized frame) """
+        hands = [IHDHandState(hand.id,
+                              hand.palm_position.to_tuple(),
+                              hand.palm_velocity.to_tuple(),
+                              hand.is_left) for hand in frame.hands]
+        return IHDFrameState(frame.id, frame.timestamp, hands)
+
+
+IHDFrameState.invalid = IHDFrameState(-1, 0, is_valid=False)
+
+
+def extract_hand_array(frame, out):
+    """ Copy id, handedness, palm position, palm velocity and timestamp of all hands into rows of hand array
+        in a single pass over the hands
+    Args:
+        frame (Leap.Frame or IHDFrameState): Frame
+        out (np.ndarray): Preallocated hand array (max_hands x NUM_HAND_COLUMNS)
+    Returns:
+        num_hands (int): Number of hands in frame, only the first len(out) hands are copied
+    """
+    hand_array = frame.hand_array if isinstance(frame, IHDFrameState) else None
+    if hand_array is not None:
+        num_hands = len(hand_array)
+        num_copied = min(num_hands, len(out))
+        out[:num_copied] = hand_array[:num_copied]
+        return num_hands
+
+    timestamp = frame.timestamp
+    rows = [(hand.id, hand.is_left) + hand.palm_position.to_tuple() + hand.palm_velocity.to_tuple() + (timestamp,)
+            for hand in frame.hands]
+    num_hands = len(rows)
+    if num_hands > 0:
+        num_copied = min(num_hands, len(out))
+        out[:num_copied] = rows[:num_copied]
+    return num_hands
+
+
+def extract_finger_array(frame, out):
+    """ Copy id, handedness, tip position, tip velocity and timestamp of the fingers of all hands into rows of a
+        finger array (same columns as hand arrays) in a single pass over hands and fingers
+    Args:
+        frame (Leap.Frame or IHDFrameState): Frame
+        out (np.ndarray): Preallocated finger array (max_fingers x NUM_HAND_COLUMNS)
+    Returns:
+        num_fingers (int): Number of fingers in frame, only the first len(out) fingers are copied
+    """
+    finger_array = frame.finger_array if isinstance(frame, IHDFrameState) else None
+    if finger_array is not None:
+        num_fingers = len(finger_array)
+        num_copied = min(num_fingers, len(out))
+        out[:num_copied] = finger_array[:num_copied]
+        return num_fingers
+
+    timestamp = frame.timestamp
+    rows = [(finger.id, hand.is_left) + finger.tip_position.to_tuple() + finger.tip_velocity.to_tuple() +
+            (timestamp,) for hand in frame.hands for finger in hand.fingers]
+    num_fingers = len(rows)
+    if num_fingers > 0:
+        num_copied = min(num_fingers, len(out))
+        out[:num_copied] = rows[:num_copied]
+    return num_fingers
+
+
+class IHDHandArrayExtractor:
+    """ Extracts hands (or fingertips) of frames into a preallocated, reused hand array """
+
+    def __init__(self, max_hands=4, fingers=False):
+        """ Initialize extractor
+        Args:
+            max_hands (int): Maximum number of hands per frame, further hands are truncated
+            fingers (bool): Extract one row per fingertip (see extract_finger_array) instead of one row per palm
+        """
+        self.max_hands = max_hands
+        self.fingers = fingers
+        self.max_rows = max_hands*NUM_FINGERS if fingers else max_hands
+        self.extract_function = extract_finger_array if fingers else extract_hand_array
+        self.hand_array = np.zeros((self.max_rows, NUM_HAND_COLUMNS))
+        self.num_truncated_hands = 0
+
+    def extract(self, frame):
+        """ Extract hands of frame
+        Args:
+            frame (Leap.Frame or IHDFrameState): Frame
+        Returns:
+            hand_array (np.ndarray): View on rows of all hands / fingertips (valid until next call)
+        """
+        num_rows = self.extract_function(frame, self.hand_array)
+        if num_rows > self.max_rows:
+            self.num_truncated_hands += num_rows - self.max_rows
+            num_rows = self.max_rows
+        return self.hand_array[:num_rows]
@@ -0,0 +1,187 @@
+""" Lifecycle of tracked hands: loss, re-association and expiry
+
+If hand tracking is interrupted, the Leap service reports the hand with a new ID once it is found again. Instead of
+dropping the state of a hand as soon as its ID is missing, IHDHandLifecycle keeps the slot of a lost hand for
+max_lost_sec. A new hand ID is re-associated with the nearest lost hand of the same handedness whose last palm
+position is within max_distance_mm, so the stroke state (e.g. a downward motion in progress) is continued.
+
+Lost hands are kept in an expiry index (heap ordered by expiry time), only hands whose time is up are visited.
+IHDHandLifecycle keeps the lost slots of IHDStrokeStateTable (ihd_stroke_table.py), IHDLostHands the lost entries of
+IHDHandTrackingMemory (invisible_hand_drum.py).
+"""
+
+import heapq
+import math
+
+import numpy as np
+
+from ihd_frame import HAND_IS_LEFT, HAND_PALM_X, HAND_PALM_Z
+
+
+class IHDHandLifecycle:
+    """ Lost hands of IHDStrokeStateTable slots with expiry index """
+
+    def __init__(self, capacity=16, max_lost_sec=.5, max_distance_mm=100.):
+        """ Initialize lifecycle
+        Args:
+            capacity (int): Number of slots
+            max_lost_sec (float): Time (device time) after which a lost hand is removed
+            max_distance_mm (float): Maximum distance between the last position of a lost hand and a new hand
+                                     for re-association
+        """
+        self.capacity = capacity
+        self.max_lost_us = max_lost_sec*1e6
+        self.max_distance_mm = max_distance_mm
+
+        self.is_lost = np.zeros(capacity, dtype=bool)
+        # incremented whenever a hand of a slot is lost, entries of earlier losses in the expiry index are stale
+        self.generation = np.zeros(capacity, dtype=np.int64)
+        self.is_left = np.zeros(capacity)
+        self.positions = np.zeros((capacity, 3))
+        # heap of (expiry timestamp, slot, generation)
+        self.expiry_index = []
+
+        self.num_lost = 0
+        self.num_reassociated = 0
+        self.num_expired = 0
+
+    def reset(self):
+        self.is_lost[:] = False
+        self.expiry_index = []
+
+    def update(self, slots, hands):
+        """ Save handedness and palm position of the tracked hands (hand array rows) """
+        self.is_left[slots] = hands[:, HAND_IS_LEFT]
+        self.positions[slots] = hands[:, HAND_PALM_X:HAND_PALM_Z + 1]
+
+    def mark_lost(self, slots, last_timestamps):
+        """ Add hands which are no longer tracked to expiry index
+        Args:
+            slots (np.ndarray): Slots of hands, which were tracked so far
+            last_timestamps (np.ndarray): Device timestamps (microseconds) of the frames the hands were last seen in
+        """
+        self.is_lost[slots] = True
+        self.generation[slots] += 1
+        for slot, generation, timestamp in zip(slots, self.generation[slots], last_timestamps):
+            heapq.heappush(self.expiry_index, (timestamp + self.max_lost_us, slot, generation))
+        self.num_lost += len(slots)
+
+    def mark_found(self, slots):
+        """ Hands of slots (indices or mask) are tracked with their previous ID again """
+        self.is_lost[slots] = False
+
+    def expire(self, timestamp):
+        """ Remove lost hands whose time is up
+        Args:
+            timestamp (float): Current device timestamp (microseconds)
+        Returns:
+            slots (list): Slots to be freed
+        """
+        slots = []
+        while self.expiry_index and self.expiry_index[0][0] < timestamp:
+            _, slot, generation = heapq.heappop(self.expiry_index)
+            if self.is_lost[slot] and self.generation[slot] == generation:
+                # hand was not found again
+                self.is_lost[slot] = False
+                slots.append(slot)
+        self.num_expired += len(slots)
+        return slots
+
+    def reassociate(self, hand):
+        """ Find lost hand for a new hand ID
+        Args:
+            hand (np.ndarray): Hand array row of the new hand
+        Returns:
+            slot (int): Slot of the nearest lost hand with same handedness, None if there is none within
+                        max_distance_mm
+        """
+        candidates = np.flatnonzero(self.is_lost & (self.is_left == hand[HAND_IS_LEFT]))
+        if len(candidates) == 0:
+            return None
+        distances = np.sqrt(np.sum(np.square(self.positions[candidates] - hand[HAND_PALM_X:HAND_PALM_Z + 1]),
+                                   axis=1))
+        nearest = np.argmin(distances)
+        if distances[nearest] > self.max_distance_mm:
+            return None
+        slot = candidates[nearest]
+        self.is_lost[slot] = False
+        self.num_reassociated += 1
+        return slot
+
+    def report(self):
+        return '%d hands lost, %d re-associated, %d expired' % (self.num_lost, self.num_reassociated,
+                                                                  self.num_expired)
+
+
+class IHDLostHands:
+    """ Lost entries of IHDHandTrackingMemory (by hand ID) with expiry index """
+
+    def __init__(self, max_lost_sec=.5, max_distance_mm=100.):
+        """ Initialize lost hands
+        Args:
+            max_lost_sec (float): Time (device time) after which a lost hand is removed
+            max_distance_mm (float): Maximum distance between the last position of a lost hand and a new hand
+                                     for re-association
+        """
+        self.max_lost_us = max_lost_sec*1e6
+        self.max_distance_mm = max_distance_mm
+
+        # hand ID -> (entry, number of the loss), entries of earlier losses in the expiry index are stale
+        self.lost = {}
+        # heap of (expiry timestamp, number of the loss, hand ID)
+        self.expiry_index = []
+
+        self.num_lost = 0
+        self.num_reassociated = 0
+        self.num_expired = 0
+
+    def reset(self):
+        self.lost = {}
+        self.expiry_index = []
+
+    def mark_lost(self, _id, entry):
+        """ Keep entry of a hand which is no longer tracked (IHDHandTracking, last seen at entry.prev_timestamp) """
+        self.lost[_id] = (entry, self.num_lost)
+        heapq.heappush(self.expiry_index, (entry.prev_timestamp + self.max_lost_us, self.num_lost, _id))
+        self.num_lost += 1
+
+    def expire(self, timestamp):
+        """ Remove lost hands whose time is up
+        Args:
+            timestamp (float): Current device timestamp (microseconds)
+        """
+        while self.expiry_index and self.expiry_index[0][0] < timestamp:
+            _, loss, _id = heapq.heappop(self.expiry_index)
+            if _id in self.lost and self.lost[_id][1] == loss:
+                # hand was not found again
+                del self.lost[_id]
+                self.num_expired += 1
+
+    def reassociate(self, position, is_left):
+        """ Find lost hand for a new hand ID
+        Args:
+            position (tuple): Palm position (x, y, z) of the new hand in mm
+            is_left (bool): Handedness of the new hand
+        Returns:
+            entry (IHDHandTracking): Entry of the nearest lost hand with same handedness, None if there is none
+                                     within max_distance_mm
+        """
+        nearest_id = None
+        nearest_distance = self.max_distance_mm
+        for _id, (entry, _) in self.lost.items():
+            if entry.is_left != is_left:
+                continue
+            last_position = entry.prev_position
+            distance = math.sqrt((last_position[0] - position[0])**2 + (last_position[1] - position[1])**2 +
+                                 (last_position[2] - position[2])**2)
+            if distance <= nearest_distance:
+                nearest_id = _id
+                nearest_distance = distance
+        if nearest_id is None:
+            return None
+        self.num_reassociated += 1
+        return self.lost.pop(nearest_id)[0]
+
+    def report(self):
+        return '%d hands lost, %d re-associated, %d expired' % (self.num_lost, self.num_reassociated,
+                                                                  self.num_expired)
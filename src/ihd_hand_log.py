@@ -0,0 +1,202 @@
+""" Append-only, memory-mapped hand tracking log
+
+Each tracked hand per frame is stored as one fixed-width record (see HAND_LOG_DTYPE) so that captures can be sliced
+with NumPy without parsing and without the Leap library. Frames without any tracked hand are stored as a single
+record with hand_id = NO_HAND_ID to keep the frame timing intact.
+
+File layout:
+    header (HEADER_SIZE bytes): magic, format version, record size, number of records
+    records (num_records x HAND_LOG_DTYPE.itemsize bytes)
+"""
+
+import os
+import struct
+
+import numpy as np
+
+from ihd_frame import IHDFrameState, IHDHandState, NUM_HAND_COLUMNS, HAND_ID, HAND_IS_LEFT, HAND_PALM_X, \
+    HAND_PALM_Z, HAND_VELOCITY_X, HAND_VELOCITY_Z, HAND_TIMESTAMP
+
+HAND_LOG_DTYPE = np.dtype([('frame_id', '<i8'),
+                           ('timestamp', '<i8'),
+                           ('hand_id', '<i4'),
+                           ('is_left', 'u1'),
+                           ('palm_position', '<f4', (3,)),
+                           ('palm_velocity', '<f4', (3,))])
+
+NO_HAND_ID = -1
+
+HEADER_MAGIC = b'IHDLOG'
+HEADER_VERSION = 1
+HEADER_FORMAT = '<6sHIQ'
+HEADER_SIZE = 64
+
+
+def _write_header(f, num_records):
+    f.seek(0)
+    f.write(struct.pack(HEADER_FORMAT, HEADER_MAGIC, HEADER_VERSION, HAND_LOG_DTYPE.itemsize, num_records))
+
+
+def _read_header(f):
+    f.seek(0)
+    magic, version, record_size, num_records = struct.unpack(HEADER_FORMAT, f.read(struct.calcsize(HEADER_FORMAT)))
+    if magic != HEADER_MAGIC:
+        raise Exception('No hand tracking log file')
+    if version != HEADER_VERSION or record_size != HAND_LOG_DTYPE.itemsize:
+        raise Exception('Unsupported hand tracking log version')
+    return num_records
+
+
+class IHDHandLogWriter:
+    """ Appends hand records to memory-mapped log file, the file grows in chunks of chunk_size records """
+
+    def __init__(self, fn, chunk_size=65536):
+        self.fn = fn
+        self.chunk_size = chunk_size
+        self.num_records = 0
+        self.capacity = 0
+        self.records = None
+
+        self.f = open(fn, 'w+b')
+        _write_header(self.f, 0)
+        self.f.truncate(HEADER_SIZE)
+        self.grow()
+
+    def grow(self):
+        """ Extend file by one chunk and re-map records """
+        if self.records is not None:
+            self.records.flush()
+            self.records = None
+        self.capacity += self.chunk_size
+        self.f.truncate(HEADER_SIZE + self.capacity*HAND_LOG_DTYPE.itemsize)
+        self.records = np.memmap(self.f, dtype=HAND_LOG_DTYPE, mode='r+', offset=HEADER_SIZE, shape=(self.capacity,))
+
+    def reserve(self, num_records):
+        """ Returns writable view on the next num_records records """
+        while self.num_records + num_records > self.capacity:
+            self.grow()
+        view = self.records[self.num_records:self.num_records + num_records]
+        self.num_records += num_records
+        return view
+
+    def append_frame(self, frame):
+        """ Append all hands of a frame (Leap.Frame or IHDFrameState) """
+        hands = frame.hands
+        num_hands = len(hands)
+        view = self.reserve(max(1, num_hands))
+        view['frame_id'] = frame.id
+        view['timestamp'] = frame.timestamp
+        if num_hands == 0:
+            view['hand_id'] = NO_HAND_ID
+            view['is_left'] = 0
+            view['palm_position'] = 0
+            view['palm_velocity'] = 0
+        for i, hand in enumerate(hands):
+            view['hand_id'][i] = hand.id
+            view['is_left'][i] = hand.is_left
+            view['palm_position'][i] = hand.palm_position.to_tuple()
+            view['palm_velocity'][i] = hand.palm_velocity.to_tuple()
+
+    def append_records(self, records):
+        """ Append array of HAND_LOG_DTYPE records """
+        self.reserve(len(records))[:] = records
+
+    def flush(self):
+        """ Write records and record count to disk, readers only see flushed records """
+        self.records.flush()
+        _write_header(self.f, self.num_records)
+        self.f.flush()
+
+    def close(self):
+        if self.f.closed:
+            return
+        self.flush()
+        self.records = None
+        # drop unused part of last chunk
+        self.f.truncate(HEADER_SIZE + self.num_records*HAND_LOG_DTYPE.itemsize)
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class IHDHandLogReader:
+    """ Read-only memory-mapped view on hand tracking log """
+
+    def __init__(self, fn):
+        self.fn = fn
+        with open(fn, 'rb') as f:
+            self.num_records = _read_header(f)
+        if self.num_records > 0:
+            self.records = np.memmap(fn, dtype=HAND_LOG_DTYPE, mode='r', offset=HEADER_SIZE,
+                                     shape=(self.num_records,))
+        else:
+            self.records = np.zeros(0, dtype=HAND_LOG_DTYPE)
+        self._frame_starts = None
+
+    def __len__(self):
+        return self.num_records
+
+    @property
+    def frame_starts(self):
+        """ Record index of first record of each frame (with one additional entry for the end) """
+        if self._frame_starts is None:
+            frame_ids = self.records['frame_id']
+            self._frame_starts = np.concatenate(([0],
+                                                 np.flatnonzero(frame_ids[1:] != frame_ids[:-1]) + 1,
+                                                 [self.num_records])) if self.num_records > 0 else np.zeros(1, int)
+        return self._frame_starts
+
+    @property
+    def num_frames(self):
+        return len(self.frame_starts) - 1
+
+    def frame_records(self, frame_idx):
+        """ Records of all hands in frame with given index (0 .. num_frames-1) """
+        return self.records[self.frame_starts[frame_idx]:self.frame_starts[frame_idx + 1]]
+
+    def frames(self, start=0, stop=None):
+        """ Generator over IHDFrameState objects, e.g. to feed IHDReplayController """
+        if stop is None:
+            stop = self.num_frames
+        for frame_idx in range(start, stop):
+            records = self.frame_records(frame_idx)
+            hands = [IHDHandState(int(record['hand_id']),
+                                  record['palm_position'],
+                                  record['palm_velocity'],
+                                  is_left=record['is_left']) for record in records if record['hand_id'] != NO_HAND_ID]
+            yield IHDFrameState(int(records['frame_id'][0]), int(records['timestamp'][0]), hands)
+
+    def hand_array(self):
+        """ All records as rows of one hand array (see ihd_frame.extract_hand_array) """
+        hand_array = np.empty((self.num_records, NUM_HAND_COLUMNS))
+        hand_array[:, HAND_ID] = self.records['hand_id']
+        hand_array[:, HAND_IS_LEFT] = self.records['is_left']
+        hand_array[:, HAND_PALM_X:HAND_PALM_Z + 1] = self.records['palm_position']
+        hand_array[:, HAND_VELOCITY_X:HAND_VELOCITY_Z + 1] = self.records['palm_velocity']
+        hand_array[:, HAND_TIMESTAMP] = self.records['timestamp']
+        return hand_array
+
+    def hand_array_frames(self, start=0, stop=None):
+        """ Generator over IHDFrameState objects with views on the hand array of the log (no hand objects) """
+        if stop is None:
+            stop = self.num_frames
+        hand_array = self.hand_array()
+        frame_starts = self.frame_starts
+        for frame_idx in range(start, stop):
+            first, end = frame_starts[frame_idx], frame_starts[frame_idx + 1]
+            if hand_array[first, HAND_ID] == NO_HAND_ID:
+                end = first
+            yield IHDFrameState(int(self.records['frame_id'][first]), int(self.records['timestamp'][first]),
+                                hand_array=hand_array[first:end])
+
+
+def convert_to_hand_log(frames, fn):
+    """ Write frames (Leap.Frame or IHDFrameState) from other capture formats into hand tracking log """
+    with IHDHandLogWriter(fn) as writer:
+        for frame in frames:
+            writer.append_frame(frame)
+    return os.path.getsize(fn)
@@ -0,0 +1,216 @@
+""" Handoff of hand tracking snapshots from the Leap callback thread to a processing worker thread
+
+The Leap callback (producer) only copies the hand state of a frame into a preallocated slot of a single-producer /
+single-consumer ring buffer. A worker thread (consumer) takes snapshots in order and runs detection and output.
+Producer and consumer each own one index (head / tail) so no lock is needed for the data path, the worker is only
+woken up via an event when the buffer was empty.
+
+With frame_references, the callback only keeps a reference to the frame and the worker reads its hand objects (the
+per-hand memory reads them directly, see IHDGestureDetector.per_hand_access), so the hand array extraction is not run
+on the callback thread at all.
+"""
+
+import threading
+import traceback
+
+import numpy as np
+
+from ihd_clock import host_time
+from ihd_frame import IHDFrameState, NUM_FINGERS, NUM_HAND_COLUMNS, extract_finger_array, extract_hand_array
+
+
+class IHDFrameRingBuffer:
+    """ Preallocated single-producer / single-consumer ring buffer of frame snapshots """
+
+    def __init__(self, capacity=256, max_hands=4, max_swipes=4, fingers=False, frame_references=False):
+        """ Initialize ring buffer
+        Args:
+            capacity (int): Number of snapshots
+            max_hands (int): Maximum number of hands per snapshot
+            max_swipes (int): Maximum number of swipes per snapshot
+            fingers (bool): Additionally snapshot the fingertips of all hands (finger tracking)
+            frame_references (bool): Keep references to the frames instead of snapshots of their hands and swipes
+        """
+        self.capacity = capacity
+        self.max_hands = max_hands
+        self.max_swipes = max_swipes
+
+        self.frame_ids = np.zeros(capacity, dtype=np.int64)
+        self.timestamps = np.zeros(capacity, dtype=np.int64)
+        self.capture_times = np.zeros(capacity)
+        self.num_hands = np.zeros(capacity, dtype=np.int32)
+        self.hands = np.zeros((capacity, max_hands, NUM_HAND_COLUMNS))
+        self.fingers = fingers
+        self.max_fingers = max_hands*NUM_FINGERS
+        self.num_fingers = np.zeros(capacity, dtype=np.int32)
+        self.finger_rows = np.zeros((capacity, self.max_fingers, NUM_HAND_COLUMNS)) if fingers else None
+        self.num_swipes = np.zeros(capacity, dtype=np.int32)
+        # swipe: horizontal distance between start and current position, is left hand
+        self.swipes = np.zeros((capacity, max_swipes, 2))
+        self.frame_references = frame_references
+        self.frames = [None]*capacity
+
+        # head is only written by producer, tail only by consumer
+        self.head = 0
+        self.tail = 0
+
+        self.num_pushed = 0
+        self.num_overflows = 0
+        self.num_truncated_hands = 0
+        self.max_fill = 0
+
+    def __len__(self):
+        return self.head - self.tail
+
+    def push(self, frame, capture_time, swipes=()):
+        """ Copy hand state of frame into next free slot (producer side)
+        Args:
+            frame (Leap.Frame or IHDFrameState): Current frame
+            capture_time (float): Host time (s) when the frame was received
+            swipes (list): List of (dx, is_left_hand) of swipe gestures in the frame
+        Returns:
+            success (bool): False if buffer is full and snapshot was dropped
+        """
+        fill = self.head - self.tail
+        if fill >= self.capacity:
+            self.num_overflows += 1
+            return False
+
+        slot = self.head % self.capacity
+        self.capture_times[slot] = capture_time
+        if self.frame_references:
+            self.frames[slot] = frame
+            self.publish(fill)
+            return True
+        self.frame_ids[slot] = frame.id
+        self.timestamps[slot] = frame.timestamp
+
+        num_hands = extract_hand_array(frame, self.hands[slot])
+        if num_hands > self.max_hands:
+            self.num_truncated_hands += num_hands - self.max_hands
+            num_hands = self.max_hands
+        self.num_hands[slot] = num_hands
+        if self.fingers:
+            self.num_fingers[slot] = min(extract_finger_array(frame, self.finger_rows[slot]), self.max_fingers)
+
+        num_swipes = min(len(swipes), self.max_swipes)
+        for swipe_idx in range(num_swipes):
+            self.swipes[slot, swipe_idx] = swipes[swipe_idx]
+        self.num_swipes[slot] = num_swipes
+
+        self.publish(fill)
+        return True
+
+    def publish(self, fill):
+        """ Publish slot to consumer """
+        self.head += 1
+        self.num_pushed += 1
+        self.max_fill = max(self.max_fill, fill + 1)
+
+    def pop(self):
+        """ Take oldest snapshot (consumer side)
+        Returns:
+            frame (IHDFrameState): Snapshot or None if buffer is empty
+            capture_time (float): Host time (s) when the frame was received
+        """
+        if self.tail == self.head:
+            return None, None
+
+        slot = self.tail % self.capacity
+        capture_time = self.capture_times[slot]
+        if self.frame_references:
+            frame = self.frames[slot]
+            self.frames[slot] = None
+            self.tail += 1
+            return frame, capture_time
+
+        swipes = [(swipe[0], bool(swipe[1])) for swipe in self.swipes[slot, :self.num_swipes[slot]]]
+        frame = IHDFrameState(int(self.frame_ids[slot]), int(self.timestamps[slot]),
+                              swipes=swipes,
+                              hand_array=self.hands[slot, :self.num_hands[slot]].copy(),
+                              finger_array=self.finger_rows[slot, :self.num_fingers[slot]].copy()
+                              if self.fingers else None)
+
+        # release slot to producer
+        self.tail += 1
+        return frame, capture_time
+
+
+class IHDFrameWorker:
+    """ Worker thread which processes frame snapshots from ring buffer """
+
+    def __init__(self, process_frame, capacity=256, max_hands=4, fingers=False, frame_references=False):
+        """ Initialize worker
+        Args:
+            process_frame (function): Called with (frame, capture_time) for every snapshot
+            capacity (int): Ring buffer capacity (frames)
+            max_hands (int): Maximum number of hands per snapshot
+            fingers (bool): Snapshot fingertips (finger tracking)
+            frame_references (bool): Hand over the frames themselves, process_frame reads hands and swipes
+        """
+        self.process_frame = process_frame
+        self.frame_references = frame_references
+        self.buffer = IHDFrameRingBuffer(capacity=capacity, max_hands=max_hands, fingers=fingers,
+                                         frame_references=frame_references)
+        self.wake_up = threading.Event()
+        self.running = False
+        self.thread = None
+
+        self.num_processed = 0
+        self.lag_sec_sum = 0.
+        self.lag_sec_max = 0.
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name='IHDFrameWorker')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """ Process remaining snapshots and stop worker thread """
+        self.running = False
+        self.wake_up.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def submit(self, frame, capture_time, swipes=()):
+        """ Hand over frame snapshot (called from Leap callback thread), swipes are ignored with frame references """
+        success = self.buffer.push(frame, capture_time, swipes)
+        self.wake_up.set()
+        return success
+
+    def run(self):
+        while True:
+            frame, capture_time = self.buffer.pop()
+            if frame is None:
+                if not self.running:
+                    break
+                self.wake_up.clear()
+                # check again to not miss a snapshot pushed before the event was cleared
+                if len(self.buffer) == 0:
+                    self.wake_up.wait(.1)
+                continue
+
+            lag = host_time() - capture_time
+            self.lag_sec_sum += lag
+            self.lag_sec_max = max(self.lag_sec_max, lag)
+            self.num_processed += 1
+
+            try:
+                self.process_frame(frame, capture_time)
+            except Exception:
+                # keep worker alive, a failing frame must not stop the instrument
+                traceback.print_exc()
+
+    def report(self):
+        """ Summary of handoff counters (overflows, lag between frame arrival and processing) """
+        mean_lag_ms = 1000.*self.lag_sec_sum / self.num_processed if self.num_processed > 0 else 0
+        return '%d frames processed, %d overflows, %d truncated hands, max queue fill %d / %d, ' \
+               'lag mean %.3f ms, max %.3f ms' % (self.num_processed,
+                                                  self.buffer.num_overflows,
+                                                  self.buffer.num_truncated_hands,
+                                                  self.buffer.max_fill,
+                                                  self.buffer.capacity,
+                                                  mean_lag_ms,
+                                                  1000.*self.lag_sec_max)
@@ -0,0 +1,172 @@
+""" Zero-copy access to Leap IR images and asynchronous capture of images to a compressed chunked file
+
+Image.data / Image.distortion in Leap.py allocate a new byte_array / float_array and copy the whole buffer on every
+access. image_data_array() and image_distortion_array() wrap data_pointer / distortion_pointer as NumPy arrays
+instead. The views point into memory owned by the Leap image, they are only valid as long as the image is referenced.
+
+IHDImageCaptureWriter copies images into a preallocated pool of buffers (one memcpy in the Leap callback) and
+compresses and writes them in a background thread.
+
+File layout: sequence of chunks, each with a header (CHUNK_HEADER_FORMAT) followed by the zlib compressed data:
+    chunk type (image / distortion map), frame id, frame timestamp (us), camera id (0: left, 1: right),
+    height, width, bytes per pixel (4 for float distortion maps), compressed length
+"""
+
+import ctypes
+import struct
+import threading
+import zlib
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import numpy as np
+
+CHUNK_IMAGE = 0
+CHUNK_DISTORTION = 1
+CHUNK_HEADER_FORMAT = '<BqqiiiiI'
+CHUNK_HEADER_SIZE = struct.calcsize(CHUNK_HEADER_FORMAT)
+
+
+def image_data_array(image):
+    """ NumPy view (height x width x bytes per pixel, uint8) on the IR image buffer without copying """
+    num_bytes_per_pixel = image.bytes_per_pixel
+    height, width = image.height, image.width
+    buffer_ = (ctypes.c_ubyte * (height*width*num_bytes_per_pixel)).from_address(int(image.data_pointer))
+    return np.ctypeslib.as_array(buffer_).reshape((height, width, num_bytes_per_pixel))
+
+
+def image_distortion_array(image):
+    """ NumPy view (distortion_height x distortion_width, float32) on the distortion map without copying,
+        each row contains alternating x / y calibration values
+    """
+    height, width = image.distortion_height, image.distortion_width
+    buffer_ = (ctypes.c_float * (height*width)).from_address(int(image.distortion_pointer))
+    return np.ctypeslib.as_array(buffer_).reshape((height, width))
+
+
+class IHDImageCaptureWriter:
+    """ Writes IR images to compressed chunked file in a background thread """
+
+    def __init__(self, fn, num_buffers=32, compression_level=1):
+        """ Initialize writer
+        Args:
+            fn (string): File name
+            num_buffers (int): Number of preallocated image buffers, images are dropped if all are pending
+            compression_level (int): zlib compression level (1: fastest ... 9: smallest)
+        """
+        self.fn = fn
+        self.num_buffers = num_buffers
+        self.compression_level = compression_level
+        self.buffers = None
+        self.free_buffers = queue.Queue()
+        self.pending = queue.Queue()
+        self.cameras_with_distortion = set()
+
+        self.num_images = 0
+        self.num_dropped = 0
+        self.num_reallocations = 0
+        self.num_bytes_written = 0
+
+        self.f = open(fn, 'wb')
+        self.thread = threading.Thread(target=self.run, name='IHDImageCaptureWriter')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def allocate_buffers(self, shape):
+        self.buffers = [np.zeros(shape, dtype=np.uint8) for _ in range(self.num_buffers)]
+        for buffer_idx in range(self.num_buffers):
+            self.free_buffers.put(buffer_idx)
+
+    def submit(self, image, frame_id, timestamp):
+        """ Copy image for writing (called from Leap callback thread)
+        Args:
+            image (Leap.Image): IR image
+            frame_id (int): ID of frame the image belongs to
+            timestamp (int): Frame timestamp (us), to align images with hand tracking logs
+        Returns:
+            success (bool): False if image was dropped since all buffers are pending
+        """
+        data = image_data_array(image)
+        if self.buffers is None:
+            self.allocate_buffers(data.shape)
+
+        camera_id = image.id
+        if camera_id not in self.cameras_with_distortion:
+            # distortion map is written once per camera
+            self.cameras_with_distortion.add(camera_id)
+            self.pending.put((CHUNK_DISTORTION, frame_id, timestamp, camera_id, image_distortion_array(image).copy()))
+
+        try:
+            buffer_idx = self.free_buffers.get_nowait()
+        except queue.Empty:
+            self.num_dropped += 1
+            return False
+        if self.buffers[buffer_idx].shape != data.shape:
+            # image size changed (e.g. other device mode), the free buffer is replaced, pending ones are kept
+            self.buffers[buffer_idx] = np.zeros(data.shape, dtype=np.uint8)
+            self.num_reallocations += 1
+        np.copyto(self.buffers[buffer_idx], data)
+        self.pending.put((CHUNK_IMAGE, frame_id, timestamp, camera_id, buffer_idx))
+        self.num_images += 1
+        return True
+
+    def write_chunk(self, chunk_type, frame_id, timestamp, camera_id, data):
+        compressed = zlib.compress(data.tobytes(), self.compression_level)
+        num_bytes_per_pixel = data.shape[2] if data.ndim == 3 else data.itemsize
+        self.f.write(struct.pack(CHUNK_HEADER_FORMAT, chunk_type, frame_id, timestamp, camera_id,
+                                 data.shape[0], data.shape[1], num_bytes_per_pixel, len(compressed)))
+        self.f.write(compressed)
+        self.num_bytes_written += CHUNK_HEADER_SIZE + len(compressed)
+
+    def run(self):
+        while True:
+            item = self.pending.get()
+            if item is None:
+                break
+            chunk_type, frame_id, timestamp, camera_id, data = item
+            if chunk_type == CHUNK_IMAGE:
+                buffer_idx = data
+                self.write_chunk(chunk_type, frame_id, timestamp, camera_id, self.buffers[buffer_idx])
+                self.free_buffers.put(buffer_idx)
+            else:
+                self.write_chunk(chunk_type, frame_id, timestamp, camera_id, data)
+
+    def close(self):
+        """ Write pending images and close file """
+        if self.thread is None:
+            return
+        self.pending.put(None)
+        self.thread.join()
+        self.thread = None
+        self.f.close()
+
+    def report(self):
+        return '%d images captured, %d dropped, %d buffers reallocated after image size changes, %.1f MB written' % \
+            (self.num_images, self.num_dropped, self.num_reallocations, self.num_bytes_written / 1e6)
+
+
+def read_image_capture(fn):
+    """ Generator over chunks of image capture file
+    Returns:
+        chunk_type (int): CHUNK_IMAGE or CHUNK_DISTORTION
+        frame_id (int): Frame ID
+        timestamp (int): Frame timestamp (us)
+        camera_id (int): Camera ID
+        data (np.ndarray): Image (height x width x bytes per pixel, uint8) or distortion map (float32)
+    """
+    with open(fn, 'rb') as f:
+        while True:
+            header = f.read(CHUNK_HEADER_SIZE)
+            if len(header) < CHUNK_HEADER_SIZE:
+                break
+            chunk_type, frame_id, timestamp, camera_id, height, width, num_bytes_per_pixel, length = \
+                struct.unpack(CHUNK_HEADER_FORMAT, header)
+            data = zlib.decompress(f.read(length))
+            if chunk_type == CHUNK_IMAGE:
+                data = np.frombuffer(data, dtype=np.uint8).reshape((height, width, num_bytes_per_pixel))
+            else:
+                data = np.frombuffer(data, dtype=np.float32).reshape((height, width))
+            yield chunk_type, frame_id, timestamp, camera_id, data
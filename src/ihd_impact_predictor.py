@@ -0,0 +1,394 @@
+""" Predictive hand stroke detection: forecast of the impact time to compensate sensor and output latency
+
+The stroke detector of IHDStrokeStateTable fires once the palm has dropped delta_height, the note then sounds after
+the sensor and MIDI / synthesizer latency. IHDImpactPredictor tracks the palm height of every slot with a
+constant-acceleration Kalman filter (state: height, vertical velocity, vertical acceleration, measurements: palm
+height and SDK palm velocity) and forecasts the time at which the hand reaches the impact height, i.e. the height of
+the top of the current downward motion minus the stroke depth learned from previous strokes of the hand.
+
+Within lookahead_sec of the forecast impact, the note is scheduled for the impact time minus latency_sec if the
+prediction is confident (converged filter, downward speed, consistent measurements). The scheduled note is cancelled
+if the hand stops before it was sent. Reactive strokes of a downward motion with a scheduled note are not played
+again, reactive strokes without prediction are played as before (fallback).
+
+Usage (evaluation against replayed recordings or simulated hands):
+    python ihd_impact_predictor.py --capture session.ihdlog
+    python ihd_impact_predictor.py --hands 2 --duration 60
+"""
+
+import sys
+import argparse
+
+import numpy as np
+
+from ihd_frame import HAND_PALM_X, HAND_PALM_Y, HAND_PALM_Z, HAND_VELOCITY_X, HAND_VELOCITY_Y, HAND_VELOCITY_Z, \
+    HAND_TIMESTAMP
+
+NO_SLOTS = np.zeros(0, dtype=int)
+
+
+class IHDImpactPredictor:
+    """ Per-slot Kalman filters and scheduled notes of forecast hand stroke impacts """
+
+    def __init__(self,
+                 capacity=16,
+                 latency_sec=.03,
+                 lookahead_sec=.06,
+                 jerk_noise=1e9,
+                 height_noise_mm=1.,
+                 velocity_noise=50.,
+                 min_speed=300.,
+                 cancel_speed=100.,
+                 min_drop_mm=5.,
+                 min_frames=3,
+                 max_height_std_mm=2.,
+                 max_innovation=3.,
+                 default_depth_mm=50.,
+                 depth_smoothing=.3,
+                 use_palm_velocity=True,
+                 record_motions=False):
+        """ Initialize predictor
+        Args:
+            capacity (int): Number of slots (see IHDStrokeStateTable)
+            latency_sec (float): Latency to be compensated (sensor latency plus MIDI / synthesizer latency)
+            lookahead_sec (float): Notes are scheduled if the forecast impact is at most this far ahead
+            jerk_noise (float): Spectral density of the white jerk process noise (mm^2/s^5)
+            height_noise_mm (float): Standard deviation of the palm height measurement
+            velocity_noise (float): Standard deviation of the palm velocity measurement (mm/s)
+            min_speed (float): Minimum downward speed (mm/s) for a confident prediction
+            cancel_speed (float): Scheduled notes are cancelled if the downward speed drops below (mm/s)
+            min_drop_mm (float): Minimum drop from the top of the downward motion for a confident prediction
+            min_frames (int): Minimum number of frames of the downward motion for a confident prediction
+            max_height_std_mm (float): Maximum standard deviation of the filtered height for a confident prediction
+            max_innovation (float): Maximum normalized height innovation (in standard deviations)
+            default_depth_mm (float): Stroke depth (top of the downward motion to impact) before the first stroke
+            depth_smoothing (float): Weight of a new stroke depth in the exponentially smoothed depth per hand
+            use_palm_velocity (bool): Use SDK palm velocity as second measurement
+            record_motions (bool): Record all downward motions for evaluation (see motions)
+        """
+        self.capacity = capacity
+        self.latency_us = latency_sec*1e6
+        self.lookahead_sec = lookahead_sec
+        self.jerk_noise = jerk_noise
+        self.height_variance = height_noise_mm**2
+        self.velocity_variance = velocity_noise**2
+        self.min_speed = min_speed
+        self.cancel_speed = cancel_speed
+        self.min_drop_mm = min_drop_mm
+        self.min_frames = min_frames
+        self.max_height_variance = max_height_std_mm**2
+        self.max_innovation = max_innovation
+        self.default_depth_mm = default_depth_mm
+        self.depth_smoothing = depth_smoothing
+        self.use_palm_velocity = use_palm_velocity
+
+        # filter state (height, vertical velocity, vertical acceleration) and covariance per slot
+        self.x = np.zeros((capacity, 3))
+        self.P = np.zeros((capacity, 3, 3))
+        self.prev_timestamp = np.zeros(capacity)
+
+        # current downward motion per slot
+        self.was_downwards = np.zeros(capacity, dtype=bool)
+        self.top = np.zeros(capacity)
+        self.bottom = np.zeros(capacity)
+        self.bottom_timestamp = np.zeros(capacity)
+        self.num_downward_frames = np.zeros(capacity, dtype=np.int64)
+        self.depth = np.full(capacity, default_depth_mm)
+        # scheduled note: send time (device time, us), sent / cancelled, reactive stroke of the motion
+        self.is_scheduled = np.zeros(capacity, dtype=bool)
+        self.is_sent = np.zeros(capacity, dtype=bool)
+        self.is_cancelled = np.zeros(capacity, dtype=bool)
+        self.send_timestamp = np.full(capacity, np.inf)
+        self.sent_timestamp = np.full(capacity, np.nan)
+        self.stroke_timestamp = np.full(capacity, np.nan)
+
+        self.num_scheduled = 0
+        self.num_sent = 0
+        self.num_cancelled = 0
+
+        self.record_motions = record_motions
+        # (top, bottom, impact timestamp, reactive stroke timestamp, sent timestamp, cancelled) per finished motion
+        self.motions = []
+
+    def init_filters(self, slots, hands):
+        """ Start filters of hands which are tracked for the first time """
+        self.x[slots, 0] = hands[:, HAND_PALM_Y]
+        self.x[slots, 1] = hands[:, HAND_VELOCITY_Y] if self.use_palm_velocity else 0.
+        self.x[slots, 2] = 0.
+        self.P[slots] = np.diag((self.height_variance,
+                                 self.velocity_variance if self.use_palm_velocity else 1e6,
+                                 1e8))
+        self.prev_timestamp[slots] = hands[:, HAND_TIMESTAMP]
+        self.was_downwards[slots] = False
+        self.clear_motion(slots)
+
+    def clear_motion(self, slots):
+        self.num_downward_frames[slots] = 0
+        self.is_scheduled[slots] = False
+        self.is_sent[slots] = False
+        self.is_cancelled[slots] = False
+        self.send_timestamp[slots] = np.inf
+        self.sent_timestamp[slots] = np.nan
+        self.stroke_timestamp[slots] = np.nan
+
+    def filter(self, slots, hands):
+        """ Kalman filter prediction and measurement update
+        Returns:
+            innovation (np.ndarray): Normalized height innovation
+        """
+        timestamps = hands[:, HAND_TIMESTAMP]
+        dt = np.maximum((timestamps - self.prev_timestamp[slots])*1e-6, 0.)
+        self.prev_timestamp[slots] = timestamps
+        x = self.x[slots]
+        P = self.P[slots]
+
+        # prediction with constant acceleration and white jerk noise
+        num_slots = len(slots)
+        F = np.zeros((num_slots, 3, 3))
+        F[:, 0, 0] = F[:, 1, 1] = F[:, 2, 2] = 1.
+        F[:, 0, 1] = F[:, 1, 2] = dt
+        F[:, 0, 2] = .5*dt**2
+        x = np.einsum('nij,nj->ni', F, x)
+        P = np.einsum('nij,njk,nlk->nil', F, P, F)
+        dt2 = dt*dt
+        dt3 = dt2*dt
+        Q = np.empty((num_slots, 3, 3))
+        Q[:, 0, 0] = dt3*dt2 / 20.
+        Q[:, 0, 1] = Q[:, 1, 0] = dt2*dt2 / 8.
+        Q[:, 0, 2] = Q[:, 2, 0] = dt3 / 6.
+        Q[:, 1, 1] = dt3 / 3.
+        Q[:, 1, 2] = Q[:, 2, 1] = dt2 / 2.
+        Q[:, 2, 2] = dt
+        P += self.jerk_noise*Q
+
+        # sequential scalar updates with height and velocity measurement
+        innovation = hands[:, HAND_PALM_Y] - x[:, 0]
+        S = P[:, 0, 0] + self.height_variance
+        K = P[:, :, 0] / S[:, None]
+        x += K*innovation[:, None]
+        P -= K[:, :, None]*P[:, 0, None, :]
+        normalized_innovation = np.abs(innovation) / np.sqrt(S)
+
+        if self.use_palm_velocity:
+            velocity_innovation = hands[:, HAND_VELOCITY_Y] - x[:, 1]
+            S = P[:, 1, 1] + self.velocity_variance
+            K = P[:, :, 1] / S[:, None]
+            x += K*velocity_innovation[:, None]
+            P -= K[:, :, None]*P[:, 1, None, :]
+
+        self.x[slots] = x
+        self.P[slots] = P
+        return normalized_innovation
+
+    def time_to_impact(self, slots):
+        """ Time (s) until the filtered trajectory (constant acceleration) reaches the impact height,
+            inf if it does not
+        """
+        height, velocity, acceleration = self.x[slots].T
+        # 0.5 a t^2 + v t + (h - h_impact) = 0
+        c = height - (self.top[slots] - self.depth[slots])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            discriminant = velocity*velocity - 2*acceleration*c
+            sqrt_discriminant = np.sqrt(np.maximum(discriminant, 0.))
+            # smaller positive root, numerically stable form
+            t = np.where(np.abs(acceleration) > 1e-6,
+                         2*c / (-velocity + sqrt_discriminant),
+                         -c / velocity)
+        t = np.where((discriminant >= 0) & (t >= 0), t, np.inf)
+        # at or below the impact height already
+        t[c <= 0] = 0.
+        return t
+
+    def update(self, slots, hands, downwards, is_new=None):
+        """ Update filters and scheduled notes of the hands of the current frame
+        Args:
+            slots (np.ndarray): Slots of the hands
+            hands (np.ndarray): Hand array rows of the hands
+            downwards (np.ndarray): True if hand is in a downward motion (see IHDStrokeStateTable)
+            is_new (np.ndarray): True for hands which are tracked for the first time, default: none
+        Returns:
+            scheduled_rows (np.ndarray): Rows of hands whose note was scheduled in this frame
+            impact_positions (np.ndarray): Forecast palm positions at impact of these hands
+            cancelled_slots (np.ndarray): Slots whose scheduled (not yet sent) note was cancelled in this frame
+        """
+        if is_new is not None and is_new.any():
+            self.init_filters(slots[is_new], hands[is_new])
+        normalized_innovation = self.filter(slots, hands)
+        heights = hands[:, HAND_PALM_Y]
+        timestamps = hands[:, HAND_TIMESTAMP]
+
+        # finished downward motions: learn stroke depth, start new motions at the current height
+        was_downwards = self.was_downwards[slots]
+        finished = was_downwards & ~downwards
+        if finished.any():
+            self.finish_motions(slots[finished])
+        self.was_downwards[slots] = downwards
+        started = downwards & ~was_downwards
+        self.top[slots[~downwards]] = heights[~downwards]
+        self.bottom[slots[started]] = np.inf
+
+        down_slots = slots[downwards]
+        down_heights = heights[downwards]
+        self.num_downward_frames[down_slots] += 1
+        is_bottom = down_heights < self.bottom[down_slots]
+        self.bottom[down_slots[is_bottom]] = down_heights[is_bottom]
+        self.bottom_timestamp[down_slots[is_bottom]] = timestamps[downwards][is_bottom]
+
+        # hands which stopped before the scheduled note was sent: the note is cancelled, or sent immediately if the
+        # stroke was confirmed by the reactive detector (impact earlier than forecast)
+        velocities = self.x[slots, 1]
+        pending = self.is_scheduled[slots] & ~self.is_sent[slots] & ~self.is_cancelled[slots]
+        stopped = pending & (velocities > -self.cancel_speed)
+        is_confirmed = ~np.isnan(self.stroke_timestamp[slots])
+        self.send_timestamp[slots[stopped & is_confirmed]] = timestamps[stopped & is_confirmed]
+        cancelled_slots = slots[stopped & ~is_confirmed]
+        if len(cancelled_slots) > 0:
+            self.is_cancelled[cancelled_slots] = True
+            self.send_timestamp[cancelled_slots] = np.inf
+            self.num_cancelled += len(cancelled_slots)
+
+        # schedule notes for confident predictions within the lookahead (if the reactive detector did not fire yet)
+        candidates = downwards & ~self.is_scheduled[slots] & ~is_confirmed & \
+            (self.num_downward_frames[slots] >= self.min_frames) & \
+            (velocities < -self.min_speed) & \
+            (self.top[slots] - heights >= self.min_drop_mm) & \
+            (self.P[slots, 0, 0] < self.max_height_variance) & \
+            (normalized_innovation < self.max_innovation)
+        if not candidates.any():
+            return NO_SLOTS, np.zeros((0, 3)), cancelled_slots
+        candidate_rows = np.flatnonzero(candidates)
+        candidate_slots = slots[candidate_rows]
+        t = self.time_to_impact(candidate_slots)
+        in_lookahead = t <= self.lookahead_sec
+        scheduled_rows = candidate_rows[in_lookahead]
+        scheduled_slots = candidate_slots[in_lookahead]
+        t = t[in_lookahead]
+
+        self.is_scheduled[scheduled_slots] = True
+        self.send_timestamp[scheduled_slots] = timestamps[scheduled_rows] + t*1e6 - self.latency_us
+        self.num_scheduled += len(scheduled_slots)
+
+        # horizontal position at impact from the current palm velocity
+        impact_positions = hands[scheduled_rows, HAND_PALM_X:HAND_PALM_Z + 1] + \
+            t[:, None]*hands[scheduled_rows, HAND_VELOCITY_X:HAND_VELOCITY_Z + 1]
+        impact_positions[:, 1] = self.top[scheduled_slots] - self.depth[scheduled_slots]
+        return scheduled_rows, impact_positions, cancelled_slots
+
+    def pop_due(self, timestamp):
+        """ Slots whose scheduled note is due
+        Args:
+            timestamp (float): Device timestamp (microseconds) of the current frame
+        Returns:
+            slots (np.ndarray): Slots whose note has to be sent now
+        """
+        due_slots = np.flatnonzero(self.send_timestamp <= timestamp)
+        if len(due_slots) > 0:
+            self.send_timestamp[due_slots] = np.inf
+            self.is_sent[due_slots] = True
+            self.sent_timestamp[due_slots] = timestamp
+            self.num_sent += len(due_slots)
+        return due_slots
+
+    def on_strokes(self, slots, timestamps):
+        """ Reactive strokes of slots (see IHDStrokeStateTable)
+        Returns:
+            is_predicted (np.ndarray): True if a note was scheduled for the downward motion (and not cancelled)
+        """
+        self.stroke_timestamp[slots] = timestamps
+        return self.is_scheduled[slots] & ~self.is_cancelled[slots]
+
+    def finish_motions(self, slots):
+        """ Learn stroke depth from finished downward motions with a stroke """
+        is_stroke = ~np.isnan(self.stroke_timestamp[slots])
+        stroke_slots = slots[is_stroke]
+        self.depth[stroke_slots] += self.depth_smoothing*(self.top[stroke_slots] - self.bottom[stroke_slots] -
+                                                          self.depth[stroke_slots])
+        if self.record_motions:
+            for slot in slots:
+                self.motions.append((self.top[slot], self.bottom[slot], self.bottom_timestamp[slot],
+                                     self.stroke_timestamp[slot], self.sent_timestamp[slot], self.is_cancelled[slot]))
+        self.clear_motion(slots)
+
+    def report(self):
+        return '%d impacts predicted, %d notes sent, %d cancelled' % (self.num_scheduled, self.num_sent,
+                                                                       self.num_cancelled)
+
+
+def evaluate(frames, latency_sec=.03, units='mm_per_frame', **kwargs):
+    """ Run stroke detection with impact prediction over frames and compare with reactive detection
+    Args:
+        frames (iterable): Frames (see ihd_replay.read_frames)
+        latency_sec (float): Latency to be compensated
+        units (string): Units of stroke detector
+        kwargs: Further arguments of IHDImpactPredictor
+    Returns:
+        results (dict): Metrics (times in ms)
+    """
+    from ihd_frame import IHDHandArrayExtractor
+    from ihd_stroke_table import IHDStrokeStateTable
+
+    predictor = IHDImpactPredictor(latency_sec=latency_sec, record_motions=True, **kwargs)
+    table = IHDStrokeStateTable(capacity=predictor.capacity, units=units, impact_predictor=predictor)
+    extractor = IHDHandArrayExtractor()
+    for frame_id, frame in enumerate(frames):
+        table.detect_strokes(extractor.extract(frame), frame_id)
+        predictor.pop_due(frame.timestamp)
+
+    motions = np.array(predictor.motions, dtype=float).reshape((-1, 6))
+    impact, stroke, sent, cancelled = motions[:, 2], motions[:, 3], motions[:, 4], motions[:, 5] > 0
+    is_stroke = ~np.isnan(stroke)
+    is_sent = ~np.isnan(sent)
+    both = is_stroke & is_sent
+    latency_us = latency_sec*1e6
+
+    def percentiles(values_us):
+        if len(values_us) == 0:
+            return [np.nan]*3
+        return list(np.percentile(values_us*1e-3, (5, 50, 95)))
+
+    return {'reactive_strokes': int(np.sum(is_stroke)),
+            'predicted_notes': int(np.sum(is_sent)),
+            'cancelled': int(np.sum(cancelled)),
+            'fallback_strokes': int(np.sum(is_stroke & ~is_sent)),
+            'false_positives': int(np.sum(is_sent & ~is_stroke)),
+            'false_positive_rate': np.sum(is_sent & ~is_stroke) / max(1., float(np.sum(is_sent))),
+            # time the note is sent earlier than with reactive detection
+            'ms_won': percentiles(stroke[both] - sent[both]),
+            # sound onset (send time + latency) relative to the impact (lowest point of the downward motion)
+            'reactive_onset_error': percentiles(stroke[is_stroke] + latency_us - impact[is_stroke]),
+            'predicted_onset_error': percentiles(sent[is_sent] + latency_us - impact[is_sent])}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Evaluate impact prediction against reactive stroke detection')
+    parser.add_argument('--capture', help='Capture file (see ihd_replay.read_frames), default: simulated hands')
+    parser.add_argument('--hands', type=int, default=1, help='Number of simulated hands')
+    parser.add_argument('--fps', type=float, default=120.)
+    parser.add_argument('--duration', type=float, default=60., help='Simulated session duration in seconds')
+    parser.add_argument('--stroke-rate', type=float, default=4., help='Strokes per second per simulated hand')
+    parser.add_argument('--feints', type=float, default=.1,
+                        help='Probability of simulated strokes which stop before the impact')
+    parser.add_argument('--latency', type=float, default=.03, help='Latency to be compensated in seconds')
+    parser.add_argument('--units', default='mm_per_frame', choices=['mm_per_frame', 'mm_per_sec'])
+    args = parser.parse_args()
+
+    if args.capture:
+        from ihd_replay import read_frames
+        frames = read_frames(args.capture)
+    else:
+        from ihd_simulator import IHDHandSimulator
+        frames = IHDHandSimulator(num_hands=args.hands, fps=args.fps, stroke_rate_hz=args.stroke_rate,
+                                  feint_probability=args.feints, seed=1).frames(args.duration)
+
+    results = evaluate(frames, latency_sec=args.latency, units=args.units)
+    print('%d reactive strokes, %d predicted notes, %d cancelled, %d fallback strokes' %
+          (results['reactive_strokes'], results['predicted_notes'], results['cancelled'],
+           results['fallback_strokes']))
+    print('false positives: %d (%.1f %% of predicted notes)' % (results['false_positives'],
+                                                                100*results['false_positive_rate']))
+    for name in ('ms_won', 'reactive_onset_error', 'predicted_onset_error'):
+        print('%-24s p5 %7.1f ms  median %7.1f ms  p95 %7.1f ms' % ((name,) + tuple(results[name])))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,136 @@
+""" Streaming window of the downward movement of tracked hands with constant cost per frame
+
+The stroke velocity is the mean downward movement (mm per frame or mm/s) over the last window_size frames of the
+current downward motion. Both stroke detectors keep these samples in bounded ring buffers with a running sum, so
+neither memory nor the cost of the mean grow with the length of a motion:
+    - IHDStreamingKinematics: one ring buffer per slot of IHDStrokeStateTable (ihd_stroke_table.py), all slots of a
+      frame are updated in one vectorized step
+    - IHDMovementWindow: ring buffer of a single hand of IHDHandTrackingMemory (invisible_hand_drum.py)
+
+Peak, acceleration and jerk of the downward movement are computed on demand from the same ring buffers (maximum, first
+and second difference of the latest samples), so they add no cost per frame. They are changes per frame of the
+samples, i.e. of mm per frame or of mm/s (divide by the frame interval for changes per second).
+"""
+
+import numpy as np
+
+# kinematics columns
+KIN_WRITE_IDX, KIN_NUM_SAMPLES, KIN_WINDOW_SUM = range(3)
+NUM_KIN_COLUMNS = 3
+
+
+class IHDStreamingKinematics:
+    """ Per-slot ring buffers with running sum of hand movement """
+
+    def __init__(self, capacity=16, window_size=32):
+        """ Initialize kinematics
+        Args:
+            capacity (int): Number of slots (tracked hands)
+            window_size (int): Number of most recent samples of the current downward motion used for the mean
+                               (32 covers a whole stroke up to about 200 fps)
+        """
+        self.capacity = capacity
+        self.window_size = window_size
+
+        self.samples = np.zeros((capacity, window_size))
+        self.state = np.zeros((NUM_KIN_COLUMNS, capacity))
+
+    def update(self, slots, samples, active):
+        """ Update windows of all hands in the current frame
+        Args:
+            slots (np.ndarray): Slots of the hands
+            samples (np.ndarray): Downward movement per hand, appended to the window if active
+            active (np.ndarray): True if hand is moving downwards, otherwise the window is reset
+        """
+        write_idx, num_samples, window_sum = self.state[:, slots]
+
+        # ring buffer with running sum, the sample at the write index drops out of a full window
+        # (the window is reset with every upward movement, rounding errors of the running sum do not accumulate)
+        write_idx = write_idx.astype(np.int64)
+        dropped = self.samples[slots, write_idx]
+        self.samples[slots, write_idx] = samples
+        window_sum = np.where(active, window_sum + samples - np.where(num_samples == self.window_size, dropped, 0.),
+                              0.)
+        num_samples = np.where(active, np.minimum(num_samples + 1, self.window_size), 0.)
+        write_idx = np.where(active, (write_idx + 1) % self.window_size, 0)
+
+        self.state[:, slots] = (write_idx, num_samples, window_sum)
+
+    def reset_window(self, slots):
+        """ Start new window for slots """
+        self.state[:, slots] = 0
+
+    def mean(self, slots):
+        """ Mean downward movement over the window of the current downward motion """
+        return self.state[KIN_WINDOW_SUM, slots] / np.maximum(self.state[KIN_NUM_SAMPLES, slots], 1)
+
+    def peak(self, slots):
+        """ Maximum downward movement over the window of the current downward motion (0 for empty windows) """
+        num_samples = self.state[KIN_NUM_SAMPLES, slots]
+        # after a reset, the window is filled from index 0
+        is_valid = np.arange(self.window_size)[None, :] < num_samples[:, None]
+        return np.where(num_samples > 0, np.max(np.where(is_valid, self.samples[slots], -np.inf), axis=1), 0.)
+
+    def latest(self, slots, age):
+        """ Samples appended age frames before the latest one (age 0: latest sample) """
+        return self.samples[slots, (self.state[KIN_WRITE_IDX, slots].astype(np.int64) - 1 - age) % self.window_size]
+
+    def acceleration(self, slots):
+        """ Change of the downward movement in the latest frame (0 for less than 2 samples) """
+        return np.where(self.state[KIN_NUM_SAMPLES, slots] >= 2, self.latest(slots, 0) - self.latest(slots, 1), 0.)
+
+    def jerk(self, slots):
+        """ Change of the acceleration in the latest frame (0 for less than 3 samples) """
+        return np.where(self.state[KIN_NUM_SAMPLES, slots] >= 3,
+                        self.latest(slots, 0) - 2*self.latest(slots, 1) + self.latest(slots, 2), 0.)
+
+
+class IHDMovementWindow:
+    """ Ring buffer with running sum of the downward movement of a single hand """
+
+    def __init__(self, window_size=32):
+        self.window_size = window_size
+        self.samples = [0.]*window_size
+        self.write_idx = 0
+        self.num_samples = 0
+        self.window_sum = 0.
+
+    def __len__(self):
+        return self.num_samples
+
+    def append(self, sample):
+        """ Append sample, the oldest sample drops out of a full window """
+        if self.num_samples == self.window_size:
+            self.window_sum -= self.samples[self.write_idx]
+        else:
+            self.num_samples += 1
+        self.window_sum += sample
+        self.samples[self.write_idx] = sample
+        self.write_idx = (self.write_idx + 1) % self.window_size
+
+    def clear(self):
+        """ Start new window """
+        self.write_idx = 0
+        self.num_samples = 0
+        self.window_sum = 0.
+
+    def mean(self):
+        """ Mean downward movement over the window of the current downward motion """
+        return self.window_sum / max(self.num_samples, 1)
+
+    def peak(self):
+        """ Maximum downward movement over the window of the current downward motion (0 for an empty window) """
+        # after clear, the window is filled from index 0
+        return max(self.samples[:self.num_samples]) if self.num_samples > 0 else 0.
+
+    def latest(self, age):
+        """ Sample appended age frames before the latest one (age 0: latest sample) """
+        return self.samples[(self.write_idx - 1 - age) % self.window_size]
+
+    def acceleration(self):
+        """ Change of the downward movement in the latest frame (0 for less than 2 samples) """
+        return self.latest(0) - self.latest(1) if self.num_samples >= 2 else 0.
+
+    def jerk(self):
+        """ Change of the acceleration in the latest frame (0 for less than 3 samples) """
+        return self.latest(0) - 2*self.latest(1) + self.latest(2) if self.num_samples >= 3 else 0.
@@ -0,0 +1,100 @@
+""" Opt-in fast path for the Leap.py attributes and methods read on every frame
+
+Properties of the SWIG proxy classes in Leap.py already map directly to the getter functions of the LeapPython
+extension, the __getattr__ = lambda ...: _swig_getattr(...) dispatch is only used if the class was generated without
+property support. The remaining per-frame overhead is in pure Python wrappers:
+
+    - HandList / GestureList / FingerList / PointableList.__iter__ is a generator which calls the Python level
+      __len__ and __getitem__ wrappers for every element
+    - casting a gesture (SwipeGesture(gesture)) runs __init__, whose try / except around self.this.append() always
+      raises and then goes through __setattr__ -> _swig_setattr -> _swig_setattr_nondynamic
+
+install() replaces the list iterators by functions which call the extension directly and makes sure the hot
+attributes are direct property descriptors, the *_gesture() functions replace the gesture casts. uninstall() restores
+Leap.py. Python level special methods such as Vector.__getitem__ (position[1]) cannot be replaced by the extension
+functions, as these are not bound to the instance, use the x / y / z properties instead.
+
+The effect is measured by python ihd_benchmark.py leap_attributes --capture session.leap
+"""
+
+import Leap
+from Leap import LeapPython
+
+# (class, attribute, getter) which are read for every frame / hand / gesture
+HOT_ATTRIBUTES = [(Leap.Vector, 'x', LeapPython.Vector_x_get),
+                  (Leap.Vector, 'y', LeapPython.Vector_y_get),
+                  (Leap.Vector, 'z', LeapPython.Vector_z_get),
+                  (Leap.Hand, 'id', LeapPython.Hand_id_get),
+                  (Leap.Hand, 'is_left', LeapPython.Hand_is_left_get),
+                  (Leap.Hand, 'palm_position', LeapPython.Hand_palm_position_get),
+                  (Leap.Hand, 'palm_velocity', LeapPython.Hand_palm_velocity_get),
+                  (Leap.Hand, 'fingers', LeapPython.Hand_fingers_get),
+                  (Leap.Pointable, 'id', LeapPython.Pointable_id_get),
+                  (Leap.Pointable, 'tip_position', LeapPython.Pointable_tip_position_get),
+                  (Leap.Pointable, 'tip_velocity', LeapPython.Pointable_tip_velocity_get),
+                  (Leap.Gesture, 'type', LeapPython.Gesture_type_get),
+                  (Leap.SwipeGesture, 'start_position', LeapPython.SwipeGesture_start_position_get),
+                  (Leap.SwipeGesture, 'position', LeapPython.SwipeGesture_position_get),
+                  (Leap.SwipeGesture, 'pointable', LeapPython.SwipeGesture_pointable_get),
+                  (Leap.Frame, 'id', LeapPython.Frame_id_get),
+                  (Leap.Frame, 'timestamp', LeapPython.Frame_timestamp_get),
+                  (Leap.Frame, 'hands', LeapPython.Frame_hands_get)]
+
+# (list class, length function, item function)
+LIST_CLASSES = [(Leap.HandList, LeapPython.HandList___len__, LeapPython.HandList___getitem__),
+                (Leap.GestureList, LeapPython.GestureList___len__, LeapPython.GestureList___getitem__),
+                (Leap.FingerList, LeapPython.FingerList___len__, LeapPython.FingerList___getitem__),
+                (Leap.PointableList, LeapPython.PointableList___len__, LeapPython.PointableList___getitem__)]
+
+_originals = {}
+
+
+def _make_list_iter(length_function, item_function):
+    def list_iter(self):
+        return iter([item_function(self, index) for index in range(length_function(self))])
+    return list_iter
+
+
+def _make_cast(cls, new_function):
+    def cast(gesture):
+        """ Construct proxy object without running the generic SWIG __init__ / __setattr__ path """
+        obj = cls.__new__(cls)
+        obj.__dict__['this'] = new_function(gesture)
+        return obj
+    return cast
+
+# direct gesture casts, e.g. swipe = swipe_gesture(gesture) instead of Leap.SwipeGesture(gesture)
+swipe_gesture = _make_cast(Leap.SwipeGesture, LeapPython.new_SwipeGesture)
+circle_gesture = _make_cast(Leap.CircleGesture, LeapPython.new_CircleGesture)
+key_tap_gesture = _make_cast(Leap.KeyTapGesture, LeapPython.new_KeyTapGesture)
+screen_tap_gesture = _make_cast(Leap.ScreenTapGesture, LeapPython.new_ScreenTapGesture)
+
+
+def _replace(cls, name, value):
+    key = (cls, name)
+    if key not in _originals:
+        _originals[key] = cls.__dict__.get(name)
+    setattr(cls, name, value)
+
+
+def is_installed():
+    return len(_originals) > 0
+
+
+def install():
+    """ Install fast path into Leap.py classes (affects all existing and new proxy objects) """
+    for cls, name, getter in HOT_ATTRIBUTES:
+        if not isinstance(cls.__dict__.get(name), property):
+            _replace(cls, name, property(getter))
+    for cls, length_function, item_function in LIST_CLASSES:
+        _replace(cls, '__iter__', _make_list_iter(length_function, item_function))
+
+
+def uninstall():
+    """ Restore original Leap.py classes """
+    for (cls, name), value in _originals.items():
+        if value is None:
+            delattr(cls, name)
+        else:
+            setattr(cls, name, value)
+    _originals.clear()
@@ -0,0 +1,23 @@
+""" MIDI message encoding shared by all senders: status bytes and the mapping of play levels to velocities
+
+Messages are built per note as 3-element lists: in CPython, indexing tables of pre-encoded messages was only on par
+with building a new list per message, and slower behind a method call per note.
+
+Usage:
+    midi_out.send_message([NOTE_ON | channel, 60, level_to_velocity(level)])
+    midi_out.send_message([NOTE_OFF | channel, 60, 0])
+"""
+
+NOTE_OFF = 0x80
+NOTE_ON = 0x90
+CONTROL_CHANGE = 0xB0
+ALL_NOTES_OFF = 123
+
+# velocity 61 .. 122 for play level 0 .. 1
+MIN_VELOCITY = 61
+LEVEL_STEPS = 61
+
+
+def level_to_velocity(level):
+    """ MIDI velocity of play level (0 .. 1) """
+    return int(122.*(.5 + .5*level))
@@ -0,0 +1,206 @@
+""" Output thread which sends timestamped MIDI messages at their target time
+
+Messages are queued with their send time in a priority queue (heap ordered by time, FIFO for equal times) and sent by a
+dedicated thread, so the Leap callback / frame worker never waits for the MIDI backend. The thread sleeps until shortly
+before the next send time and spins for the last spin_sec, which gives sub-millisecond precision without a busy thread.
+Events can be queued ahead of time (e.g. metronome clicks and notes of the computer player at the exact beat time)
+and cancelled until they are sent (e.g. a note-off queued ahead whose pitch is played again meanwhile).
+
+Send times are frame times (see IHDClock), which are host times if the clock is synced to the host. For other
+timebases (replay of device time), time_offset maps frame time to host time.
+
+The lateness (send time - target time) of every message which was queued ahead of its target time is kept for
+statistics. Messages which are queued after their target time (e.g. notes of strokes at the frame time, which is
+the capture time of the frame) are sent immediately and counted separately.
+
+Usage:
+    scheduler = IHDMidiScheduler(midi_out)
+    scheduler.start()
+    scheduler.schedule([0x90, 60, 100], send_time)
+    scheduler.stop()
+"""
+
+import sys
+import heapq
+import threading
+import traceback
+from collections import deque
+
+import numpy as np
+
+from ihd_clock import host_time
+
+
+class IHDMidiScheduler:
+    """ Priority queue of timestamped MIDI messages and output thread """
+
+    def __init__(self, midi_out, spin_sec=.002, poll_sec=.001, max_statistics=10000):
+        """ Initialize scheduler
+        Args:
+            midi_out (rtmidi.MidiOut): Opened MIDI output (send_message)
+            spin_sec (float): Time before the send time from which the thread spins instead of sleeping
+            poll_sec (float): Maximum sleep time with Python 2, where waiting on a condition polls with sleeps of up
+                              to 50 ms and would delay messages which are queued meanwhile
+            max_statistics (int): Number of most recent messages in the lateness statistics
+        """
+        self.midi_out = midi_out
+        self.spin_sec = spin_sec
+        self.max_wait_sec = poll_sec if sys.version_info[0] < 3 else 1.
+        # host time - frame time
+        self.time_offset = 0.
+
+        # heap of (target host time, sequence number, queued ahead of target time, message)
+        self.queue = []
+        self.sequence = 0
+        self.condition = threading.Condition()
+        self.running = False
+        self.thread = None
+
+        self.latenesses = deque(maxlen=max_statistics)
+        self.num_queued_late = 0
+        self.num_sent = 0
+        self.num_errors = 0
+        self.max_queue_size = 0
+
+    def __len__(self):
+        return len(self.queue)
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name='IHDMidiScheduler')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """ Send all queued messages (without waiting for their send time) and stop output thread """
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def schedule(self, message, send_time):
+        """ Queue message (thread-safe)
+        Args:
+            message (list): MIDI message
+            send_time (float): Frame time (s) at which the message is sent
+        Returns:
+            sequence (int): Sequence number of the queued message (see cancel)
+        """
+        return self.push(send_time + self.time_offset, message)
+
+    def cancel(self, sequence):
+        """ Remove queued message (thread-safe)
+        Args:
+            sequence (int): Sequence number returned by schedule
+        Returns:
+            cancelled (bool): False if the message was sent already
+        """
+        with self.condition:
+            for idx, entry in enumerate(self.queue):
+                if entry[1] == sequence:
+                    self.queue[idx] = self.queue[-1]
+                    self.queue.pop()
+                    heapq.heapify(self.queue)
+                    return True
+        return False
+
+    def drop_pending(self, is_dropped):
+        """ Remove all queued messages for which is_dropped(message) is True (thread-safe)
+        Returns:
+            messages (list): Removed messages
+        """
+        with self.condition:
+            dropped = [entry[3] for entry in self.queue if is_dropped(entry[3])]
+            if dropped:
+                self.queue = [entry for entry in self.queue if not is_dropped(entry[3])]
+                heapq.heapify(self.queue)
+        return dropped
+
+    def schedule_all(self, messages, send_time):
+        """ Queue simultaneous messages (thread-safe), sent in the given order
+        Args:
+            messages (list): MIDI messages
+            send_time (float): Frame time (s) at which the messages are sent
+        """
+        target_time = send_time + self.time_offset
+        with self.condition:
+            is_ahead = target_time > host_time()
+            for message in messages:
+                heapq.heappush(self.queue, (target_time, self.sequence, is_ahead, message))
+                self.sequence += 1
+            if not is_ahead:
+                self.num_queued_late += len(messages)
+            self.max_queue_size = max(self.max_queue_size, len(self.queue))
+            self.condition.notify()
+
+    def send_message(self, message):
+        """ Queue message to be sent as soon as possible (interface of rtmidi.MidiOut) """
+        self.push(host_time(), message)
+
+    def push(self, target_time, message):
+        with self.condition:
+            is_ahead = target_time > host_time()
+            if not is_ahead:
+                self.num_queued_late += 1
+            heapq.heappush(self.queue, (target_time, self.sequence, is_ahead, message))
+            self.sequence += 1
+            self.max_queue_size = max(self.max_queue_size, len(self.queue))
+            self.condition.notify()
+            return self.sequence - 1
+
+    def next_message(self):
+        """ Wait for the next message which is due
+        Returns:
+            target_time (float): Target host time, None if the scheduler was stopped
+            is_ahead (bool): Message was queued ahead of its target time
+            message (list): MIDI message
+        """
+        while True:
+            with self.condition:
+                while True:
+                    if not self.queue:
+                        if not self.running:
+                            return None, False, None
+                        self.condition.wait(self.max_wait_sec)
+                        continue
+                    wait_sec = self.queue[0][0] - host_time() - self.spin_sec
+                    if wait_sec <= 0 or not self.running:
+                        break
+                    # an earlier message may be queued meanwhile
+                    self.condition.wait(min(wait_sec, self.max_wait_sec))
+                target_time = self.queue[0][0]
+            # spin outside of the lock, producers are not blocked
+            if self.running:
+                while host_time() < target_time:
+                    pass
+            with self.condition:
+                # unless the message was cancelled while spinning (a later message is not due yet)
+                if self.queue and (self.queue[0][0] <= target_time or not self.running):
+                    target_time, _, is_ahead, message = heapq.heappop(self.queue)
+                    return target_time, is_ahead, message
+
+    def run(self):
+        while True:
+            target_time, is_ahead, message = self.next_message()
+            if message is None:
+                break
+            if is_ahead:
+                self.latenesses.append(host_time() - target_time)
+            try:
+                self.midi_out.send_message(message)
+            except Exception:
+                # keep output thread alive, a failing message must not stop the instrument
+                self.num_errors += 1
+                traceback.print_exc()
+            self.num_sent += 1
+
+    def report(self):
+        """ Summary of lateness statistics (ms) of the most recent messages queued ahead """
+        latenesses_ms = 1e3*np.array(self.latenesses) if len(self.latenesses) > 0 else np.full(1, np.nan)
+        return '%d MIDI messages sent by output thread (%d queued ahead, lateness mean %.3f ms, median %.3f ms, ' \
+               'p99 %.3f ms, max %.3f ms, %d later than 1 ms; %d sent at once), max queue size %d' % \
+               (self.num_sent, len(self.latenesses), np.mean(latenesses_ms), np.median(latenesses_ms),
+                np.percentile(latenesses_ms, 99), np.max(latenesses_ms), np.sum(latenesses_ms > 1.),
+                self.num_queued_late, self.max_queue_size)
@@ -0,0 +1,252 @@
+""" Pad layouts loaded from layout files and compiled into a cached binary geometry index
+
+A layout file (JSON) defines the pads of the instrument in device coordinates (mm):
+
+    {"name": "hang_d_kurd",
+     "pads": [{"center": [0, 180, 0], "radius": 40, "dead_zone": 3, "pitch": 50, "sample": "D.wav"},
+              {"center": [0, 170, 87], "radius": 40}]}
+
+    center: pad centre (x, y, z)
+    radius: strokes farther away (horizontal distance) play no pad, default: unlimited
+    dead_zone: border within the radius where strokes are ignored, e.g. between adjacent pads, default: 0
+    height: maximum vertical distance between stroke and pad centre, default: unlimited
+    pitch: MIDI pitch of the pad, default: pitch of the current scale (see IHDPlayer.drum_id_to_pitch)
+    sample: sample file of the pad (audio directory) played by the sampler (see ihd_sampler.py), default: sample of
+            the nearest root pitch
+
+Strokes are mapped to the pad with the nearest centre in the horizontal plane (see ihd_pad_lookup.py), then the radius,
+dead zone and height of that pad are checked. At load time, the pad arrays and the lookup grid are compiled into a
+binary geometry index (.npz) in the cache directory (default: per-user cache directory, not next to the layout
+files). The index is keyed by the content of the layout file, so it is only rebuilt after the file changed.
+
+Compiled layouts are not modified, IHDGestureDetector.set_pad_layout replaces the layout by a single reference
+assignment: a stroke is mapped either with the old or with the new layout, also while the frame worker thread is
+running. IHDPadLayoutWatcher reloads a layout file whenever it changed.
+
+Usage:
+    layout = load_pad_layout('layouts/hang_d_kurd.json')
+    pad = layout.map_stroke(position)
+"""
+
+import os
+import json
+import zlib
+import threading
+import traceback
+
+import numpy as np
+
+from ihd_pad_lookup import IHDPadLookup
+
+# version of the compiled geometry index, cache files of other versions are rebuilt
+GEOMETRY_VERSION = 1
+
+# default directory of geometry indices
+CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache'),
+                         'invisible_hand_drum', 'layouts')
+
+NO_PITCH = -1
+
+
+class IHDPadLayout:
+    """ Compiled pad layout with nearest pad lookup (not modified after construction) """
+
+    def __init__(self, centers, radii=None, dead_zones=None, heights=None, pitches=None, samples=None, name='',
+                 grid=None):
+        """ Initialize layout
+        Args:
+            centers (np.ndarray): Pad centres (x, y, z) as rows
+            radii (np.ndarray): Pad radii (mm), default: unlimited
+            dead_zones (np.ndarray): Width (mm) of the ignored border of the pads, default: 0
+            heights (np.ndarray): Maximum vertical distance (mm) between stroke and pad centre, default: unlimited
+            pitches (np.ndarray): MIDI pitch per pad, NO_PITCH: pitch of the current scale, default: NO_PITCH
+            samples (list): Sample file name per pad ('' for none)
+            name (string): Layout name
+            grid (dict): Precomputed lookup grid (see IHDPadLookup.build_grid)
+        """
+        self.centers = np.array(centers, dtype=float).reshape((-1, 3))
+        self.num_pads = len(self.centers)
+        self.radii = self.pad_values(radii, np.inf)
+        self.dead_zones = self.pad_values(dead_zones, 0.)
+        self.heights = self.pad_values(heights, np.inf)
+        self.pitches = self.pad_values(pitches, NO_PITCH).astype(np.int64)
+        self.samples = list(samples) if samples is not None else [''] * self.num_pads
+        if len(self.samples) != self.num_pads:
+            raise Exception('Non-valid pad samples')
+        self.name = name
+        self.lookup = IHDPadLookup(self.centers[:, [0, 2]], grid=grid)
+
+        # squared horizontal radius within the dead zone, lists for single pad access
+        self.max_squared_distances = np.square(np.maximum(self.radii - self.dead_zones, 0)).tolist()
+        self.center_y = self.centers[:, 1].tolist()
+        self.height_list = self.heights.tolist()
+        self.pitch_list = self.pitches.tolist()
+
+    def pitch(self, pad):
+        """ MIDI pitch assigned to pad, NO_PITCH if none (or if the pad is not part of the layout) """
+        return self.pitch_list[pad] if pad < self.num_pads else NO_PITCH
+
+    def pad_values(self, values, default):
+        if values is None:
+            return np.full(self.num_pads, default, dtype=float)
+        values = np.array(values, dtype=float).reshape(-1)
+        if len(values) != self.num_pads:
+            raise Exception('Non-valid number of pad values')
+        return values
+
+    @staticmethod
+    def from_positions(positions, name=''):
+        """ Layout of unlimited pads around horizontal positions (x, z), e.g. the hexagon layout """
+        positions = np.array(positions, dtype=float).reshape((-1, 2))
+        return IHDPadLayout(np.column_stack((positions[:, 0], np.zeros(len(positions)), positions[:, 1])), name=name)
+
+    def map_stroke(self, position):
+        """ Pad of stroke position
+        Args:
+            position (tuple): Stroke position (x, y, z)
+        Returns:
+            pad (int): Pad index, None if the stroke is outside of the pad (radius, dead zone, height)
+        """
+        x, y, z = position[0], position[1], position[2]
+        pad = self.lookup.lookup(x, z)
+        dx = x - self.lookup.pad_x[pad]
+        dz = z - self.lookup.pad_z[pad]
+        if dx*dx + dz*dz > self.max_squared_distances[pad] or abs(y - self.center_y[pad]) > self.height_list[pad]:
+            return None
+        return pad
+
+    def map_strokes(self, positions):
+        """ Pads of several stroke positions (x, y, z) as rows, -1 for strokes outside of their pad """
+        pads = self.lookup.lookup_batch(positions[:, [0, 2]])
+        squared = np.sum(np.square(positions[:, [0, 2]] - self.centers[pads][:, [0, 2]]), axis=1)
+        is_outside = (squared > np.square(np.maximum(self.radii - self.dead_zones, 0))[pads]) | \
+                     (np.abs(positions[:, 1] - self.centers[pads, 1]) > self.heights[pads])
+        pads[is_outside] = -1
+        return pads
+
+    def arrays(self):
+        """ Pad and grid arrays of the geometry index """
+        arrays = dict(('grid_' + name, np.asarray(value)) for name, value in self.lookup.grid.items())
+        arrays.update({'version': np.array(GEOMETRY_VERSION),
+                       'name': np.array(self.name),
+                       'centers': self.centers,
+                       'radii': self.radii,
+                       'dead_zones': self.dead_zones,
+                       'heights': self.heights,
+                       'pitches': self.pitches,
+                       'samples': np.array(self.samples)})
+        return arrays
+
+    @staticmethod
+    def from_arrays(arrays):
+        """ Layout of geometry index arrays (see arrays()) without rebuilding the lookup grid """
+        grid = dict((name[len('grid_'):], arrays[name]) for name in arrays if name.startswith('grid_'))
+        grid['cell_mm'] = float(grid['cell_mm'])
+        return IHDPadLayout(arrays['centers'], arrays['radii'], arrays['dead_zones'], arrays['heights'],
+                            arrays['pitches'], [str(sample) for sample in arrays['samples']], str(arrays['name']),
+                            grid=grid)
+
+
+def parse_layout(text):
+    """ Pad layout of layout file content (JSON, see module docstring) """
+    definition = json.loads(text)
+    pads = definition.get('pads', [])
+    if len(pads) == 0:
+        raise Exception('Non-valid pad layout without pads')
+    for pad in pads:
+        if len(pad.get('center', ())) != 3:
+            raise Exception('Non-valid pad center %s' % pad.get('center'))
+    return IHDPadLayout([pad['center'] for pad in pads],
+                        radii=[pad.get('radius', np.inf) for pad in pads],
+                        dead_zones=[pad.get('dead_zone', 0.) for pad in pads],
+                        heights=[pad.get('height', np.inf) for pad in pads],
+                        pitches=[pad.get('pitch', NO_PITCH) for pad in pads],
+                        samples=[str(pad.get('sample', '')) for pad in pads],
+                        name=str(definition.get('name', '')))
+
+
+def geometry_index_fn(fn, text, cache_dir=None):
+    """ File name of the compiled geometry index of a layout file (content hash) """
+    cache_dir = cache_dir if cache_dir is not None else CACHE_DIR
+    checksum = zlib.crc32(text) & 0xffffffff
+    return os.path.join(cache_dir, '.%s.%08x.v%d.npz' % (os.path.basename(fn), checksum, GEOMETRY_VERSION))
+
+
+def load_pad_layout(fn, cache_dir=None):
+    """ Load layout file, the compiled geometry index is read from or written to the cache directory
+    Args:
+        fn (string): Layout file name
+        cache_dir (string): Directory of geometry indices, default: CACHE_DIR
+    Returns:
+        layout (IHDPadLayout): Compiled layout
+    """
+    with open(fn, 'rb') as f:
+        text = f.read()
+    index_fn = geometry_index_fn(fn, text, cache_dir)
+    if os.path.exists(index_fn):
+        with np.load(index_fn) as arrays:
+            return IHDPadLayout.from_arrays(dict((name, arrays[name]) for name in arrays.files))
+
+    layout = parse_layout(text.decode('utf-8'))
+    try:
+        if not os.path.isdir(os.path.dirname(index_fn)):
+            os.makedirs(os.path.dirname(index_fn))
+        # write to temporary file and rename, a concurrent load never reads a partial index
+        tmp_fn = index_fn + '.%d.tmp' % os.getpid()
+        with open(tmp_fn, 'wb') as f:
+            np.savez(f, **layout.arrays())
+        os.rename(tmp_fn, index_fn)
+    except (IOError, OSError):
+        # cache directory not writable, the layout is compiled again on the next load
+        traceback.print_exc()
+    return layout
+
+
+class IHDPadLayoutWatcher:
+    """ Thread which reloads a layout file after it was modified """
+
+    def __init__(self, fn, on_change, interval_sec=1., cache_dir=None):
+        """ Initialize watcher
+        Args:
+            fn (string): Layout file name
+            on_change (function): Called with the new IHDPadLayout (in the watcher thread)
+            interval_sec (float): Time between two checks of the modification time
+            cache_dir (string): Directory of geometry indices (see load_pad_layout)
+        """
+        self.fn = fn
+        self.on_change = on_change
+        self.interval_sec = interval_sec
+        self.cache_dir = cache_dir
+        self.last_mtime = os.path.getmtime(fn)
+        self.stopped = threading.Event()
+        self.thread = None
+        self.num_reloads = 0
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='IHDPadLayoutWatcher')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def check(self):
+        """ Reload layout if the layout file was modified since the last check """
+        mtime = os.path.getmtime(self.fn)
+        if mtime == self.last_mtime:
+            return False
+        self.last_mtime = mtime
+        self.on_change(load_pad_layout(self.fn, self.cache_dir))
+        self.num_reloads += 1
+        return True
+
+    def run(self):
+        while not self.stopped.wait(self.interval_sec):
+            try:
+                self.check()
+            except Exception:
+                # keep the current layout, e.g. while the file is saved or if it is not valid
+                traceback.print_exc()
@@ -0,0 +1,154 @@
+""" Precomputed nearest-pad lookup for arbitrary drum layouts
+
+A stroke is mapped to the pad with the nearest centre (Voronoi region of the pad) in the horizontal plane (x, z).
+Instead of computing the distance to every pad per stroke, IHDPadLookup precomputes once per layout a regular grid over
+the layout: for every cell, the pads whose Voronoi region intersects the cell. Most cells lie within one region, so a
+lookup is one grid index (O(1)) without temporary arrays. Only cells on region borders compare the distances of their
+few candidate pads, strokes outside the grid (margin_mm beyond the layout) compare all pads.
+
+Usage:
+    lookup = IHDPadLookup(ring_layout(64, radius=250))
+    pad = lookup.lookup(x, z)
+"""
+
+import numpy as np
+
+
+def ring_layout(num_pads, radius=100.):
+    """ Layout of concentric rings around a centre pad (e.g. extended hand-pans), ring k holds up to 6k pads
+    Args:
+        num_pads (int): Number of pads
+        radius (float): Radius (mm) of the outer ring
+    Returns:
+        positions (np.ndarray): Pad centres (x, z) as rows
+    """
+    if num_pads < 1:
+        raise Exception('Non-valid number of pads')
+    num_rings = 0
+    while 1 + 3*num_rings*(num_rings + 1) < num_pads:
+        num_rings += 1
+    positions = [(0., 0.)]
+    for ring in range(1, num_rings + 1):
+        num_ring_pads = min(6*ring, num_pads - len(positions))
+        angles = 2*np.pi*np.arange(num_ring_pads) / num_ring_pads + np.pi/2
+        ring_radius = radius*ring / float(num_rings)
+        positions += list(zip(ring_radius*np.cos(angles), ring_radius*np.sin(angles)))
+    return np.array(positions)
+
+
+class IHDPadLookup:
+    """ Nearest pad of stroke positions via precomputed grid of candidate pads """
+
+    def __init__(self, positions, cell_mm=5., margin_mm=200., grid=None):
+        """ Build lookup grid for layout
+        Args:
+            positions (np.ndarray): Pad centres (x, z) as rows
+            cell_mm (float): Edge length of the grid cells
+            margin_mm (float): Extent of the grid beyond the outermost pad centres
+            grid (dict): Grid arrays of an earlier build of the same layout (see build_grid), e.g. loaded from a
+                         cache file, default: build grid
+        """
+        self.positions = np.array(positions, dtype=float).reshape((-1, 2))
+        self.num_pads = len(self.positions)
+        if self.num_pads == 0:
+            raise Exception('Non-valid pad layout')
+        self.grid = grid if grid is not None else self.build_grid(cell_mm, margin_mm)
+
+        self.cell_mm = float(self.grid['cell_mm'])
+        self.inv_cell_mm = 1. / self.cell_mm
+        self.origin = self.grid['origin']
+        self.num_cols, self.num_rows = [int(num) for num in self.grid['shape']]
+        self.cell_pad_array = self.grid['cell_pads']
+        self.num_ambiguous_cells = int(np.sum(self.cell_pad_array < 0))
+        # lists, indexing Python lists is faster than indexing arrays for single values
+        self.cell_pads = self.cell_pad_array.tolist()
+        self.candidate_starts = self.grid['candidate_starts'].tolist()
+        self.candidates = self.grid['candidates'].tolist()
+        self.pad_x = self.positions[:, 0].tolist()
+        self.pad_z = self.positions[:, 1].tolist()
+        self.origin_x, self.origin_z = self.origin.tolist()
+
+    def build_grid(self, cell_mm, margin_mm):
+        """ Candidate pads of all grid cells
+        Returns:
+            grid (dict): Cell size, origin (x, z), shape (columns, rows), unique pad per cell (-1 if several
+                         candidates), candidate pads of all cells in compressed rows (candidate_starts, candidates)
+        """
+        origin = self.positions.min(axis=0) - margin_mm
+        num_cols, num_rows = [int(num) for num in np.ceil((self.positions.max(axis=0) + margin_mm - origin) /
+                                                          float(cell_mm))]
+
+        cell_pads = np.empty(num_rows*num_cols, dtype=np.int64)
+        candidate_starts = np.zeros(num_rows*num_cols + 1, dtype=np.int64)
+        candidates = []
+        # one row of cells at a time, temporaries of (columns x pads)
+        low_x = origin[0] + cell_mm*np.arange(num_cols)
+        high_x = low_x + cell_mm
+        pad_x, pad_z = self.positions[:, 0], self.positions[:, 1]
+        dx_min = np.maximum(np.maximum(low_x[:, None] - pad_x, pad_x - high_x[:, None]), 0)
+        dx_max = np.maximum(np.abs(pad_x - low_x[:, None]), np.abs(pad_x - high_x[:, None]))
+        for row in range(num_rows):
+            low_z = origin[1] + cell_mm*row
+            high_z = low_z + cell_mm
+            dz_min = np.maximum(np.maximum(low_z - pad_z, pad_z - high_z), 0)
+            dz_max = np.maximum(np.abs(pad_z - low_z), np.abs(pad_z - high_z))
+            # a pad can only be nearest for a point in the cell if its minimum distance to the cell does not exceed
+            # the smallest maximum distance of any pad to the cell
+            min_squared = np.square(dx_min) + np.square(dz_min)
+            max_squared = np.square(dx_max) + np.square(dz_max)
+            is_candidate = min_squared <= max_squared.min(axis=1)[:, None]
+            num_candidates = is_candidate.sum(axis=1)
+            cells = slice(row*num_cols, (row + 1)*num_cols)
+            cell_pads[cells] = np.where(num_candidates == 1, np.argmax(is_candidate, axis=1), -1)
+            candidate_starts[row*num_cols + 1:(row + 1)*num_cols + 1] = num_candidates
+            candidates.append(np.nonzero(is_candidate)[1])
+        return {'cell_mm': float(cell_mm),
+                'origin': origin,
+                'shape': np.array((num_cols, num_rows)),
+                'cell_pads': cell_pads,
+                'candidate_starts': np.cumsum(candidate_starts),
+                'candidates': np.concatenate(candidates)}
+
+    def lookup(self, x, z):
+        """ Nearest pad (index of layout row) of position (x, z) """
+        col = (x - self.origin_x)*self.inv_cell_mm
+        row = (z - self.origin_z)*self.inv_cell_mm
+        if 0 <= col < self.num_cols and 0 <= row < self.num_rows:
+            cell = int(row)*self.num_cols + int(col)
+            pad = self.cell_pads[cell]
+            if pad >= 0:
+                return pad
+        else:
+            return int(self.nearest_brute_force(x, z))
+        # nearest of the candidates, first pad on ties as np.argmin
+        pad = -1
+        min_squared = float('inf')
+        for idx in range(self.candidate_starts[cell], self.candidate_starts[cell + 1]):
+            candidate = self.candidates[idx]
+            dx = self.pad_x[candidate] - x
+            dz = self.pad_z[candidate] - z
+            squared = dx*dx + dz*dz
+            if squared < min_squared:
+                min_squared = squared
+                pad = candidate
+        return pad
+
+    def lookup_batch(self, points):
+        """ Nearest pads of several positions
+        Args:
+            points (np.ndarray): Positions (x, z) as rows
+        Returns:
+            pads (np.ndarray): Pad index per row
+        """
+        cols = np.floor((points[:, 0] - self.origin[0])*self.inv_cell_mm).astype(np.int64)
+        rows = np.floor((points[:, 1] - self.origin[1])*self.inv_cell_mm).astype(np.int64)
+        is_inside = (cols >= 0) & (cols < self.num_cols) & (rows >= 0) & (rows < self.num_rows)
+        pads = np.full(len(points), -1, dtype=np.int64)
+        pads[is_inside] = self.cell_pad_array[rows[is_inside]*self.num_cols + cols[is_inside]]
+        for idx in np.flatnonzero(pads < 0):
+            pads[idx] = self.lookup(points[idx, 0], points[idx, 1])
+        return pads
+
+    def nearest_brute_force(self, x, z):
+        """ Nearest pad by distances to all pads (reference for lookup) """
+        return np.argmin(np.sqrt(np.sum(np.square(self.positions - np.array((x, z))), axis=1)))
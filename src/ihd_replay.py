@@ -0,0 +1,400 @@
+""" Replay of recorded sessions to drive IHDController (or any Leap.Listener) without a Leap device
+
+The following capture formats are supported:
+
+    - serialized Leap frames (Frame.serialize blobs, each prefixed by its length as 32 bit integer), which require
+      the Leap library for deserialization
+    - plain hand state text files with one line per hand and frame
+
+          # frame_id timestamp_us hand_id is_left palm_x palm_y palm_z velocity_x velocity_y velocity_z
+          1041 2081530 12 0 -12.5 180.1 20.3 0.0 -150.2 1.1
+
+      A line which only contains frame_id and timestamp marks a frame without any tracked hand.
+
+    - memory-mapped hand tracking logs (*.ihdlog, see ihd_hand_log.py)
+"""
+
+import ctypes
+import struct
+import sys
+import time
+import argparse
+from collections import deque
+
+import numpy as np
+
+from ihd_clock import IHDClock, host_time
+from ihd_frame import IHDFrameState, IHDHandState
+from ihd_hand_log import IHDHandLogReader
+
+
+class IHDLatencyStats:
+    """ Collects processing durations (in seconds) """
+
+    def __init__(self, name):
+        self.name = name
+        self.durations = []
+
+    def add(self, duration):
+        self.durations.append(duration)
+
+    def summary(self):
+        """ Returns dict with count and latency statistics in milliseconds """
+        if len(self.durations) == 0:
+            return {'name': self.name, 'count': 0}
+        durations_ms = 1000.*np.array(self.durations)
+        return {'name': self.name,
+                'count': len(durations_ms),
+                'mean_ms': np.mean(durations_ms),
+                'median_ms': np.median(durations_ms),
+                'p95_ms': np.percentile(durations_ms, 95),
+                'p99_ms': np.percentile(durations_ms, 99),
+                'max_ms': np.max(durations_ms)}
+
+    def __str__(self):
+        s = self.summary()
+        if s['count'] == 0:
+            return '%s: no calls' % self.name
+        return '%s: %d calls, mean %.3f ms, median %.3f ms, p95 %.3f ms, p99 %.3f ms, max %.3f ms' % \
+               (s['name'], s['count'], s['mean_ms'], s['median_ms'], s['p95_ms'], s['p99_ms'], s['max_ms'])
+
+
+def profile_method(obj, method_name, stats=None):
+    """ Wrap method of given object instance to record the duration of each call
+    Args:
+        obj (object): Instance, e.g. IHDGestureDetector
+        method_name (string): Method name, e.g. 'analyze_frame'
+        stats (IHDLatencyStats): Optional statistics object to add the durations to
+    Returns:
+        stats (IHDLatencyStats)
+    """
+    if stats is None:
+        stats = IHDLatencyStats('%s.%s' % (obj.__class__.__name__, method_name))
+    method = getattr(obj, method_name)
+
+    def timed_method(*args, **kwargs):
+        start = host_time()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            stats.add(host_time() - start)
+
+    setattr(obj, method_name, timed_method)
+    return stats
+
+
+class IHDNullMidiOut:
+    """ MIDI output which only counts messages (headless replay / benchmarking) """
+
+    def __init__(self, delay_sec=0.):
+        """ Initialize output
+        Args:
+            delay_sec (float): Duration of every send_message call, emulates a slow MIDI backend
+        """
+        self.delay_sec = delay_sec
+        self.num_messages = 0
+        self.last_message = None
+
+    def get_ports(self):
+        return []
+
+    def open_port(self, port):
+        pass
+
+    def open_virtual_port(self, name):
+        pass
+
+    def send_message(self, message):
+        if self.delay_sec > 0:
+            time.sleep(self.delay_sec)
+        self.num_messages += 1
+        self.last_message = message
+
+
+class IHDReplayConfig:
+    """ Replacement for Leap.Config, stores values but has no effect """
+
+    def __init__(self):
+        self.values = {}
+
+    def set(self, key, value):
+        self.values[key] = value
+        return True
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def save(self):
+        return True
+
+
+class IHDReplayController:
+    """ Stand-in for Leap.Controller which feeds recorded frames to its listeners """
+
+    def __init__(self, frames, history_length=60, callback_drop_probability=0., seed=None):
+        """ Initialize replay controller
+        Args:
+            frames (iterable): Frames (Leap.Frame or IHDFrameState) in recording order
+            history_length (int): Number of frames accessible via frame(history)
+            callback_drop_probability (float): Probability that on_frame is not called for a frame (simulates
+                                               callbacks skipped by a stalled process), the frame is still
+                                               accessible via frame(history)
+            seed (int): Random seed for dropping callbacks
+        """
+        self.frames = frames
+        self.callback_drop_probability = callback_drop_probability
+        self.rng = np.random.RandomState(seed)
+        self.history = deque(maxlen=history_length)
+        self.listeners = []
+        self.config = IHDReplayConfig()
+        self.enabled_gestures = set()
+        self.is_connected = True
+        self.has_focus = True
+        self.frame_stats = IHDLatencyStats('on_frame')
+        self.num_frames = 0
+        self.num_missed_deadlines = 0
+        self.replay_duration_sec = 0
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+        listener.on_init(self)
+        listener.on_connect(self)
+        return True
+
+    def remove_listener(self, listener):
+        if listener not in self.listeners:
+            return False
+        listener.on_disconnect(self)
+        listener.on_exit(self)
+        self.listeners.remove(listener)
+        return True
+
+    def frame(self, history=0):
+        """ Return current frame (history=0) or one of the previous frames """
+        if history < len(self.history):
+            return self.history[-1 - history]
+        return IHDFrameState.invalid
+
+    def enable_gesture(self, _type, enable=True):
+        if enable:
+            self.enabled_gestures.add(_type)
+        else:
+            self.enabled_gestures.discard(_type)
+
+    def is_gesture_enabled(self, _type):
+        return _type in self.enabled_gestures
+
+    def set_policy(self, policy):
+        pass
+
+    def clear_policy(self, policy):
+        pass
+
+    def run(self, speed=1.):
+        """ Replay all frames
+        Args:
+            speed (float): Replay speed relative to recording (1 = real-time, 4 = four times faster),
+                           None replays as fast as possible
+        Returns:
+            num_frames (int): Number of replayed frames
+        """
+        replay_start = host_time()
+        first_timestamp = None
+        prev_timestamp = None
+
+        for frame in self.frames:
+            if first_timestamp is None:
+                first_timestamp = frame.timestamp
+
+            # wait until frame is due
+            if speed:
+                due_time = replay_start + (frame.timestamp - first_timestamp)*1e-6/speed
+                wait_time = due_time - host_time()
+                if wait_time > 0:
+                    time.sleep(wait_time)
+
+            self.history.append(frame)
+
+            if self.callback_drop_probability > 0 and self.rng.random_sample() < self.callback_drop_probability:
+                self.num_frames += 1
+                continue
+
+            start = host_time()
+            for listener in self.listeners:
+                listener.on_frame(self)
+            duration = host_time() - start
+            self.frame_stats.add(duration)
+
+            # processing took longer than the time until the next frame arrives in a live session
+            if prev_timestamp is not None and duration > (frame.timestamp - prev_timestamp)*1e-6:
+                self.num_missed_deadlines += 1
+            prev_timestamp = frame.timestamp
+            self.num_frames += 1
+
+        self.replay_duration_sec = host_time() - replay_start
+        return self.num_frames
+
+    def report(self):
+        """ Summary of replay throughput and per-frame processing latency """
+        fps = self.num_frames / self.replay_duration_sec if self.replay_duration_sec > 0 else 0
+        return '%d frames in %.2f s (%.1f fps), %d missed frame deadlines\n%s' % \
+               (self.num_frames, self.replay_duration_sec, fps, self.num_missed_deadlines, self.frame_stats)
+
+
+def read_hand_state_file(fn):
+    """ Read frames from plain hand state text file
+    Args:
+        fn (string): File name
+    Returns:
+        frames (list): List of IHDFrameState
+    """
+    frames = []
+    with open(fn, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if len(line) == 0 or line.startswith('#'):
+                continue
+            values = line.split()
+            frame_id, timestamp = int(values[0]), int(values[1])
+            if len(frames) == 0 or frames[-1].id != frame_id:
+                frames.append(IHDFrameState(frame_id, timestamp))
+            if len(values) > 2:
+                frames[-1].hands.append(IHDHandState(int(values[2]),
+                                                     [float(_) for _ in values[4:7]],
+                                                     [float(_) for _ in values[7:10]],
+                                                     is_left=int(values[3])))
+    return frames
+
+
+def write_hand_state_file(fn, frames):
+    """ Write frames (Leap.Frame or IHDFrameState) to plain hand state text file """
+    with open(fn, 'w') as f:
+        f.write('# frame_id timestamp_us hand_id is_left palm_x palm_y palm_z velocity_x velocity_y velocity_z\n')
+        for frame in frames:
+            if len(frame.hands) == 0:
+                f.write('%d %d\n' % (frame.id, frame.timestamp))
+            for hand in frame.hands:
+                f.write('%d %d %d %d %f %f %f %f %f %f\n' % ((frame.id, frame.timestamp, hand.id, hand.is_left) +
+                                                             tuple(hand.palm_position.to_tuple()) +
+                                                             tuple(hand.palm_velocity.to_tuple())))
+
+
+class IHDSerializedFrameWriter:
+    """ Append Leap frames as length-prefixed Frame.serialize blobs to a capture file """
+
+    def __init__(self, fn):
+        self.f = open(fn, 'wb')
+        self.num_frames = 0
+
+    def write(self, frame):
+        serialized_data, serialized_length = frame.serialize
+        data_address = serialized_data.cast().__long__()
+        buffer_ = (ctypes.c_ubyte * serialized_length).from_address(data_address)
+        self.f.write(struct.pack('<i', serialized_length))
+        self.f.write(buffer_)
+        self.num_frames += 1
+
+    def close(self):
+        self.f.close()
+
+
+def read_serialized_frames(fn):
+    """ Generator over Leap frames from capture file of length-prefixed Frame.serialize blobs """
+    # only needed for this capture format, hand state files can be replayed without the Leap library
+    import Leap
+
+    with open(fn, 'rb') as f:
+        while True:
+            header = f.read(4)
+            if len(header) < 4:
+                break
+            length = struct.unpack('<i', header)[0]
+            data = f.read(length)
+            leap_byte_array = Leap.byte_array(length)
+            address = leap_byte_array.cast().__long__()
+            ctypes.memmove(address, data, length)
+            frame = Leap.Frame()
+            frame.deserialize((leap_byte_array, length))
+            yield frame
+
+
+def read_frames(fn):
+    """ Read frames from capture file, format is chosen based on file extension
+        (.txt -> hand state file, .ihdlog -> hand tracking log, otherwise serialized Leap frames)
+    """
+    if fn.endswith('.txt'):
+        return read_hand_state_file(fn)
+    if fn.endswith('.ihdlog'):
+        return IHDHandLogReader(fn).frames()
+    return read_serialized_frames(fn)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay recorded session through IHDController')
+    parser.add_argument('capture',
+                        help='Capture file (*.txt hand state file, *.ihdlog hand log or serialized Leap frames)')
+    parser.add_argument('--speed', type=float, default=1.,
+                        help='Replay speed relative to recording, 0 replays as fast as possible')
+    parser.add_argument('--threaded', action='store_true',
+                        help='Process frames in worker thread as in a live session')
+    parser.add_argument('--drop-callbacks', type=float, default=0.,
+                        help='Probability that the on_frame callback is skipped for a frame')
+    parser.add_argument('--predict', action='store_true',
+                        help='Send notes of forecast stroke impacts ahead of the impact (see ihd_impact_predictor.py)')
+    parser.add_argument('--smoothing', choices=['one_euro', 'kalman'],
+                        help='Smoothing of palm positions before stroke detection (see ihd_smoothing.py)')
+    parser.add_argument('--delta-height', type=float,
+                        help='Stroke threshold in mm (default 15, lower thresholds with smoothing)')
+    parser.add_argument('--pads', type=int,
+                        help='Number of pads in concentric rings (see ihd_pad_lookup.ring_layout), default: hexagon')
+    parser.add_argument('--scales',
+                        help="Comma-separated scales selectable by swipes (see ihd_scales.py), e.g. 'd_kurd,random'")
+    parser.add_argument('--output-thread', action='store_true',
+                        help='Send MIDI messages at their frame time from an output thread (see ihd_midi_scheduler.py)')
+    parser.add_argument('--midi-delay', type=float, default=0.,
+                        help='Duration (ms) of sending one MIDI message, emulates a slow MIDI backend')
+    parser.add_argument('--layout',
+                        help='Pad layout file (see ihd_pad_layout.py), reloaded while replaying if modified')
+    parser.add_argument('--audio',
+                        help="Play notes with the in-process sampler instead of MIDI (see ihd_sampler.py) to sink "
+                             "'null', 'device' or a WAV file name (real time, replay with speed 1)")
+    args = parser.parse_args()
+
+    from invisible_hand_drum import IHDController
+    from ihd_pad_lookup import ring_layout
+    from ihd_sampler import IHDSampler, create_sink
+
+    # replay at arbitrary speed, use device timestamps as timebase
+    listener = IHDController(midi_out=IHDNullMidiOut(delay_sec=1e-3*args.midi_delay),
+                             clock=IHDClock(sync_to_host=False),
+                             threaded=args.threaded,
+                             predict_impacts=args.predict,
+                             smoothing=args.smoothing,
+                             thresholds={'delta_height': args.delta_height} if args.delta_height else None,
+                             pad_positions=ring_layout(args.pads, radius=250.) if args.pads else None,
+                             pad_layout_fn=args.layout,
+                             scales=args.scales.split(',') if args.scales else None,
+                             output_thread=args.output_thread,
+                             sampler=IHDSampler(sink=create_sink(args.audio)) if args.audio else None)
+    # play_all plays the notes of the computer player (within update) and of forecast strokes
+    all_stats = [profile_method(listener.gesture_detector, 'analyze_frame'),
+                 profile_method(listener.player, 'play'),
+                 profile_method(listener.player, 'play_all'),
+                 profile_method(listener.player, 'update')]
+
+    controller = IHDReplayController(read_frames(args.capture),
+                                     callback_drop_probability=args.drop_callbacks,
+                                     seed=1)
+    controller.add_listener(listener)
+    controller.run(speed=args.speed)
+    controller.remove_listener(listener)
+
+    print(controller.report())
+    for stats in all_stats:
+        print(stats)
+    print('%d MIDI messages sent, %d strokes outside of the pads' %
+          (listener.player.midi_out.num_messages, listener.gesture_detector.num_strokes_outside_pads))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,507 @@
+""" In-process polyphonic sampler playing the hang recordings (audio/*.wav) without an external synthesizer
+
+The recordings are decoded once into float32 NumPy buffers (IHDSampleBank). A render thread mixes the sounding voices
+in small fixed-size blocks (64 frames: 1.3 ms at 48 kHz) into a preallocated block buffer and writes every block to a
+sink. Mixing uses preallocated temporaries only, no arrays are allocated per block.
+
+Every note is played by the sample whose root pitch is nearest to the note (or by the sample of its pad, see the
+'sample' field of layout files) and transposed to the pitch of the note by resampling (linear interpolation),
+including the microtonal offset (cents) of the scale. The gain of a voice follows the MIDI velocity of the play level
+((velocity / 127)^2). Voices ring out until the end of their sample, the oldest voice is faded out within one block if
+more than max_voices are sounding (without fade out if more than max_voices notes start within one block). Metronome
+clicks are short synthesized bursts.
+
+Notes are queued from any thread (deque) and started in the block which contains their start time (sample accurate
+if the note is queued ahead, e.g. clicks and notes of the computer player with lookahead), otherwise in the next block.
+Start times are frame times, time_offset maps frame time to host time (see IHDMidiScheduler).
+
+Sinks:
+    IHDNullSink: discards blocks (headless benchmarking), the render thread is paced to real time
+    IHDWavFileSink: writes 16 bit PCM WAV file, paced to real time (or as fast as possible for offline rendering)
+    IHDAudioDeviceSink: audio device via the optional sounddevice package, paced by the blocking device writes
+
+Usage:
+    sampler = IHDSampler(sink=create_sink('device'))
+    sampler.start()
+    sampler.note_on(62, 100, cents=14.)
+    sampler.stop()
+"""
+
+import os
+import glob
+import heapq
+import struct
+import threading
+import time
+import traceback
+import wave
+from collections import deque
+
+import numpy as np
+
+from ihd_clock import host_time
+
+AUDIO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'audio')
+
+# root pitches of the bundled recordings (fundamentals measured from the recordings, the file names do not name the
+# notes), samples without root pitch are played untransposed
+SAMPLE_PITCHES = {'A.wav': 48, 'B.wav': 53, 'C.wav': 55, 'D.wav': 56, 'E.wav': 60, 'F.wav': 61, 'G.wav': 65}
+
+# synthesized metronome clicks: name, frequency (Hz), duration (s)
+CLICK_SAMPLES = (('click_accent', 1500., .03), ('click', 1000., .03))
+
+# maximum transposition ratio (2 octaves up), samples are zero padded for the interpolation of one block
+MAX_RATE = 4.
+
+WAVE_FORMAT_PCM = 1
+WAVE_FORMAT_IEEE_FLOAT = 3
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+
+def read_wav(fn):
+    """ Decode WAV file (PCM 16 / 24 / 32 bit or 32 bit float, also WAVE_FORMAT_EXTENSIBLE, which the wave module
+        does not read)
+    Returns:
+        sample_rate (int): Sample rate (Hz)
+        samples (np.ndarray): Samples (frames x channels, float32 within -1 .. 1)
+    """
+    with open(fn, 'rb') as f:
+        data = f.read()
+    if data[:4] != b'RIFF' or data[8:12] != b'WAVE':
+        raise Exception('Non-valid WAV file %s' % fn)
+    fmt = None
+    samples = None
+    pos = 12
+    while pos + 8 <= len(data):
+        chunk_id, size = struct.unpack('<4sI', data[pos:pos + 8])
+        if chunk_id == b'fmt ':
+            fmt = struct.unpack('<HHIIHH', data[pos + 8:pos + 24])
+            if fmt[0] == WAVE_FORMAT_EXTENSIBLE:
+                # format tag of the sub format GUID
+                fmt = (struct.unpack('<H', data[pos + 32:pos + 34])[0],) + fmt[1:]
+        elif chunk_id == b'data':
+            samples = data[pos + 8:pos + 8 + size]
+        pos += 8 + size + (size & 1)
+    if fmt is None or samples is None:
+        raise Exception('Non-valid WAV file %s' % fn)
+
+    format_tag, num_channels, sample_rate, _, _, bits = fmt
+    num_bytes = bits // 8
+    samples = samples[:len(samples) // (num_bytes*num_channels) * num_bytes*num_channels]
+    if format_tag == WAVE_FORMAT_IEEE_FLOAT and bits == 32:
+        values = np.frombuffer(samples, dtype='<f4')
+    elif format_tag == WAVE_FORMAT_PCM and bits in (16, 32):
+        values = np.frombuffer(samples, dtype='<i%d' % num_bytes) / float(2**(bits - 1))
+    elif format_tag == WAVE_FORMAT_PCM and bits == 24:
+        # little endian 3 byte integers, sign extended via the most significant byte
+        b = np.frombuffer(samples, dtype=np.uint8).reshape((-1, 3)).astype(np.int32)
+        values = (b[:, 0] | (b[:, 1] << 8) | (b[:, 2] << 16)) - ((b[:, 2] >= 128) << 24)
+        values = values / float(2**23)
+    else:
+        raise Exception('Non-valid WAV format %d with %d bits' % (format_tag, bits))
+    return sample_rate, values.astype(np.float32).reshape((-1, num_channels))
+
+
+class IHDSampleBank:
+    """ Decoded samples with root pitches (not modified after construction) """
+
+    def __init__(self, directory=AUDIO_DIR, sample_rate=48000, block_size=64, pitches=None):
+        """ Load all WAV files of directory
+        Args:
+            directory (string): Sample directory
+            sample_rate (int): Output sample rate (Hz), samples of other rates are resampled
+            block_size (int): Frames per block of the sampler (zero padding of the samples)
+            pitches (dict): Root pitch per file name, default: SAMPLE_PITCHES
+        """
+        pitches = pitches if pitches is not None else SAMPLE_PITCHES
+        self.sample_rate = sample_rate
+        self.padding = int(np.ceil(block_size*MAX_RATE)) + 2
+        self.names = []
+        self.buffers = []
+        self.lengths = []
+        self.root_pitches = []
+
+        for fn in sorted(glob.glob(os.path.join(directory, '*.wav'))):
+            rate, samples = read_wav(fn)
+            if rate != sample_rate:
+                times = np.arange(int(len(samples)*sample_rate / float(rate))) * rate / float(sample_rate)
+                samples = np.column_stack([np.interp(times, np.arange(len(samples)), channel)
+                                           for channel in samples.T]).astype(np.float32)
+            self.add(os.path.basename(fn), samples, pitches.get(os.path.basename(fn)))
+        for name, frequency, duration_sec in CLICK_SAMPLES:
+            times = np.arange(int(duration_sec*sample_rate)) / float(sample_rate)
+            burst = .5*np.sin(2*np.pi*frequency*times)*np.exp(-times / (.2*duration_sec))
+            self.add(name, burst[:, None].astype(np.float32), None)
+
+        # all samples in one buffer (each followed by zero padding), voices are mixed by one gather from it
+        self.starts = np.cumsum([0] + [len(buffer_) for buffer_ in self.buffers[:-1]])
+        self.data = np.concatenate(self.buffers)
+        self.buffers = [self.data[start:start + length] for start, length in zip(self.starts, self.lengths)]
+        self.index = dict((name, idx) for idx, name in enumerate(self.names))
+        # sample of nearest root pitch per MIDI pitch
+        pitched = [idx for idx, pitch in enumerate(self.root_pitches) if pitch is not None]
+        if len(pitched) == 0:
+            raise Exception('Non-valid sample directory without pitched samples')
+        roots = np.array([self.root_pitches[idx] for idx in pitched])
+        self.nearest_samples = tuple(pitched[int(np.argmin(np.abs(roots - pitch)))] for pitch in range(128))
+
+    def add(self, name, samples, root_pitch):
+        """ Add sample (frames x channels), mono samples are played on both channels """
+        if samples.shape[1] == 1:
+            samples = np.repeat(samples, 2, axis=1)
+        buffer_ = np.zeros((len(samples) + self.padding, 2), dtype=np.float32)
+        buffer_[:len(samples)] = samples[:, :2]
+        self.names.append(name)
+        self.buffers.append(buffer_)
+        self.lengths.append(len(samples))
+        self.root_pitches.append(root_pitch)
+
+    def __len__(self):
+        return len(self.names)
+
+
+class IHDNullSink:
+    """ Sink which discards all blocks """
+
+    is_blocking = False
+    latency_sec = 0.
+
+    def __init__(self):
+        self.num_blocks = 0
+
+    def open(self, sample_rate, block_size):
+        pass
+
+    def write(self, block):
+        self.num_blocks += 1
+
+    def close(self):
+        pass
+
+
+class IHDWavFileSink:
+    """ Sink which writes 16 bit stereo PCM WAV file """
+
+    is_blocking = False
+    latency_sec = 0.
+
+    def __init__(self, fn):
+        self.fn = fn
+        self.wav = None
+        self.num_blocks = 0
+        self.pcm = None
+
+    def open(self, sample_rate, block_size):
+        self.wav = wave.open(self.fn, 'wb')
+        self.wav.setnchannels(2)
+        self.wav.setsampwidth(2)
+        self.wav.setframerate(sample_rate)
+        self.pcm = np.empty((block_size, 2), dtype='<i2')
+
+    def write(self, block):
+        np.multiply(block, 32767., out=self.pcm, casting='unsafe')
+        self.wav.writeframes(self.pcm.tobytes())
+        self.num_blocks += 1
+
+    def close(self):
+        if self.wav is not None:
+            self.wav.close()
+            self.wav = None
+
+
+class IHDAudioDeviceSink:
+    """ Sink which plays blocks on an audio device (requires the sounddevice package) """
+
+    is_blocking = True
+
+    def __init__(self, device=None, latency='low'):
+        """ Initialize sink
+        Args:
+            device (int or string): Output device, default: default output device
+            latency (float or string): Device latency (s) or 'low' / 'high'
+        """
+        import sounddevice
+        self.sounddevice = sounddevice
+        self.device = device
+        self.latency = latency
+        self.latency_sec = 0.
+        self.stream = None
+        self.num_blocks = 0
+        self.num_underflows = 0
+
+    def open(self, sample_rate, block_size):
+        self.stream = self.sounddevice.OutputStream(samplerate=sample_rate, blocksize=block_size, channels=2,
+                                                    dtype='float32', device=self.device, latency=self.latency)
+        self.stream.start()
+        self.latency_sec = self.stream.latency
+
+    def write(self, block):
+        if self.stream.write(block):
+            self.num_underflows += 1
+        self.num_blocks += 1
+
+    def close(self):
+        if self.stream is not None:
+            self.stream.stop()
+            self.stream.close()
+            self.stream = None
+
+
+def create_sink(name):
+    """ Sink by name: 'null', 'device' (audio device if one exists, otherwise null sink) or WAV file name """
+    if name == 'null':
+        return IHDNullSink()
+    if name == 'device':
+        try:
+            import sounddevice
+            sounddevice.query_devices(kind='output')
+        except Exception:
+            print('No audio output device, playing to null sink')
+            return IHDNullSink()
+        return IHDAudioDeviceSink()
+    if name.endswith('.wav'):
+        return IHDWavFileSink(name)
+    raise Exception('Non-valid audio sink')
+
+
+class IHDSampler:
+    """ Polyphonic sampler with render thread """
+
+    def __init__(self, bank=None, sink=None, block_size=64, max_voices=32, master_gain=.5, realtime=True,
+                 max_statistics=10000):
+        """ Initialize sampler
+        Args:
+            bank (IHDSampleBank): Samples, default: recordings of the audio directory
+            sink (object): Sink (see IHDNullSink), default: null sink
+            block_size (int): Frames per block
+            max_voices (int): Maximum number of sounding voices, the oldest voice is stolen
+            master_gain (float): Gain of the mix, the mix is clipped to -1 .. 1
+            realtime (bool): Pace the render thread to real time for sinks which do not block, otherwise render as
+                             fast as possible (offline rendering into a WAV file)
+            max_statistics (int): Number of most recent blocks / notes in the statistics
+        """
+        self.bank = bank if bank is not None else IHDSampleBank(block_size=block_size)
+        self.sink = sink if sink is not None else IHDNullSink()
+        self.sample_rate = self.bank.sample_rate
+        self.block_size = block_size
+        self.block_sec = block_size / float(self.sample_rate)
+        self.max_voices = max_voices
+        self.master_gain = master_gain
+        self.realtime = realtime
+        # host time - frame time
+        self.time_offset = 0.
+        self.gains = tuple((velocity / 127.)**2 for velocity in range(128))
+
+        # notes queued by players: (start host time, sample index, rate, gain)
+        self.events = deque()
+        # heap of (start host time, sequence number, sample index, rate, gain) of notes which start in later blocks
+        self.pending = []
+        self.sequence = 0
+
+        # voices in order of their start, stolen voices are faded out in the next block (up to 2 x max_voices rows)
+        capacity = 2*max_voices
+        self.num_voices = 0
+        self.voice_starts = np.zeros(capacity, dtype=np.int64)
+        self.voice_lengths = np.zeros(capacity)
+        self.voice_positions = np.zeros(capacity)
+        self.voice_rates = np.zeros(capacity)
+        self.voice_gains = np.zeros(capacity)
+        self.voice_released = np.zeros(capacity, dtype=bool)
+
+        # block buffer and temporaries of the mix (voices x frames)
+        self.block = np.zeros((block_size, 2), dtype=np.float32)
+        self.next_block = np.zeros((block_size, 2), dtype=np.float32)
+        self.ramp = np.arange(block_size, dtype=np.float64)
+        self.positions = np.empty((capacity, block_size))
+        self.indices = np.empty((capacity, block_size), dtype=np.int64)
+        self.weights = np.empty((capacity, block_size), dtype=np.float32)
+        self.next_weights = np.empty((capacity, block_size), dtype=np.float32)
+        self.frames = np.empty((capacity, block_size, 2), dtype=np.float32)
+        self.next_frames = np.empty((capacity, block_size, 2), dtype=np.float32)
+        self.fade_out = np.linspace(1., 0., block_size).astype(np.float32)
+
+        self.running = False
+        self.thread = None
+        self.block_time = None
+        self.num_blocks = 0
+        self.num_late_blocks = 0
+        self.num_notes = 0
+        self.num_stolen = 0
+        self.num_errors = 0
+        self.max_sounding = 0
+        self.render_durations = deque(maxlen=max_statistics)
+        self.latenesses = deque(maxlen=max_statistics)
+
+    def __len__(self):
+        return self.num_voices
+
+    def note_on(self, pitch, velocity, cents=0., sample=None, start_time=None):
+        """ Queue note (thread-safe)
+        Args:
+            pitch (int): MIDI pitch
+            velocity (int): MIDI velocity (0 .. 127)
+            cents (float): Microtonal offset of the pitch
+            sample (string): Sample name (e.g. 'D.wav'), default (or unknown sample): sample of nearest root pitch
+            start_time (float): Frame time (s) at which the note starts, default: as soon as possible
+        """
+        idx = self.bank.index.get(sample) if sample else None
+        if idx is None:
+            idx = self.bank.nearest_samples[pitch]
+        root_pitch = self.bank.root_pitches[idx]
+        rate = 1. if root_pitch is None else min(2.**((pitch + .01*cents - root_pitch) / 12.), MAX_RATE)
+        self.events.append((host_time() if start_time is None else start_time + self.time_offset, idx, rate,
+                            self.gains[velocity]))
+
+    def start(self):
+        self.sink.open(self.sample_rate, self.block_size)
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name='IHDSampler')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.sink.close()
+
+    def run(self):
+        self.block_time = host_time() + self.sink.latency_sec
+        while self.running:
+            if self.realtime and not self.sink.is_blocking:
+                # block is played when it is due, it is rendered one block before
+                wait_sec = self.block_time - self.block_sec - host_time()
+                if wait_sec > 0:
+                    time.sleep(wait_sec)
+                elif wait_sec < -self.block_sec:
+                    self.num_late_blocks += 1
+            try:
+                self.sink.write(self.render_block())
+            except Exception:
+                # keep render thread alive, a failing block must not stop the instrument
+                self.num_errors += 1
+                traceback.print_exc()
+            if self.sink.is_blocking:
+                # blocking write returned: the next block is played after the device latency
+                self.block_time = host_time() + self.sink.latency_sec
+            else:
+                self.block_time += self.block_sec
+
+    def render_block(self, block_time=None):
+        """ Mix all voices into the next block
+        Args:
+            block_time (float): Host time at which the block is played, default: time of the render thread
+        Returns:
+            block (np.ndarray): Mixed block (frames x 2, float32), overwritten by the next call
+        """
+        render_start = host_time()
+        block_time = block_time if block_time is not None else (self.block_time if self.block_time is not None
+                                                                else host_time())
+        while self.events:
+            start_time, idx, rate, gain = self.events.popleft()
+            heapq.heappush(self.pending, (start_time, self.sequence, idx, rate, gain))
+            self.sequence += 1
+        # notes which start within this block (or earlier)
+        block_end_time = block_time + self.block_sec
+        while self.pending and self.pending[0][0] < block_end_time:
+            start_time, _, idx, rate, gain = heapq.heappop(self.pending)
+            offset = int(round((start_time - block_time)*self.sample_rate)) if start_time > block_time else 0
+            self.start_voice(idx, rate, gain, offset)
+            self.latenesses.append(block_time + offset / float(self.sample_rate) - start_time)
+        self.max_sounding = max(self.max_sounding, self.num_voices)
+
+        block = self.block
+        num_voices = self.num_voices
+        if num_voices == 0:
+            block[:] = 0
+        else:
+            self.mix(num_voices)
+            block *= self.master_gain
+            np.clip(block, -1., 1., out=block)
+            self.remove_voices(num_voices)
+        self.num_blocks += 1
+        self.render_durations.append(host_time() - render_start)
+        return block
+
+    def start_voice(self, idx, rate, gain, offset):
+        """ Add voice of sample which starts offset frames into the block """
+        if np.count_nonzero(~self.voice_released[:self.num_voices]) >= self.max_voices:
+            # oldest voice which is not released yet
+            self.voice_released[np.argmin(self.voice_released[:self.num_voices])] = True
+            self.num_stolen += 1
+        if self.num_voices == len(self.voice_starts):
+            # all rows are taken (more than max_voices notes start within this block), the oldest stolen voice
+            # ends at once instead of fading out
+            self.remove_voice(int(np.argmax(self.voice_released[:self.num_voices])))
+        voice = self.num_voices
+        self.voice_starts[voice] = self.bank.starts[idx]
+        self.voice_lengths[voice] = self.bank.lengths[idx]
+        # position of the first frame of the block, frames before the start have negative positions
+        self.voice_positions[voice] = -offset*rate
+        self.voice_rates[voice] = rate
+        self.voice_gains[voice] = gain
+        self.voice_released[voice] = False
+        self.num_voices += 1
+        self.num_notes += 1
+
+    def mix(self, num_voices):
+        """ Mix voices into block: one gather of the frames around the (fractional) positions of all voices and
+            linear interpolation as weighted sum
+        """
+        positions = self.positions[:num_voices]
+        indices = self.indices[:num_voices]
+        weights = self.weights[:num_voices]
+        next_weights = self.next_weights[:num_voices]
+        np.multiply(self.voice_rates[:num_voices, None], self.ramp, out=positions)
+        positions += self.voice_positions[:num_voices, None]
+
+        # gain of the frames, 0 before the start of the voice, fade out of stolen voices
+        np.greater_equal(positions, 0, out=weights)
+        weights *= self.voice_gains[:num_voices, None]
+        for voice in np.flatnonzero(self.voice_released[:num_voices]):
+            weights[voice] *= self.fade_out
+
+        np.maximum(positions, 0, out=positions)
+        np.copyto(indices, positions, casting='unsafe')
+        # interpolation weights of the next frame (fraction) and of the frame (gain - fraction)
+        np.subtract(positions, indices, out=next_weights, casting='unsafe')
+        next_weights *= weights
+        weights -= next_weights
+
+        indices += self.voice_starts[:num_voices, None]
+        np.take(self.bank.data, indices, axis=0, out=self.frames[:num_voices])
+        indices += 1
+        np.take(self.bank.data, indices, axis=0, out=self.next_frames[:num_voices])
+        np.einsum('vf,vfc->fc', weights, self.frames[:num_voices], out=self.block)
+        np.einsum('vf,vfc->fc', next_weights, self.next_frames[:num_voices], out=self.next_block)
+        self.block += self.next_block
+
+    def remove_voices(self, num_voices):
+        """ Advance voices by one block, remove voices which ended and stolen voices """
+        self.voice_positions[:num_voices] += self.voice_rates[:num_voices]*self.block_size
+        is_sounding = (self.voice_positions[:num_voices] < self.voice_lengths[:num_voices]) & \
+                      ~self.voice_released[:num_voices]
+        if np.all(is_sounding):
+            return
+        self.num_voices = int(np.count_nonzero(is_sounding))
+        for values in (self.voice_starts, self.voice_lengths, self.voice_positions, self.voice_rates,
+                       self.voice_gains, self.voice_released):
+            values[:self.num_voices] = values[:num_voices][is_sounding]
+
+    def remove_voice(self, voice):
+        """ Remove voice at once, later voices move up one row """
+        for values in (self.voice_starts, self.voice_lengths, self.voice_positions, self.voice_rates,
+                       self.voice_gains, self.voice_released):
+            values[voice:self.num_voices - 1] = values[voice + 1:self.num_voices]
+        self.num_voices -= 1
+
+    def report(self):
+        """ Summary of render durations and note latencies (ms) of the most recent blocks / notes """
+        durations_ms = 1e3*np.array(self.render_durations) if len(self.render_durations) > 0 else np.zeros(1)
+        latenesses_ms = 1e3*np.array(self.latenesses) if len(self.latenesses) > 0 else np.zeros(1)
+        return '%d blocks of %.2f ms rendered (mean %.3f ms, p99 %.3f ms, max %.3f ms, %d late), %d notes ' \
+               '(start after queue time mean %.3f ms, max %.3f ms), max %d voices, %d stolen, %d errors' % \
+               (self.num_blocks, 1e3*self.block_sec, np.mean(durations_ms), np.percentile(durations_ms, 99),
+                np.max(durations_ms), self.num_late_blocks, self.num_notes, np.mean(latenesses_ms),
+                np.max(latenesses_ms), self.max_sounding, self.num_stolen, self.num_errors)
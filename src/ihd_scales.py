@@ -0,0 +1,90 @@
+""" Scale and tuning library with precomputed pitch tables
+
+Each scale is compiled once into an immutable IHDScale: a table with the MIDI pitch and the microtonal offset (cents)
+of every pad, so resolving the pitch of a note is a single tuple index. Layouts with more pads than the scale has notes
+continue the scale in the next octaves.
+
+Scales are given as MIDI note sets, fractional notes are microtonal (62.14 = D4 + 14 cents). Besides the original
+pad scales, the library contains common hang / handpan tunings (ding first) and a just intonation variant of D Kurd.
+The 'random' scale is a permutation of the 'ionian' notes, which is drawn once per selection of the scale.
+
+Microtonal offsets are only played by the sampler (ihd_sampler.py). MIDI output plays the nearest MIDI pitch of the
+pitch table: pitch bend applies to a whole channel and would detune all notes sounding on it, so IHDPlayer warns when a
+microtonal scale is selected without the sampler.
+
+Usage:
+    scale = create_scale('d_kurd')
+    pitch = scale.pitch_table[pad]
+    scale = parse_scale('custom', '50 57 58.5 60 62')
+"""
+
+import numpy as np
+
+# number of pads of the pitch tables
+MAX_PADS = 128
+
+SCALE_NOTES = {'ionian': tuple(range(36, 43)),
+               'ionian_inv': tuple(range(42, 35, -1)),
+               # hang / handpan tunings (ding first), e.g. D Kurd: D3 A3 Bb3 C4 D4 E4 F4 G4 A4
+               'd_kurd': (50, 57, 58, 60, 62, 64, 65, 67, 69),
+               'd_integral': (50, 57, 58, 60, 62, 64, 65, 69),
+               'd_celtic_minor': (50, 57, 60, 62, 64, 65, 67, 69, 72),
+               'd_hijaz': (50, 57, 58, 61, 62, 64, 65, 67, 69),
+               'f_pygmy': (53, 56, 58, 60, 63, 65, 67, 68, 72),
+               'd_amara': (50, 57, 60, 62, 64, 65, 69, 72),
+               # D Kurd in just intonation relative to the ding (1/1 3/2 8/5 16/9 2/1 9/4 12/5 8/3 3/1)
+               'd_kurd_just': (50, 57.02, 58.137, 59.961, 62, 64.039, 65.156, 66.98, 69.02)}
+
+# permutation of these notes per selection
+RANDOM_SCALE_NOTES = SCALE_NOTES['ionian']
+
+
+class IHDScale:
+    """ Immutable pitch and tuning table of a scale """
+
+    def __init__(self, name, notes, num_pads=MAX_PADS):
+        """ Compile scale
+        Args:
+            name (string): Scale name
+            notes (tuple): MIDI notes of the pads, fractional notes are microtonal
+            num_pads (int): Number of pads of the tables
+        """
+        if len(notes) == 0:
+            raise Exception('Non-valid scale without notes')
+        self.name = name
+        self.notes = tuple(float(note) for note in notes)
+        # nearest MIDI pitch and offset, continued in the next octaves
+        pitches = np.round(np.array(self.notes))
+        offsets = 100.*(np.array(self.notes) - pitches)
+        pads = np.arange(num_pads)
+        pitch_table = pitches[pads % len(pitches)] + 12*(pads // len(pitches))
+        self.pitch_table = tuple(int(pitch) for pitch in np.clip(pitch_table, 0, 127))
+        self.cents_table = tuple(float(offset) for offset in offsets[pads % len(pitches)])
+
+    def __len__(self):
+        return len(self.notes)
+
+    @property
+    def is_microtonal(self):
+        return any(cents != 0 for cents in self.cents_table)
+
+
+def parse_scale(name, text):
+    """ Scale of a MIDI note set, e.g. '50 57 58.5 60' """
+    return IHDScale(name, [float(note) for note in text.replace(',', ' ').split()])
+
+
+def create_scale(name, random_state=None):
+    """ Scale of the library
+    Args:
+        name (string): Scale name (see SCALE_NOTES) or 'random'
+        random_state (np.random.RandomState): Random generator of the permutation of scale 'random'
+    Returns:
+        scale (IHDScale): Compiled scale
+    """
+    if name == 'random':
+        random_state = random_state if random_state is not None else np.random.RandomState()
+        return IHDScale(name, [RANDOM_SCALE_NOTES[idx] for idx in random_state.permutation(len(RANDOM_SCALE_NOTES))])
+    if name not in SCALE_NOTES:
+        raise Exception('Undefined scale')
+    return IHDScale(name, SCALE_NOTES[name])
@@ -0,0 +1,293 @@
+""" Synthetic hand motion generator as stand-in for the Leap Motion controller
+
+Produces palm trajectories of 1..N hands playing strokes (accelerating strike, rebound, horizontal move to the next pad)
+including tracking jitter, tracking dropouts, hand ID changes and feints (shallow strokes which stop before a stroke
+would be detected). Optionally, each stroke is played by a single finger: the fingertip moves the full stroke depth,
+the palm only a fraction of it. Frames have the same surface as Leap frames
+(frame.hands, hand.id, hand.palm_position, ...) and can be fed to IHDReplayController for load and scaling tests.
+"""
+
+import sys
+import argparse
+
+import numpy as np
+
+from ihd_frame import IHDFrameState, IHDHandState, IHDFingerState, NUM_FINGERS
+
+# fingertip offsets from the palm (thumb to pinky, right hand, mm), mirrored in x for left hands
+FINGERTIP_OFFSETS = np.array(((-60., -10., -30.), (-25., -5., -90.), (0., -5., -100.), (20., -5., -90.),
+                              (40., -10., -70.)))
+
+
+class IHDSimulatedHand:
+    """ Motion model of a single simulated hand """
+
+    def __init__(self, _id, is_left, rng, params):
+        self.id = _id
+        self.initial_id = _id
+        self.is_left = is_left
+        self.rng = rng
+        self.params = params
+        self.dropout_frames_left = 0
+        self.position = np.zeros(3)
+        self.velocity = np.zeros(3)
+        self.num_strokes = 0
+        # impact time (s), impact speed (mm/s) and striking finger of every completed stroke (ground truth for
+        # detection tests)
+        self.impact_times = []
+        self.impact_speeds = []
+        self.impact_fingers = []
+        self.is_feint = False
+        self.striking_finger = 0
+        self.tip_offsets = FINGERTIP_OFFSETS*(-1, 1, 1) if is_left else FINGERTIP_OFFSETS
+        self.tip_positions = np.zeros((NUM_FINGERS, 3))
+        self.tip_velocities = np.zeros((NUM_FINGERS, 3))
+        self.start_stroke(0.)
+        self.position[:] = self.target_position
+        self.start_position = self.target_position.copy()
+
+    def start_stroke(self, curr_time):
+        """ Randomize period, depth and horizontal target of the next stroke """
+        p = self.params
+        self.stroke_start_time = curr_time
+        self.stroke_period = 1. / (p['stroke_rate_hz']*self.rng.uniform(.8, 1.2))
+        self.stroke_depth = p['stroke_depth_mm']*self.rng.uniform(.6, 1.4)
+        # random draw only with feints, sessions without feints are reproduced unchanged
+        self.is_feint = p['feint_probability'] > 0 and self.rng.random_sample() < p['feint_probability']
+        if self.is_feint:
+            self.stroke_depth = p['feint_depth_mm']
+        if p['fingers']:
+            self.striking_finger = self.rng.randint(NUM_FINGERS)
+        self.start_position = self.position.copy()
+        angle = self.rng.uniform(0, 2*np.pi)
+        radius = self.rng.uniform(0, p['pad_area_radius_mm'])
+        self.target_position = np.array((radius*np.cos(angle), p['top_height_mm'], radius*np.sin(angle)))
+
+    def update(self, curr_time):
+        """ Compute palm position and velocity (mm, mm/s) at given time (s) """
+        p = self.params
+        while curr_time - self.stroke_start_time >= self.stroke_period:
+            if not self.is_feint:
+                self.num_strokes += 1
+                self.impact_times.append(self.stroke_start_time + p['strike_fraction']*self.stroke_period)
+                self.impact_speeds.append(2*self.stroke_depth / (p['strike_fraction']*self.stroke_period))
+                self.impact_fingers.append(self.striking_finger)
+            self.start_stroke(self.stroke_start_time + self.stroke_period)
+
+        phase = (curr_time - self.stroke_start_time) / self.stroke_period
+        strike_fraction = p['strike_fraction']
+        top = self.target_position[1]
+        strike_duration = strike_fraction*self.stroke_period
+
+        if phase < strike_fraction:
+            # accelerating downwards strike from rest at the top (constant acceleration)
+            t = phase*self.stroke_period
+            acceleration = 2*self.stroke_depth / strike_duration**2
+            height = top - .5*acceleration*t**2
+            vertical_velocity = -acceleration*t
+        else:
+            # exponential rebound from the impact point
+            t = (phase - strike_fraction)*self.stroke_period
+            tau = p['rebound_time_constant_sec']
+            height = top - self.stroke_depth*np.exp(-t/tau)
+            vertical_velocity = self.stroke_depth/tau*np.exp(-t/tau)
+
+        # horizontal movement from the previous to the next pad during the strike
+        horizontal_weight = min(1., phase / strike_fraction) if strike_fraction > 0 else 1.
+        horizontal = self.start_position + horizontal_weight*(self.target_position - self.start_position)
+
+        self.position[0] = horizontal[0]
+        self.position[1] = height
+        self.position[2] = horizontal[2]
+        self.velocity[1] = vertical_velocity
+        if not p['fingers']:
+            return self.position + self.rng.normal(0, p['jitter_mm'], 3), self.velocity
+
+        # striking fingertip moves the full stroke, palm and other fingertips a fraction of it
+        palm_fraction = p['palm_fraction']
+        self.position[1] = top - palm_fraction*(top - height)
+        self.velocity[1] = palm_fraction*vertical_velocity
+        self.tip_positions[:] = self.position + self.tip_offsets + self.rng.normal(0, p['jitter_mm'], (NUM_FINGERS, 3))
+        self.tip_velocities[:] = self.velocity
+        self.tip_positions[self.striking_finger, 1] += (1 - palm_fraction)*(height - top)
+        self.tip_velocities[self.striking_finger, 1] = vertical_velocity
+        return self.position + self.rng.normal(0, p['jitter_mm'], 3), self.velocity
+
+
+class IHDHandSimulator:
+    """ Generates frames for multiple simulated hands """
+
+    def __init__(self,
+                 num_hands=1,
+                 fps=120.,
+                 stroke_rate_hz=2.,
+                 stroke_depth_mm=60.,
+                 top_height_mm=200.,
+                 pad_area_radius_mm=100.,
+                 strike_fraction=.2,
+                 rebound_time_constant_sec=.05,
+                 jitter_mm=.5,
+                 frame_time_jitter_sec=0.,
+                 dropout_probability=0.,
+                 dropout_duration_frames=(2, 20),
+                 id_change_probability=0.,
+                 feint_probability=0.,
+                 feint_depth_mm=8.,
+                 fingers=False,
+                 palm_fraction=.3,
+                 seed=None):
+        """ Initialize simulator
+        Args:
+            num_hands (int): Number of simultaneously tracked hands
+            fps (float): Frame rate
+            stroke_rate_hz (float): Mean number of strokes per second per hand
+            stroke_depth_mm (float): Mean vertical distance of a stroke
+            jitter_mm (float): Standard deviation of gaussian tracking noise on palm position
+            frame_time_jitter_sec (float): Standard deviation of frame timestamp jitter
+            dropout_probability (float): Probability per frame and hand that tracking is lost
+            dropout_duration_frames (tuple): Min / max number of frames a tracking loss lasts
+            id_change_probability (float): Probability that a hand gets a new ID after tracking loss
+            feint_probability (float): Probability that a stroke is a feint (not counted in num_strokes)
+            feint_depth_mm (float): Vertical distance of a feint
+            fingers (bool): Simulate fingertips, each stroke is played by a random finger
+            palm_fraction (float): Fraction of the stroke depth moved by the palm if fingers are simulated
+            seed (int): Random seed for reproducible sessions
+        """
+        self.fps = fps
+        self.dropout_probability = dropout_probability
+        self.fingers = fingers
+        self.dropout_duration_frames = dropout_duration_frames
+        self.id_change_probability = id_change_probability
+        self.frame_time_jitter_sec = frame_time_jitter_sec
+        self.rng = np.random.RandomState(seed)
+        params = {'stroke_rate_hz': stroke_rate_hz,
+                  'stroke_depth_mm': stroke_depth_mm,
+                  'top_height_mm': top_height_mm,
+                  'pad_area_radius_mm': pad_area_radius_mm,
+                  'strike_fraction': strike_fraction,
+                  'rebound_time_constant_sec': rebound_time_constant_sec,
+                  'jitter_mm': jitter_mm,
+                  'feint_probability': feint_probability,
+                  'feint_depth_mm': feint_depth_mm,
+                  'fingers': fingers,
+                  'palm_fraction': palm_fraction}
+        self.next_hand_id = 1
+        self.hands = []
+        for hand_idx in range(num_hands):
+            self.hands.append(IHDSimulatedHand(self.new_hand_id(), hand_idx % 2 == 0, self.rng, params))
+        self.frame_id = 0
+        self.prev_timestamp = -1
+
+    def new_hand_id(self):
+        _id = self.next_hand_id
+        self.next_hand_id += 1
+        return _id
+
+    def next_frame(self):
+        """ Simulate next frame
+        Returns:
+            frame (IHDFrameState)
+        """
+        curr_time = self.frame_id / float(self.fps)
+        if self.frame_time_jitter_sec > 0:
+            curr_time += self.rng.normal(0, self.frame_time_jitter_sec)
+        # keep device timestamps strictly increasing
+        timestamp = max(self.prev_timestamp + 1, int(round(curr_time*1e6)))
+        self.prev_timestamp = timestamp
+        curr_time = timestamp*1e-6
+
+        hand_states = []
+        for hand in self.hands:
+            position, velocity = hand.update(curr_time)
+
+            # tracking dropouts
+            if hand.dropout_frames_left > 0:
+                hand.dropout_frames_left -= 1
+                if hand.dropout_frames_left == 0 and self.rng.random_sample() < self.id_change_probability:
+                    hand.id = self.new_hand_id()
+                continue
+            if self.rng.random_sample() < self.dropout_probability:
+                hand.dropout_frames_left = self.rng.randint(self.dropout_duration_frames[0],
+                                                            self.dropout_duration_frames[1] + 1)
+                continue
+
+            fingers = None
+            if self.fingers:
+                # Leap finger IDs are derived from the hand ID
+                fingers = [IHDFingerState(hand.id*10 + finger_type, finger_type, hand.tip_positions[finger_type],
+                                          hand.tip_velocities[finger_type]) for finger_type in range(NUM_FINGERS)]
+            hand_states.append(IHDHandState(hand.id, position, velocity, is_left=hand.is_left, fingers=fingers))
+
+        frame = IHDFrameState(self.frame_id, timestamp, hand_states)
+        self.frame_id += 1
+        return frame
+
+    def frames(self, duration_sec):
+        """ Generator over simulated frames for given session duration """
+        for _ in range(int(duration_sec*self.fps)):
+            yield self.next_frame()
+
+    @property
+    def num_strokes(self):
+        """ Number of completed strokes of all hands (ground truth for detection tests) """
+        return sum([hand.num_strokes for hand in self.hands])
+
+    @property
+    def impacts(self):
+        """ Hand ID, impact time (s) and impact speed (mm/s) of completed strokes, ordered by time (hand IDs are the
+            initial IDs, the impacts of hands whose ID changed cannot be assigned)
+        """
+        impacts = [(hand.initial_id, impact_time, impact_speed) for hand in self.hands
+                   for impact_time, impact_speed in zip(hand.impact_times, hand.impact_speeds)]
+        return np.array(sorted(impacts, key=lambda impact: impact[1])).reshape((-1, 3))
+
+    @property
+    def finger_impacts(self):
+        """ Finger ID (initial hand ID*10 + finger type) and impact time (s) of completed strokes, ordered by time """
+        impacts = [(hand.initial_id*10 + finger_type, impact_time) for hand in self.hands
+                   for impact_time, finger_type in zip(hand.impact_times, hand.impact_fingers)]
+        return np.array(sorted(impacts, key=lambda impact: impact[1])).reshape((-1, 2))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run IHDController on simulated hands with increasing load')
+    parser.add_argument('--fps', type=float, nargs='+', default=[60, 120, 200, 300])
+    parser.add_argument('--hands', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--duration', type=float, default=10., help='Simulated session duration in seconds')
+    parser.add_argument('--stroke-rate', type=float, default=4., help='Strokes per second per hand')
+    parser.add_argument('--dropout', type=float, default=0., help='Tracking dropout probability per frame')
+    parser.add_argument('--units', default='mm_per_frame', choices=['mm_per_frame', 'mm_per_sec'],
+                        help='Units of stroke detector thresholds')
+    parser.add_argument('--fingers', action='store_true', help='Simulate and detect fingertip strokes')
+    parser.add_argument('--threaded', action='store_true', help='Process frames in worker thread as in a live session')
+    args = parser.parse_args()
+
+    from invisible_hand_drum import IHDController
+    from ihd_clock import IHDClock
+    from ihd_replay import IHDReplayController, IHDNullMidiOut
+
+    print('fps  hands  strokes  detected  mean_ms  p99_ms  max_ms  missed_deadlines')
+    for fps in args.fps:
+        for num_hands in args.hands:
+            simulator = IHDHandSimulator(num_hands=num_hands, fps=fps, stroke_rate_hz=args.stroke_rate,
+                                         dropout_probability=args.dropout, id_change_probability=.5,
+                                         fingers=args.fingers, seed=1)
+            listener = IHDController(midi_out=IHDNullMidiOut(),
+                                     clock=IHDClock(sync_to_host=False),
+                                     threaded=args.threaded,
+                                     detector_units=args.units,
+                                     tracking='fingers' if args.fingers else 'palm')
+            controller = IHDReplayController(simulator.frames(args.duration))
+            controller.add_listener(listener)
+            controller.run(speed=None)
+            controller.remove_listener(listener)
+            summary = controller.frame_stats.summary()
+            print('%4d  %5d  %7d  %8d  %7.3f  %6.3f  %6.3f  %d' % (fps, num_hands, simulator.num_strokes,
+                                                                   listener.gesture_detector.num_strokes,
+                                                                   summary['mean_ms'], summary['p99_ms'],
+                                                                   summary['max_ms'],
+                                                                   controller.num_missed_deadlines))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
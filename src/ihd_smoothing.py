@@ -0,0 +1,287 @@
+""" Adaptive smoothing of palm positions between hand array extraction and stroke detection
+
+Tracking jitter of the raw palm position sets the downward flag of the stroke detector and exceeds the minimum movement
+per frame, which is why the stroke thresholds (delta_height, delta_height_per_frame_threshold) are conservative.
+IHDHandSmoother filters the palm positions of all hands of a frame in place, so the thresholds can be lowered:
+    - 'one_euro': One-Euro filter (low-pass filter whose cutoff frequency increases with the speed of the hand, i.e.
+      strong smoothing at rest and little lag during a stroke), speed from the SDK palm velocity or from the
+      filtered position difference
+    - 'kalman': constant-velocity Kalman filter per axis with palm position and SDK palm velocity as measurements,
+      the filtered velocity replaces the palm velocity as well
+
+The filter state of all slots is preallocated, all hands of a frame are filtered in one vectorized step.
+
+Usage (stroke detection with raw and smoothed palm positions on simulated hands with tracking jitter):
+    python ihd_smoothing.py --jitter 2 --delta-height 15 10 6
+"""
+
+import sys
+import argparse
+
+import numpy as np
+
+from ihd_frame import HAND_ID, HAND_PALM_X, HAND_PALM_Z, HAND_VELOCITY_X, HAND_VELOCITY_Z, HAND_TIMESTAMP
+
+FREE_SLOT = -1
+SMOOTHING_METHODS = ('one_euro', 'kalman')
+
+
+class IHDOneEuroFilter:
+    """ One-Euro filters of palm positions, one per slot and axis """
+
+    def __init__(self, capacity=16, min_cutoff_hz=2., beta=.1, derivative_cutoff_hz=10., use_palm_velocity=True):
+        """ Initialize filters
+        Args:
+            capacity (int): Number of slots
+            min_cutoff_hz (float): Cutoff frequency at rest
+            beta (float): Increase of the cutoff frequency with speed (Hz per mm/s)
+            derivative_cutoff_hz (float): Cutoff frequency of the speed estimate from position differences
+            use_palm_velocity (bool): Use SDK palm velocity as speed instead of the position differences
+        """
+        self.min_cutoff_hz = min_cutoff_hz
+        self.beta = beta
+        self.derivative_cutoff_hz = derivative_cutoff_hz
+        self.use_palm_velocity = use_palm_velocity
+
+        self.positions = np.zeros((capacity, 3))
+        self.velocities = np.zeros((capacity, 3))
+        self.prev_timestamp = np.zeros(capacity)
+
+    @staticmethod
+    def smoothing_factor(cutoff_hz, dt):
+        """ Weight of the new sample of an exponential low-pass filter with given cutoff frequency """
+        return 1. / (1. + 1. / (2*np.pi*cutoff_hz*dt))
+
+    def init(self, slots, hands):
+        self.positions[slots] = hands[:, HAND_PALM_X:HAND_PALM_Z + 1]
+        self.velocities[slots] = hands[:, HAND_VELOCITY_X:HAND_VELOCITY_Z + 1] if self.use_palm_velocity else 0.
+        self.prev_timestamp[slots] = hands[:, HAND_TIMESTAMP]
+
+    def update(self, slots, hands):
+        """ Filter palm positions of the hand array rows (in place) """
+        positions = hands[:, HAND_PALM_X:HAND_PALM_Z + 1]
+        timestamps = hands[:, HAND_TIMESTAMP]
+        # frames with identical timestamps do not change the filter
+        dt = np.maximum((timestamps - self.prev_timestamp[slots])*1e-6, 1e-6)[:, None]
+        prev_positions = self.positions[slots]
+
+        if self.use_palm_velocity:
+            velocities = hands[:, HAND_VELOCITY_X:HAND_VELOCITY_Z + 1]
+        else:
+            alpha = self.smoothing_factor(self.derivative_cutoff_hz, dt)
+            velocities = self.velocities[slots]
+            velocities += alpha*((positions - prev_positions) / dt - velocities)
+            self.velocities[slots] = velocities
+
+        alpha = self.smoothing_factor(self.min_cutoff_hz + self.beta*np.abs(velocities), dt)
+        filtered = prev_positions + alpha*(positions - prev_positions)
+        self.positions[slots] = filtered
+        self.prev_timestamp[slots] = timestamps
+        positions[:] = filtered
+
+
+class IHDKalmanSmoother:
+    """ Constant-velocity Kalman filters of palm positions, one per slot and axis """
+
+    def __init__(self, capacity=16, acceleration_noise=1e5, position_noise_mm=1., velocity_noise=50.,
+                 use_palm_velocity=True):
+        """ Initialize filters
+        Args:
+            capacity (int): Number of slots
+            acceleration_noise (float): Spectral density of the white acceleration process noise (mm^2/s^3)
+            position_noise_mm (float): Standard deviation of the palm position measurement
+            velocity_noise (float): Standard deviation of the palm velocity measurement (mm/s)
+            use_palm_velocity (bool): Use SDK palm velocity as second measurement
+        """
+        self.acceleration_noise = acceleration_noise
+        self.position_variance = position_noise_mm**2
+        self.velocity_variance = velocity_noise**2
+        self.use_palm_velocity = use_palm_velocity
+
+        # state (position, velocity) and covariance (p00, p01, p11) per slot and axis
+        self.positions = np.zeros((capacity, 3))
+        self.velocities = np.zeros((capacity, 3))
+        self.P = np.zeros((3, capacity, 3))
+        self.prev_timestamp = np.zeros(capacity)
+
+    def init(self, slots, hands):
+        self.positions[slots] = hands[:, HAND_PALM_X:HAND_PALM_Z + 1]
+        self.velocities[slots] = hands[:, HAND_VELOCITY_X:HAND_VELOCITY_Z + 1] if self.use_palm_velocity else 0.
+        self.P[0, slots] = self.position_variance
+        self.P[1, slots] = 0.
+        self.P[2, slots] = self.velocity_variance if self.use_palm_velocity else 1e6
+        self.prev_timestamp[slots] = hands[:, HAND_TIMESTAMP]
+
+    def update(self, slots, hands):
+        """ Filter palm positions and velocities of the hand array rows (in place) """
+        timestamps = hands[:, HAND_TIMESTAMP]
+        dt = np.maximum((timestamps - self.prev_timestamp[slots])*1e-6, 0.)[:, None]
+        x = self.positions[slots]
+        v = self.velocities[slots]
+        p00, p01, p11 = self.P[:, slots]
+
+        # prediction with constant velocity and white acceleration noise
+        x += dt*v
+        q = self.acceleration_noise*dt
+        p00 = p00 + dt*(2*p01 + dt*p11) + q*dt*dt / 3.
+        p01 = p01 + dt*p11 + q*dt / 2.
+        p11 = p11 + q
+
+        # sequential scalar updates with position and velocity measurement (2x2 covariance in closed form)
+        s = p00 + self.position_variance
+        k0 = p00 / s
+        k1 = p01 / s
+        innovation = hands[:, HAND_PALM_X:HAND_PALM_Z + 1] - x
+        x += k0*innovation
+        v += k1*innovation
+        p00, p01, p11 = (1 - k0)*p00, (1 - k0)*p01, p11 - k1*p01
+
+        if self.use_palm_velocity:
+            s = p11 + self.velocity_variance
+            k0 = p01 / s
+            k1 = p11 / s
+            innovation = hands[:, HAND_VELOCITY_X:HAND_VELOCITY_Z + 1] - v
+            x += k0*innovation
+            v += k1*innovation
+            p00, p01, p11 = p00 - k0*p01, (1 - k1)*p01, (1 - k1)*p11
+
+        self.positions[slots] = x
+        self.velocities[slots] = v
+        self.P[:, slots] = (p00, p01, p11)
+        self.prev_timestamp[slots] = timestamps
+        hands[:, HAND_PALM_X:HAND_PALM_Z + 1] = x
+        hands[:, HAND_VELOCITY_X:HAND_VELOCITY_Z + 1] = v
+
+
+class IHDHandSmoother:
+    """ Smoothing stage for hand arrays (see ihd_frame.extract_hand_array) with one filter slot per hand ID """
+
+    def __init__(self, method='one_euro', capacity=16, **kwargs):
+        """ Initialize smoother
+        Args:
+            method (string): 'one_euro' (IHDOneEuroFilter) or 'kalman' (IHDKalmanSmoother)
+            capacity (int): Maximum number of simultaneously tracked hands, further hands are not smoothed
+            kwargs: Further arguments of the filter
+        """
+        if method == 'one_euro':
+            self.filter = IHDOneEuroFilter(capacity, **kwargs)
+        elif method == 'kalman':
+            self.filter = IHDKalmanSmoother(capacity, **kwargs)
+        else:
+            raise Exception('Non-valid smoothing method')
+        self.method = method
+        self.capacity = capacity
+        self.ids = np.full(capacity, FREE_SLOT, dtype=np.int64)
+        self.num_unsmoothed_hands = 0
+
+        # hand IDs (as bytes) and slots of the last frame, reused while the same hands are tracked
+        self.last_hand_ids = None
+        self.last_slots = None
+
+    def reset(self):
+        self.ids[:] = FREE_SLOT
+        self.last_hand_ids = None
+
+    def smooth(self, hand_array):
+        """ Filter palm positions of all hands (in place), filters of hands missing in the frame are restarted
+        Args:
+            hand_array (np.ndarray): Hands of current frame
+        Returns:
+            hand_array (np.ndarray): Same array with filtered palm positions
+        """
+        if len(hand_array) == 0:
+            self.reset()
+            return hand_array
+
+        hand_ids = hand_array[:, HAND_ID].tobytes()
+        if hand_ids == self.last_hand_ids:
+            self.filter.update(self.last_slots, hand_array)
+            return hand_array
+
+        ids = hand_array[:, HAND_ID].astype(np.int64)
+        match = self.ids[:, None] == ids[None, :]
+        is_new = ~match.any(axis=0)
+        slots = match.argmax(axis=0)
+        self.ids[~match.any(axis=1)] = FREE_SLOT
+
+        new_hands = np.flatnonzero(is_new)
+        free_slots = np.flatnonzero(self.ids == FREE_SLOT)
+        num_assigned = min(len(free_slots), len(new_hands))
+        slots[new_hands[:num_assigned]] = free_slots[:num_assigned]
+        self.ids[free_slots[:num_assigned]] = ids[new_hands[:num_assigned]]
+        if num_assigned < len(new_hands):
+            # table is full, remaining hands are passed through unfiltered
+            self.num_unsmoothed_hands += len(new_hands) - num_assigned
+            rows = np.concatenate((np.flatnonzero(~is_new), new_hands[:num_assigned]))
+            self.last_hand_ids = None
+        else:
+            rows = None
+            self.last_hand_ids = hand_ids
+            self.last_slots = slots
+
+        if num_assigned > 0:
+            self.filter.init(slots[new_hands[:num_assigned]], hand_array[new_hands[:num_assigned]])
+        if rows is None:
+            self.filter.update(slots, hand_array)
+        else:
+            hands = hand_array[rows]
+            self.filter.update(slots[rows], hands)
+            hand_array[rows] = hands
+        return hand_array
+
+
+def evaluate(frames, impacts, smoothing=None, delta_height=15, units='mm_per_frame', max_delay_sec=.15):
+    """ Run stroke detection over frames and compare detected strokes with the simulated impacts
+    Args:
+        frames (iterable): Frames (see ihd_simulator.IHDHandSimulator.frames)
+        impacts (np.ndarray): Hand ID and time (s) of simulated impacts (see IHDHandSimulator.impacts)
+        smoothing (string): Smoothing method, default: raw palm positions
+        delta_height (float): Stroke threshold of the detector (mm)
+        units (string): Units of stroke detector
+        max_delay_sec (float): Strokes up to this time before or after an impact of the same hand are matched
+    Returns:
+        results (dict): Number of impacts, detected and false strokes, detection delay (ms) after the impact
+    """
+    from ihd_evaluation import run_detector, score
+
+    spec = {'detector': 'table', 'smoothing': smoothing,
+            'kwargs': {'units': units, 'thresholds': {'delta_height': delta_height}}}
+    strokes, durations = run_detector(frames, spec)
+    onsets = np.column_stack((impacts[:, 1]*1e6, impacts[:, 0]))
+    results = score(strokes, onsets, durations, max_delay_sec*1e6)
+    return {'impacts': results['onsets'],
+            'detected': results['true_positives'],
+            'false_strokes': results['false_positives'],
+            'delay': results['onset_error']}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare stroke detection with raw and smoothed palm positions')
+    parser.add_argument('--hands', type=int, default=2, help='Number of simulated hands')
+    parser.add_argument('--fps', type=float, default=120.)
+    parser.add_argument('--duration', type=float, default=30., help='Simulated session duration in seconds')
+    parser.add_argument('--stroke-rate', type=float, default=3., help='Strokes per second per simulated hand')
+    parser.add_argument('--jitter', type=float, default=2., help='Tracking noise (standard deviation in mm)')
+    parser.add_argument('--delta-height', type=float, nargs='+', default=[15, 10, 6],
+                        help='Stroke thresholds of the detector (mm)')
+    parser.add_argument('--units', default='mm_per_frame', choices=['mm_per_frame', 'mm_per_sec'])
+    args = parser.parse_args()
+
+    from ihd_simulator import IHDHandSimulator
+
+    print('%-10s %6s %8s %8s %6s %26s' % ('smoothing', 'delta', 'impacts', 'detected', 'false',
+                                          'delay p5 / median / p95'))
+    for delta_height in args.delta_height:
+        for smoothing in (None,) + SMOOTHING_METHODS:
+            simulator = IHDHandSimulator(num_hands=args.hands, fps=args.fps, stroke_rate_hz=args.stroke_rate,
+                                         jitter_mm=args.jitter, seed=1)
+            frames = list(simulator.frames(args.duration))
+            results = evaluate(frames, simulator.impacts, smoothing=smoothing, delta_height=delta_height,
+                               units=args.units)
+            print('%-10s %6.1f %8d %8d %6d %8.1f / %6.1f / %6.1f ms' %
+                  ((smoothing or 'raw', delta_height, results['impacts'], results['detected'],
+                    results['false_strokes']) + tuple(results['delay'])))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,328 @@
+""" Fixed-capacity, array-backed state of all tracked hands for hand stroke detection
+
+IHDStrokeStateTable implements the stroke detection of IHDHandTrackingMemory (invisible_hand_drum.py) as structure of
+arrays with one slot per tracked hand: each state column (STATE_*) is a contiguous row of the state matrix. All hands
+of a frame are updated in one vectorized step (one gather, the update without per-hand branches, one scatter). The
+mean downward movement is read from the bounded ring buffers of IHDStreamingKinematics (ihd_kinematics.py).
+"""
+
+import numpy as np
+
+from ihd_frame import HAND_ID, HAND_PALM_Y, HAND_VELOCITY_Y, HAND_TIMESTAMP
+from ihd_hand_lifecycle import IHDHandLifecycle
+from ihd_kinematics import IHDStreamingKinematics
+
+FREE_SLOT = -1
+
+# state columns, flags are stored as 0. / 1.
+STATE_PREV_MAX_HEIGHT, STATE_PREV_HEIGHT, STATE_PREV_TIMESTAMP, STATE_PREV_FRAME_ID, STATE_DOWNWARDS, \
+    STATE_HIT_DETECTED, STATE_MIN_MOVEMENT_CHECK = range(7)
+NUM_STATE_COLUMNS = 7
+
+NO_STROKES = np.zeros(0, dtype=int)
+NO_VELOCITIES = np.zeros(0)
+
+
+class IHDStrokeStateTable:
+    """ Hand stroke detection state with one slot per tracked hand """
+
+    def __init__(self, capacity=16, units='mm_per_frame', use_palm_velocity=True, window_size=32,
+                 reassociate_hands=True, impact_predictor=None, thresholds=None, finger_groups=False):
+        """ Initialize state table
+        Args:
+            capacity (int): Maximum number of simultaneously tracked hands, further hands are ignored
+            units (string): Units of downward movement, 'mm_per_frame' or 'mm_per_sec'
+                            (see IHDHandTrackingMemory)
+            use_palm_velocity (bool): Use SDK palm velocity for units 'mm_per_sec' (otherwise height differences
+                                      normalized by timestamp differences)
+            window_size (int): Number of most recent frames of a downward motion used for the stroke velocity
+            reassociate_hands (bool): Keep lost hands and re-associate new hand IDs with them (see
+                                      IHDHandLifecycle), keep hand state across idle periods. Otherwise hands are
+                                      removed as soon as they are missing in a frame and on_idle() resets all hands
+                                      (as IHDHandTrackingMemory).
+            impact_predictor (IHDImpactPredictor): Forecast impacts of downward motions (see
+                                                   ihd_impact_predictor.py), default: reactive detection only
+            thresholds (dict): Thresholds which differ from the defaults of reset_all (e.g. {'delta_height': 8} with
+                               smoothed palm positions, see ihd_smoothing.py)
+            finger_groups (bool): Rows are fingertips (see ihd_frame.extract_finger_array), grouped by hand (finger
+                                  ID // 10). Per hand and frame only the fingertip with the largest drop strikes, the
+                                  other fingertips of the hand moving downwards along with it are marked as hit.
+        """
+        if units not in ('mm_per_frame', 'mm_per_sec'):
+            raise Exception('Non-valid detector units')
+        self.capacity = capacity
+        self.units = units
+        self.use_palm_velocity = use_palm_velocity
+        self.thresholds = thresholds if thresholds is not None else {}
+        self.finger_groups = finger_groups
+
+        self.ids = np.full(capacity, FREE_SLOT, dtype=np.int64)
+        self.state = np.zeros((NUM_STATE_COLUMNS, capacity))
+        # downward movement per frame (mm) or downward speed (mm/s) of the current downward motion
+        self.kinematics = IHDStreamingKinematics(capacity, window_size)
+        self.lifecycle = IHDHandLifecycle(capacity) if reassociate_hands else None
+
+        self.impact_predictor = impact_predictor
+        # strokes forecast in the last frame (slots, impact positions, velocities) and slots of cancelled forecasts
+        self.predicted_strokes = (NO_STROKES, np.zeros((0, 3)), NO_VELOCITIES)
+        self.cancelled_slots = NO_STROKES
+
+        self.num_ignored_hands = 0
+
+        # hand IDs (as bytes), frame ID and slots of the last frame, reused while the same hands are tracked
+        self.last_hand_ids = None
+        self.last_frame_id = None
+        self.last_slots = None
+
+        self.delta_height = None
+        self.delta_height_per_frame_threshold = None
+        self.downward_speed_threshold = None
+        self.max_downward_speed = None
+        self.max_downward_movement_per_frame = None
+        self.velocity_exponent = None
+        self.reset_all()
+
+    def reset_all(self):
+        self.ids[:] = FREE_SLOT
+        self.last_hand_ids = None
+        if self.lifecycle is not None:
+            self.lifecycle.reset()
+        self.delta_height = 15
+        self.delta_height_per_frame_threshold = 3
+        self.downward_speed_threshold = 300.
+        self.max_downward_speed = 1000.
+        # velocity curve: (mean downward movement / maximum)^velocity_exponent, clipped at 1
+        self.max_downward_movement_per_frame = 9.
+        self.velocity_exponent = 1.
+        for name, value in self.thresholds.items():
+            if not hasattr(self, name):
+                raise Exception('Non-valid threshold %s' % name)
+            setattr(self, name, value)
+
+    def on_idle(self):
+        """ Called if no hand stroke was detected for a while
+
+            Without re-association, all hands are reset. Otherwise the hands are kept and only the reference height
+            of hands which are not in a downward motion (or already hit) is set to their current height, so a stroke
+            in progress is not lost.
+        """
+        if self.lifecycle is None:
+            self.reset_all()
+            return
+        rebase = np.flatnonzero((self.ids != FREE_SLOT) &
+                                ((self.state[STATE_DOWNWARDS] == 0) | (self.state[STATE_HIT_DETECTED] > 0)))
+        self.state[STATE_PREV_MAX_HEIGHT, rebase] = self.state[STATE_PREV_HEIGHT, rebase]
+        self.state[STATE_DOWNWARDS, rebase] = 0
+        self.state[STATE_HIT_DETECTED, rebase] = 0
+        self.kinematics.reset_window(rebase)
+
+    @property
+    def num_tracked_hands(self):
+        return np.count_nonzero(self.ids != FREE_SLOT)
+
+    def assign_slots(self, hand_array, frame_id):
+        """ Find slots of tracked hands and allocate slots for new hands
+        Args:
+            hand_array (np.ndarray): Hands of current frame
+            frame_id (int): Frame counter
+        Returns:
+            slots (np.ndarray): Slot per hand, FREE_SLOT if table is full
+            is_new (np.ndarray): True for hands which were not tracked before
+        """
+        if self.lifecycle is None:
+            # remove hands whose IDs were not tracked in the previous frame
+            self.ids[(self.ids != FREE_SLOT) & (frame_id - self.state[STATE_PREV_FRAME_ID] > 1)] = FREE_SLOT
+
+        hand_ids = hand_array[:, HAND_ID].astype(np.int64)
+        match = self.ids[:, None] == hand_ids[None, :]
+        is_new = ~match.any(axis=0)
+        slots = match.argmax(axis=0)
+
+        if self.lifecycle is not None:
+            is_seen = match.any(axis=1)
+            self.lifecycle.mark_found(is_seen)
+            lost_slots = np.flatnonzero((self.ids != FREE_SLOT) & ~is_seen & ~self.lifecycle.is_lost)
+            if len(lost_slots) > 0:
+                self.lifecycle.mark_lost(lost_slots, self.state[STATE_PREV_TIMESTAMP, lost_slots])
+            for slot in self.lifecycle.expire(hand_array[0, HAND_TIMESTAMP]):
+                self.ids[slot] = FREE_SLOT
+            for hand_idx in np.flatnonzero(is_new):
+                slot = self.lifecycle.reassociate(hand_array[hand_idx])
+                if slot is not None:
+                    # new ID continues the state of a lost hand
+                    self.ids[slot] = hand_ids[hand_idx]
+                    slots[hand_idx] = slot
+                    is_new[hand_idx] = False
+
+        new_hands = np.flatnonzero(is_new)
+        if len(new_hands) > 0:
+            free_slots = np.flatnonzero(self.ids == FREE_SLOT)
+            num_assigned = min(len(free_slots), len(new_hands))
+            slots[new_hands[:num_assigned]] = free_slots[:num_assigned]
+            slots[new_hands[num_assigned:]] = FREE_SLOT
+            self.num_ignored_hands += len(new_hands) - num_assigned
+            self.ids[free_slots[:num_assigned]] = hand_ids[new_hands[:num_assigned]]
+        return slots, is_new
+
+    def detect_strokes(self, hand_array, frame_id):
+        """ Update state of all hands in frame and detect hand strokes
+        Args:
+            hand_array (np.ndarray): Hands of current frame (see ihd_frame.extract_hand_array)
+            frame_id (int): Frame counter
+        Returns:
+            stroke_rows (np.ndarray): Indices of hand array rows with detected hand stroke
+            velocities (np.ndarray): Stroke velocities between 0 and 1
+        """
+        if self.impact_predictor is not None:
+            self.predicted_strokes = (NO_STROKES, np.zeros((0, 3)), NO_VELOCITIES)
+            self.cancelled_slots = NO_STROKES
+        if len(hand_array) == 0:
+            return NO_STROKES, NO_VELOCITIES
+
+        hand_ids = hand_array[:, HAND_ID].tobytes()
+        if hand_ids == self.last_hand_ids and frame_id == self.last_frame_id + 1:
+            # same hands as in the previous frame (common case), all of them are tracked
+            slots = self.last_slots
+            is_new = None
+            rows = None
+            hands = hand_array
+        else:
+            slots, is_new = self.assign_slots(hand_array, frame_id)
+            rows = np.flatnonzero(slots != FREE_SLOT)
+            if len(rows) < len(slots):
+                # table is full
+                slots = slots[rows]
+                is_new = is_new[rows]
+                hands = hand_array[rows]
+                self.last_hand_ids = None
+            else:
+                rows = None
+                hands = hand_array
+                self.last_hand_ids = hand_ids
+                self.last_slots = slots
+        self.last_frame_id = frame_id
+        if self.lifecycle is not None:
+            self.lifecycle.update(slots, hands)
+        heights = hands[:, HAND_PALM_Y]
+
+        prev_max_height, prev_height, prev_timestamp, prev_frame_id, _, hit_detected, min_movement_check = \
+            self.state[:, slots]
+
+        # hands which are tracked for the first time start at their current height
+        if is_new is not None:
+            prev_max_height = np.where(is_new, heights, prev_max_height)
+        # direction of movement (upwards / downwards)
+        downwards = heights < prev_max_height
+
+        vertical_velocities = self.get_vertical_velocity(prev_height, prev_timestamp, hands, is_new)
+
+        # accumulate downward movement and check minimum movement per frame / speed,
+        # reset if hand goes upwards again
+        if self.units == 'mm_per_frame':
+            movement = prev_height - heights
+            if is_new is not None:
+                # hands re-associated after a tracking loss moved over all frames of the loss
+                movement /= np.maximum(frame_id - prev_frame_id, 1)
+            threshold = self.delta_height_per_frame_threshold
+        else:
+            movement = -vertical_velocities
+            threshold = self.downward_speed_threshold
+        self.kinematics.update(slots, movement, downwards)
+        min_movement_check = (min_movement_check > 0) | (downwards & (movement > threshold))
+        if is_new is not None:
+            min_movement_check &= ~is_new
+        hit_detected = downwards & (hit_detected > 0)
+        prev_max_height = np.where(downwards, prev_max_height, heights)
+
+        # detect hand stroke if three conditions are fulfilled (during current downwards movement):
+        #   1) overall vertical moving distance exceeds threshold
+        #   2) no drum stroke was detected so far
+        #   3) minimum velocity (vertical moving distance per frame / speed) was exceeded
+        strokes = (prev_max_height - heights > self.delta_height) & ~hit_detected & min_movement_check
+        if self.finger_groups and strokes.any():
+            strokes, inhibited = self.select_finger_strokes(hands, strokes, prev_max_height - heights, downwards)
+            # inhibited fingertips start from their current height as the striking one, so their upward movement
+            # ends the inhibition
+            prev_max_height = np.where(inhibited, heights, prev_max_height)
+            hit_detected |= inhibited
+        if strokes.any():
+            stroke_rows = np.flatnonzero(strokes)
+            velocities = self.compute_velocity(self.kinematics.mean(slots[stroke_rows]))
+            prev_max_height[stroke_rows] = heights[stroke_rows]
+            hit_detected |= strokes
+        else:
+            stroke_rows = NO_STROKES
+            velocities = NO_VELOCITIES
+
+        if self.impact_predictor is not None:
+            stroke_rows, velocities = self.predict_impacts(slots, hands, downwards, is_new, stroke_rows, velocities)
+
+        self.state[:STATE_PREV_FRAME_ID, slots] = (prev_max_height, heights, hands[:, HAND_TIMESTAMP])
+        self.state[STATE_PREV_FRAME_ID, slots] = frame_id
+        self.state[STATE_DOWNWARDS:, slots] = (downwards, hit_detected, min_movement_check)
+
+        return (stroke_rows if rows is None else rows[stroke_rows]), velocities
+
+    @staticmethod
+    def select_finger_strokes(fingers, strokes, drops, downwards):
+        """ Keep the fingertip with the largest drop per hand, the other fingertips of the hand moving downwards
+            (along with the hand) are inhibited
+        Args:
+            fingers (np.ndarray): Finger array rows
+            strokes (np.ndarray): Stroke condition per row
+            drops (np.ndarray): Drop from the top of the downward motion per row
+            downwards (np.ndarray): True if row is in a downward motion
+        Returns:
+            selected (np.ndarray): Selected strokes
+            inhibited (np.ndarray): Fingertips to be marked as hit
+        """
+        hand_ids = fingers[:, HAND_ID] // 10
+        selected = np.zeros_like(strokes)
+        inhibited = np.zeros_like(strokes)
+        for hand_id in np.unique(hand_ids[strokes]):
+            fingers_of_hand = hand_ids == hand_id
+            candidates = np.flatnonzero(fingers_of_hand & strokes)
+            selected[candidates[np.argmax(drops[candidates])]] = True
+            inhibited |= fingers_of_hand & downwards
+        inhibited &= ~selected
+        return selected, inhibited
+
+    def predict_impacts(self, slots, hands, downwards, is_new, stroke_rows, velocities):
+        """ Update impact predictor, reactive strokes of downward motions whose impact was forecast are dropped
+        Returns:
+            stroke_rows (np.ndarray): Rows with reactive strokes without forecast
+            velocities (np.ndarray): Stroke velocities of these rows
+        """
+        scheduled_rows, impact_positions, self.cancelled_slots = \
+            self.impact_predictor.update(slots, hands, downwards, is_new)
+        if len(scheduled_rows) > 0:
+            scheduled_slots = slots[scheduled_rows]
+            self.predicted_strokes = (scheduled_slots, impact_positions,
+                                      self.compute_velocity(self.kinematics.mean(scheduled_slots)))
+        if len(stroke_rows) > 0:
+            is_predicted = self.impact_predictor.on_strokes(slots[stroke_rows], hands[stroke_rows, HAND_TIMESTAMP])
+            stroke_rows = stroke_rows[~is_predicted]
+            velocities = velocities[~is_predicted]
+        return stroke_rows, velocities
+
+    def get_vertical_velocity(self, prev_heights, prev_timestamps, hands, is_new):
+        """ Vertical velocity (mm/s, positive upwards) from SDK palm velocity or from height difference and
+            timestamps (0 for hands tracked for the first time)
+        """
+        if self.use_palm_velocity:
+            return hands[:, HAND_VELOCITY_Y]
+        delta_times = (hands[:, HAND_TIMESTAMP] - prev_timestamps)*1e-6
+        valid = delta_times > 0
+        if is_new is not None:
+            valid &= ~is_new
+        return np.where(valid, (hands[:, HAND_PALM_Y] - prev_heights) / np.where(valid, delta_times, 1.), 0.)
+
+    def compute_velocity(self, mean_downward_movement):
+        """ Map mean downward movement per frame (mm) or mean downward speed (mm/s) to velocity between 0 and 1 """
+        if self.units == 'mm_per_sec':
+            velocities = np.minimum(1, mean_downward_movement / self.max_downward_speed)
+        else:
+            velocities = np.minimum(1, mean_downward_movement / self.max_downward_movement_per_frame)
+        if self.velocity_exponent != 1:
+            velocities = np.maximum(velocities, 0)**self.velocity_exponent
+        return velocities
@@ -0,0 +1,317 @@
+""" Hyperparameter sweep of stroke detection and velocity mapping on annotated recordings
+
+Grids or random samples of detector parameters are evaluated offline (see ihd_evaluation.py for recordings and onset
+annotations), so a parameter change does not need a live session with the device:
+    detection: delta_height, delta_height_per_frame_threshold (units 'mm_per_frame') or downward_speed_threshold
+               (units 'mm_per_sec'), reset_after_time_sec
+    velocity curve: max_downward_movement_per_frame or max_downward_speed, velocity_exponent (see compute_velocity)
+
+Each recording is converted once into a hand array (.npy) in the cache directory, which the worker processes open
+memory-mapped, i.e. all workers share the pages of the input. The velocity curve does not change detection, so the
+detector runs once per recording and combination of detection parameters (with a linear reference curve). Its strokes
+are cached on disk and the velocity curves of all samples are applied to the cached mean downward movements.
+
+Reported per sample are precision, recall, F1, median detection latency and velocity error (mean absolute difference
+to the annotated impact speed relative to its 95th percentile, clipped at 1). Samples which are not dominated in
+latency and F1 form the Pareto front.
+
+Usage:
+    python ihd_sweep.py sessions/*.ihdlog --processes 4
+    python ihd_sweep.py sessions/*.ihdlog --samples 200 --seed 1 --output sweep.csv
+"""
+
+import os
+import sys
+import zlib
+import argparse
+import itertools
+import multiprocessing
+
+import numpy as np
+
+from ihd_clock import host_time
+from ihd_frame import IHDFrameState
+from ihd_hand_log import IHDHandLogReader, convert_to_hand_log, NO_HAND_ID
+from ihd_evaluation import DEFAULT_DETECTOR, STROKE_VELOCITY, load_frames, onsets_fn, read_onsets, run_detector, \
+    score
+
+# parameter values of grid search
+DEFAULT_GRIDS = {'mm_per_frame': {'delta_height': [10, 15, 20],
+                                  'delta_height_per_frame_threshold': [2, 3, 4],
+                                  'reset_after_time_sec': [2.],
+                                  'max_downward_movement_per_frame': [6., 9., 12.],
+                                  'velocity_exponent': [.5, 1., 2.]},
+                 'mm_per_sec': {'delta_height': [10, 15, 20],
+                                'downward_speed_threshold': [200., 300., 400.],
+                                'reset_after_time_sec': [2.],
+                                'max_downward_speed': [600., 1000., 1400.],
+                                'velocity_exponent': [.5, 1., 2.]}}
+
+# parameter ranges (low, high) of random search
+RANDOM_RANGES = {'mm_per_frame': {'delta_height': (5, 25),
+                                  'delta_height_per_frame_threshold': (1, 6),
+                                  'reset_after_time_sec': (.5, 4.),
+                                  'max_downward_movement_per_frame': (3., 15.),
+                                  'velocity_exponent': (.3, 3.)},
+                 'mm_per_sec': {'delta_height': (5, 25),
+                                'downward_speed_threshold': (100., 600.),
+                                'reset_after_time_sec': (.5, 4.),
+                                'max_downward_speed': (300., 2000.),
+                                'velocity_exponent': (.3, 3.)}}
+
+VELOCITY_PARAMETERS = {'mm_per_frame': ('max_downward_movement_per_frame', 'velocity_exponent'),
+                       'mm_per_sec': ('max_downward_speed', 'velocity_exponent')}
+
+# maximum of the linear reference curve, velocities of the detector times this value are mean downward movements
+REFERENCE_SCALE = 1e9
+
+CSV_COLUMNS = ('precision', 'recall', 'f1', 'latency_ms', 'velocity_error')
+
+# recordings opened by this (worker) process
+_recordings = {}
+
+
+def grid_samples(grid):
+    """ All combinations of the parameter values of grid (dict of lists) """
+    names = sorted(grid.keys())
+    return [dict(zip(names, values)) for values in itertools.product(*[grid[name] for name in names])]
+
+
+def random_samples(ranges, num_samples, seed=None):
+    """ Uniform random samples from parameter ranges (dict of (low, high)), integer ranges give integers """
+    random_state = np.random.RandomState(seed)
+    samples = []
+    for _ in range(num_samples):
+        sample = {}
+        for name in sorted(ranges.keys()):
+            low, high = ranges[name]
+            if isinstance(low, int) and isinstance(high, int):
+                sample[name] = int(random_state.randint(low, high + 1))
+            else:
+                sample[name] = float(random_state.uniform(low, high))
+        samples.append(sample)
+    return samples
+
+
+def split_sample(sample, units):
+    """ Split sample into detection parameters (hashable key) and velocity curve parameters """
+    velocity_names = VELOCITY_PARAMETERS[units]
+    detection = tuple(sorted((name, value) for name, value in sample.items() if name not in velocity_names))
+    return detection, tuple(sample[name] for name in velocity_names)
+
+
+def cache_recording(fn, cache_dir):
+    """ Write hand array and frame index of recording to cache directory (if outdated)
+    Returns:
+        cache_fn (string): Common file name prefix of the cached arrays, unique per recording path (recordings with
+                           the same name in different directories do not share a cache entry)
+    """
+    path_hash = zlib.crc32(os.path.abspath(fn).encode('utf-8')) & 0xffffffff
+    cache_fn = os.path.join(cache_dir, '%s.%08x' % (os.path.basename(fn), path_hash))
+    hands_fn = cache_fn + '.hands.npy'
+    if os.path.exists(hands_fn) and os.path.getmtime(hands_fn) >= os.path.getmtime(fn):
+        return cache_fn
+    if fn.endswith('.ihdlog'):
+        reader = IHDHandLogReader(fn)
+    else:
+        convert_to_hand_log(load_frames(fn), cache_fn + '.ihdlog')
+        reader = IHDHandLogReader(cache_fn + '.ihdlog')
+    frame_starts = reader.frame_starts[:-1]
+    first_records = reader.records[frame_starts]
+    # frame ID, timestamp, first and end row in hand array (frames without hands have first == end)
+    frame_index = np.column_stack((first_records['frame_id'],
+                                   first_records['timestamp'],
+                                   frame_starts,
+                                   np.where(first_records['hand_id'] == NO_HAND_ID, frame_starts,
+                                            reader.frame_starts[1:])))
+    np.save(cache_fn + '.frames.npy', frame_index)
+    # written last, marks the cache entry as complete
+    np.save(hands_fn, reader.hand_array())
+    return cache_fn
+
+
+def cached_frames(cache_fn):
+    """ Generator over IHDFrameState objects with views on the memory-mapped hand array of a cached recording """
+    if cache_fn not in _recordings:
+        _recordings[cache_fn] = (np.load(cache_fn + '.hands.npy', mmap_mode='r'),
+                                 np.load(cache_fn + '.frames.npy'))
+    hand_array, frame_index = _recordings[cache_fn]
+    for frame_id, timestamp, first, end in frame_index:
+        yield IHDFrameState(int(frame_id), int(timestamp), hand_array=hand_array[first:end])
+
+
+def detection_cache_fn(cache_fn, onsets_file, detection, units, tolerance_us):
+    """ File name of cached detection results, the key includes the content of the onset annotations """
+    with open(onsets_file, 'rb') as f:
+        onsets_hash = zlib.crc32(f.read()) & 0xffffffff
+    key = '_'.join(['%s=%g' % item for item in detection] + [units, '%d' % tolerance_us, '%08x' % onsets_hash])
+    return '%s.%08x.strokes.npz' % (cache_fn, zlib.crc32(key.encode('ascii')) & 0xffffffff)
+
+
+def evaluate_detection(args):
+    """ Run detector with detection parameters on a cached recording (worker function)
+    Args:
+        args (tuple): Cache file name, onset file name, detection parameters, units, tolerance (us)
+    Returns:
+        results (dict): Counts, detection latencies (ms) and for every matched stroke the mean downward movement
+                        and the annotated impact speed
+    """
+    cache_fn, onsets_file, detection, units, tolerance_us = args
+    results_fn = detection_cache_fn(cache_fn, onsets_file, detection, units, tolerance_us)
+    # results of an earlier sweep, unless the recording or its annotations changed since
+    if os.path.exists(results_fn) and os.path.getmtime(results_fn) >= os.path.getmtime(cache_fn + '.hands.npy'):
+        cached = np.load(results_fn)
+        return dict((name, cached[name]) for name in cached.files)
+
+    detection = dict(detection)
+    thresholds = dict((name, value) for name, value in detection.items() if name != 'reset_after_time_sec')
+    thresholds[VELOCITY_PARAMETERS[units][0]] = REFERENCE_SCALE
+    thresholds['velocity_exponent'] = 1.
+    spec = dict(DEFAULT_DETECTOR, kwargs={'units': units, 'thresholds': thresholds},
+                reset_after_time_sec=detection.get('reset_after_time_sec', DEFAULT_DETECTOR['reset_after_time_sec']))
+    strokes, durations = run_detector(cached_frames(cache_fn), spec)
+    onsets = read_onsets(onsets_file)
+    scores = score(strokes, onsets, durations, tolerance_us)
+    is_matched = scores['stroke_indices'] >= 0
+    results = {'onsets': np.array(scores['onsets']),
+               'strokes': np.array(scores['strokes']),
+               'true_positives': np.array(scores['true_positives']),
+               'latencies': scores['latencies'],
+               'movements': strokes[scores['stroke_indices'][is_matched], STROKE_VELOCITY]*REFERENCE_SCALE,
+               'impact_speeds': onsets[is_matched, 2]}
+    np.savez(results_fn, **results)
+    return results
+
+
+def apply_velocity_curve(movements, max_movement, exponent):
+    """ Velocity of mean downward movements (see IHDStrokeStateTable.compute_velocity) """
+    velocities = np.minimum(1, movements / max_movement)
+    if exponent != 1:
+        velocities = np.maximum(velocities, 0)**exponent
+    return velocities
+
+
+def sample_results(all_results, velocity, reference_speed):
+    """ Metrics of one sample from the detection results of all recordings and its velocity curve parameters """
+    true_positives = sum([int(results['true_positives']) for results in all_results])
+    precision = true_positives / float(max(1, sum([int(results['strokes']) for results in all_results])))
+    recall = true_positives / float(max(1, sum([int(results['onsets']) for results in all_results])))
+    f1 = 2*precision*recall / (precision + recall) if precision + recall > 0 else 0.
+    latencies = np.concatenate([results['latencies'] for results in all_results] + [np.zeros(0)])
+    movements = np.concatenate([results['movements'] for results in all_results] + [np.zeros(0)])
+    impact_speeds = np.concatenate([results['impact_speeds'] for results in all_results] + [np.zeros(0)])
+    is_annotated = np.isfinite(impact_speeds)
+    if np.any(is_annotated):
+        velocities = apply_velocity_curve(movements[is_annotated], *velocity)
+        velocity_error = np.mean(np.abs(velocities - np.minimum(1, impact_speeds[is_annotated] / reference_speed)))
+    else:
+        velocity_error = np.nan
+    return {'precision': precision,
+            'recall': recall,
+            'f1': f1,
+            'latency_ms': np.median(latencies) if len(latencies) > 0 else np.nan,
+            'velocity_error': velocity_error}
+
+
+def pareto_front(results):
+    """ Indices of results not dominated in detection latency (lower) and F1 (higher), ordered by latency """
+    order = sorted(range(len(results)), key=lambda idx: (results[idx]['latency_ms'], -results[idx]['f1']))
+    front = []
+    best_f1 = -1.
+    for idx in order:
+        if np.isfinite(results[idx]['latency_ms']) and results[idx]['f1'] > best_f1:
+            front.append(idx)
+            best_f1 = results[idx]['f1']
+    return front
+
+
+def sweep(fns, samples, units='mm_per_frame', tolerance_sec=.1, processes=None, cache_dir=None):
+    """ Evaluate parameter samples on recordings in a process pool
+    Args:
+        fns (list): Capture file names (with annotation files)
+        samples (list): Parameter dicts (detection and velocity curve parameters)
+        units (string): Detector units
+        tolerance_sec (float): Maximum distance between detected stroke and annotated onset
+        processes (int): Number of worker processes, default: number of cores, 1: evaluate in this process
+        cache_dir (string): Directory of cached hand arrays and detection results, default: 'sweep_cache' next to
+                            the first recording
+    Returns:
+        results (list): Metrics per sample (see sample_results)
+    """
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(os.path.abspath(fns[0])), 'sweep_cache')
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    cache_fns = [cache_recording(fn, cache_dir) for fn in fns]
+
+    splits = [split_sample(sample, units) for sample in samples]
+    detections = sorted(set(detection for detection, _ in splits))
+    tasks = [(cache_fn, onsets_fn(fn), detection, units, tolerance_sec*1e6)
+             for detection in detections for fn, cache_fn in zip(fns, cache_fns)]
+    processes = processes if processes is not None else multiprocessing.cpu_count()
+    if processes <= 1 or len(tasks) <= 1:
+        task_results = [evaluate_detection(task) for task in tasks]
+    else:
+        pool = multiprocessing.Pool(min(processes, len(tasks)))
+        try:
+            task_results = pool.map(evaluate_detection, tasks, chunksize=max(1, len(fns)))
+        finally:
+            pool.close()
+            pool.join()
+
+    detection_results = dict((detection, task_results[idx*len(fns):(idx + 1)*len(fns)])
+                             for idx, detection in enumerate(detections))
+    impact_speeds = np.concatenate([read_onsets(onsets_fn(fn))[:, 2] for fn in fns])
+    impact_speeds = impact_speeds[np.isfinite(impact_speeds)]
+    reference_speed = np.percentile(impact_speeds, 95) if len(impact_speeds) > 0 else np.nan
+    results = []
+    for sample, (detection, velocity) in zip(samples, splits):
+        results.append(dict(sample_results(detection_results[detection], velocity, reference_speed), **sample))
+    return results
+
+
+def format_sample(results, names):
+    return ('%6.3f %6.3f %6.3f %7.1f %7.3f  ' % tuple(results[column] for column in CSV_COLUMNS) +
+            ' '.join(['%s=%g' % (name, results[name]) for name in names]))
+
+
+def write_csv(fn, results, names):
+    with open(fn, 'w') as f:
+        f.write(','.join(list(CSV_COLUMNS) + names) + '\n')
+        for sample in results:
+            f.write(','.join(['%g' % sample[column] for column in list(CSV_COLUMNS) + names]) + '\n')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Sweep stroke detection and velocity parameters on annotated '
+                                                 'recordings')
+    parser.add_argument('recordings', nargs='+', help='Capture files with <capture>.onsets annotation files')
+    parser.add_argument('--units', default='mm_per_frame', choices=['mm_per_frame', 'mm_per_sec'])
+    parser.add_argument('--samples', type=int, help='Number of random samples, default: grid search')
+    parser.add_argument('--seed', type=int, help='Seed of random samples')
+    parser.add_argument('--tolerance', type=float, default=.1, help='Maximum onset error (s) of a detected stroke')
+    parser.add_argument('--processes', type=int, help='Number of worker processes, default: number of cores')
+    parser.add_argument('--cache', help='Cache directory, default: sweep_cache next to the first recording')
+    parser.add_argument('--output', help='Write results of all samples to this CSV file')
+    args = parser.parse_args()
+
+    if args.samples is not None:
+        samples = random_samples(RANDOM_RANGES[args.units], args.samples, args.seed)
+    else:
+        samples = grid_samples(DEFAULT_GRIDS[args.units])
+    names = sorted(samples[0].keys())
+
+    start = host_time()
+    results = sweep(args.recordings, samples, args.units, args.tolerance, args.processes, args.cache)
+    print('Pareto front (detection latency vs. F1) of %d samples on %d recordings (%.1f s):' %
+          (len(samples), len(args.recordings), host_time() - start))
+    print('%6s %6s %6s %7s %7s  %s' % ('prec', 'recall', 'F1', 'lat_ms', 'vel_err', 'parameters'))
+    for idx in pareto_front(results):
+        print(format_sample(results[idx], names))
+    print('best velocity curve: ' + format_sample(min(results, key=lambda sample: sample['velocity_error']), names))
+    if args.output:
+        write_csv(args.output, results, names)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,253 @@
+""" Voice lifecycle of MIDI notes: note-off scheduling, retrigger and flush
+
+Every note-on starts a voice per (channel, pitch) whose note-off is due after the gate length. Pending note-offs are
+kept in a heap ordered by due time, so each update only visits the voices which are due. A pitch which is still
+sounding when it is played again is retriggered: the running voice is ended with a note-off before the new note-on,
+the note-off of the earlier note is dropped (generation counter) and cannot cut the new note. On shutdown, all
+sounding voices are ended; with the output thread, notes queued ahead are dropped first, so no note-on is sent after
+the final note-offs.
+
+With the output thread, note-offs are queued up to lookahead_sec before their time. The voice is kept until its
+note-off time, so a pitch played again within the lookahead is still retriggered, and the queued note-off of the
+earlier note is cancelled in the output thread instead of cutting the new note.
+
+Simultaneous notes (note_ons) are sent in one bulk call, with the output thread they are queued under a single lock.
+Messages are built per note as 3-element lists (see ihd_midi_messages.py).
+
+Usage:
+    voices = IHDVoiceManager(midi_out, gate_sec=.3)
+    voices.note_on(pitch, velocity, curr_time)
+    voices.note_ons([(pitch, velocity, gate_sec), ...], curr_time)
+    voices.update(curr_time, lookahead_sec)
+    voices.flush()
+
+Check of retriggers within the lookahead of the output thread (real time, about 1 s):
+    python ihd_voices.py
+"""
+
+import sys
+import time
+import heapq
+
+from ihd_clock import host_time
+from ihd_midi_messages import NOTE_OFF, NOTE_ON, CONTROL_CHANGE, ALL_NOTES_OFF
+
+
+class IHDVoiceManager:
+    """ Sounding notes per channel and pitch with scheduled note-offs """
+
+    def __init__(self, midi_out, gate_sec=.3, scheduler=None):
+        """ Initialize voice manager
+        Args:
+            midi_out (rtmidi.MidiOut): MIDI output (send_message)
+            gate_sec (float): Default time between note-on and note-off
+            scheduler (IHDMidiScheduler): Output thread, messages are queued with their time instead of being sent
+                                          to midi_out immediately
+        """
+        self.midi_out = midi_out
+        self.gate_sec = gate_sec
+        self.scheduler = scheduler
+
+        # (channel, pitch) -> generation of the sounding voice
+        self.voices = {}
+        self.generation = 0
+        # heap of (note-off time, generation, channel, pitch)
+        self.note_offs = []
+        # note-offs queued ahead in the output thread, heap of (note-off time, generation, channel, pitch) and
+        # (channel, pitch) -> sequence number of the queued note-off (see IHDMidiScheduler.cancel)
+        self.queued_note_offs = []
+        self.queued_sequences = {}
+        self.channels = set()
+
+        self.num_note_ons = 0
+        self.num_note_offs = 0
+        self.num_retriggers = 0
+        self.max_voices = 0
+
+    def __len__(self):
+        return len(self.voices)
+
+    def note_on(self, pitch, velocity, curr_time, channel=0, gate_sec=None):
+        """ Start voice, retrigger if pitch is sounding
+        Args:
+            pitch (int): MIDI pitch
+            velocity (int): MIDI velocity (1 .. 127)
+            curr_time (float): Frame time (s) of the note
+            channel (int): MIDI channel (0 .. 15)
+            gate_sec (float): Time until note-off, default: gate_sec of voice manager
+        """
+        if self.add_voice(channel, pitch, curr_time, gate_sec):
+            self.send([NOTE_OFF | channel, pitch, 0], curr_time)
+        self.send([NOTE_ON | channel, pitch, velocity], curr_time)
+
+    def note_ons(self, notes, curr_time, channel=0):
+        """ Start voices of simultaneous notes, messages are sent in one bulk call
+        Args:
+            notes (list): List of (pitch, velocity, gate_sec), gate_sec None: gate_sec of voice manager
+            curr_time (float): Frame time (s) of the notes
+            channel (int): MIDI channel (0 .. 15)
+        """
+        messages = []
+        for pitch, velocity, gate_sec in notes:
+            if self.add_voice(channel, pitch, curr_time, gate_sec):
+                messages.append([NOTE_OFF | channel, pitch, 0])
+            messages.append([NOTE_ON | channel, pitch, velocity])
+        if self.scheduler is not None:
+            self.scheduler.schedule_all(messages, curr_time)
+        else:
+            send_message = self.midi_out.send_message
+            for message in messages:
+                send_message(message)
+
+    def add_voice(self, channel, pitch, curr_time, gate_sec):
+        """ Start voice and schedule its note-off
+        Returns:
+            is_retrigger (bool): Pitch was sounding, its voice has to be ended before the note-on
+        """
+        key = (channel, pitch)
+        is_retrigger = key in self.voices
+        if is_retrigger:
+            sequence = self.queued_sequences.pop(key, None)
+            if sequence is not None and self.scheduler.cancel(sequence):
+                # note-off of the running voice was queued ahead, it would cut the new note
+                self.num_note_offs -= 1
+            self.num_note_offs += 1
+            self.num_retriggers += 1
+        self.num_note_ons += 1
+
+        self.generation += 1
+        self.voices[key] = self.generation
+        heapq.heappush(self.note_offs, (curr_time + (gate_sec if gate_sec is not None else self.gate_sec),
+                                        self.generation, channel, pitch))
+        self.channels.add(channel)
+        self.max_voices = max(self.max_voices, len(self.voices))
+        return is_retrigger
+
+    def send(self, message, send_time):
+        if self.scheduler is not None:
+            self.scheduler.schedule(message, send_time)
+        else:
+            self.midi_out.send_message(message)
+
+    def update(self, curr_time, lookahead_sec=0.):
+        """ Send note-offs which are due
+        Args:
+            curr_time (float): Frame time (s)
+            lookahead_sec (float): With output thread, note-offs which are due until curr_time + lookahead_sec are
+                                   queued at their time
+        Returns:
+            num_note_offs (int): Number of sent / queued note-offs
+        """
+        # voices whose queued note-off is due now
+        while self.queued_note_offs and self.queued_note_offs[0][0] <= curr_time:
+            _, generation, channel, pitch = heapq.heappop(self.queued_note_offs)
+            if self.voices.get((channel, pitch)) == generation:
+                del self.voices[(channel, pitch)]
+                del self.queued_sequences[(channel, pitch)]
+
+        num_note_offs = 0
+        end_time = curr_time + lookahead_sec
+        while self.note_offs and self.note_offs[0][0] <= end_time:
+            note_off = heapq.heappop(self.note_offs)
+            note_off_time, generation, channel, pitch = note_off
+            key = (channel, pitch)
+            # voice was retriggered since
+            if self.voices.get(key) != generation:
+                continue
+            message = [NOTE_OFF | channel, pitch, 0]
+            if self.scheduler is not None and note_off_time > curr_time:
+                # queued ahead, the voice sounds until its note-off time
+                self.queued_sequences[key] = self.scheduler.schedule(message, note_off_time)
+                heapq.heappush(self.queued_note_offs, note_off)
+            else:
+                del self.voices[key]
+                self.send(message, note_off_time)
+            num_note_offs += 1
+        self.num_note_offs += num_note_offs
+        return num_note_offs
+
+    def flush(self, all_notes_off=True):
+        """ End all sounding voices (shutdown)
+        Args:
+            all_notes_off (bool): Additionally send 'all notes off' on every used channel
+        """
+        output = self.scheduler if self.scheduler is not None else self.midi_out
+        if self.scheduler is not None:
+            # note-ons queued ahead would be sent after the note-offs below (when the output thread is stopped) and
+            # hang, queued notes are dropped and every voice gets its note-off now
+            for message in self.scheduler.drop_pending(lambda message: message[0] & 0xF0 in (NOTE_OFF, NOTE_ON)):
+                if message[0] & 0xF0 == NOTE_ON:
+                    self.num_note_ons -= 1
+                else:
+                    self.num_note_offs -= 1
+        for channel, pitch in sorted(self.voices.keys()):
+            output.send_message([NOTE_OFF | channel, pitch, 0])
+            self.num_note_offs += 1
+        if all_notes_off:
+            for channel in sorted(self.channels):
+                output.send_message([CONTROL_CHANGE | channel, ALL_NOTES_OFF, 0])
+        self.voices = {}
+        self.note_offs = []
+        self.queued_note_offs = []
+        self.queued_sequences = {}
+
+    def report(self):
+        return '%d note-ons, %d note-offs, %d retriggers, max %d voices, %d sounding' % (self.num_note_ons,
+                                                                                       self.num_note_offs,
+                                                                                       self.num_retriggers,
+                                                                                       self.max_voices,
+                                                                                       len(self.voices))
+
+
+class IHDRecordingMidiOut:
+    """ MIDI output which records the messages with their host send time """
+
+    def __init__(self):
+        self.messages = []
+
+    def send_message(self, message):
+        self.messages.append((host_time(), list(message)))
+
+
+def check_retrigger_in_lookahead(gate_sec=.3, lookahead_sec=.05, frame_sec=.01, retrigger_sec=.28):
+    """ Play a pitch again after retrigger_sec, when the note-off of the first note is queued already, and check
+        that the second note sounds for its whole gate length
+    Returns:
+        messages (list): List of (send time relative to the first note in s, message)
+        success (bool): True if the second note is not cut by the note-off of the first one
+    """
+    from ihd_midi_scheduler import IHDMidiScheduler
+
+    midi_out = IHDRecordingMidiOut()
+    scheduler = IHDMidiScheduler(midi_out)
+    voices = IHDVoiceManager(midi_out, gate_sec=gate_sec, scheduler=scheduler)
+    scheduler.start()
+    start_time = host_time() + .05
+    retrigger_frame = int(round(retrigger_sec / frame_sec))
+    for frame_idx in range(int(round((retrigger_sec + gate_sec) / frame_sec)) + 10):
+        curr_time = start_time + frame_idx*frame_sec
+        time.sleep(max(0., curr_time - host_time()))
+        voices.update(curr_time, lookahead_sec)
+        if frame_idx in (0, retrigger_frame):
+            voices.note_on(60, 100, curr_time)
+    scheduler.stop()
+
+    messages = [(send_time - start_time, message) for send_time, message in midi_out.messages]
+    note_off_times = [send_time for send_time, message in messages if message[0] & 0xF0 == NOTE_OFF]
+    retrigger_time = retrigger_frame*frame_sec
+    # the retrigger note-off at the second note and the note-off of the second note after its gate length
+    success = len(note_off_times) == 2 and abs(note_off_times[0] - retrigger_time) < .005 and \
+        note_off_times[1] > retrigger_time + gate_sec - .005
+    return messages, success
+
+
+def main():
+    messages, success = check_retrigger_in_lookahead()
+    for send_time, message in messages:
+        print('%7.3f s  %s' % (send_time, message))
+    print('retrigger within lookahead: %s' % ('ok' if success else 'FAILED, note cut by earlier note-off'))
+    return 0 if success else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -14,20 +14,52 @@ import rtmidi
 import time
 import numpy as np
 
+from ihd_clock import IHDClock, host_time
+from ihd_frame import IHDFrameState, IHDHandArrayExtractor, HAND_ID, HAND_IS_LEFT, HAND_PALM_X, HAND_PALM_Z, \
+    HAND_VELOCITY_X, HAND_VELOCITY_Z, HAND_TIMESTAMP
+from ihd_hand_lifecycle import IHDLostHands
+from ihd_handoff import IHDFrameWorker
+from ihd_images import IHDImageCaptureWriter
+from ihd_impact_predictor import IHDImpactPredictor
+from ihd_kinematics import IHDMovementWindow
+from ihd_pad_layout import IHDPadLayout, IHDPadLayoutWatcher, load_pad_layout, NO_PITCH
+from ihd_scales import IHDScale, create_scale
+from ihd_midi_scheduler import IHDMidiScheduler
+from ihd_voices import IHDVoiceManager
+from ihd_midi_messages import level_to_velocity
+from ihd_sampler import CLICK_SAMPLES
+from ihd_smoothing import IHDHandSmoother
+from ihd_stroke_table import IHDStrokeStateTable
+
 
 class IHDController(Leap.Listener):
     """ Main controller class """
 
-    def __init__(self):
+    def __init__(self, midi_out=None, threaded=True, clock=None, detector_units='mm_per_frame', image_capture_fn=None,
+                 predict_impacts=False, latency_sec=.03, smoothing=None, thresholds=None, tracking='palm',
+                 pad_positions=None, pad_layout_fn=None, scales=None, output_thread=False, lookahead_sec=.05,
+                 sampler=None):
         Leap.Listener.__init__(self)
 
-        self.player = IHDPlayer(self)
-        self.gesture_detector = IHDGestureDetector(self)
+        # common timebase derived from device frame timestamps, all timing uses the frame time from process_frame
+        self.clock = clock if clock is not None else IHDClock()
+
+        # optional output thread which sends MIDI messages at their frame time (or in-process sampler instead of MIDI),
+        # clicks and notes of the computer player are scheduled lookahead_sec ahead at the exact beat time
+        self.player = IHDPlayer(self, midi_out=midi_out, scales=scales, output_thread=output_thread,
+                                lookahead_sec=lookahead_sec, sampler=sampler)
+        # optional forecast of stroke impacts, notes are sent latency_sec before the impact
+        impact_predictor = IHDImpactPredictor(latency_sec=latency_sec) if predict_impacts else None
+        self.gesture_detector = IHDGestureDetector(self, units=detector_units, impact_predictor=impact_predictor,
+                                                   smoothing=smoothing, thresholds=thresholds, tracking=tracking,
+                                                   pad_positions=pad_positions,
+                                                   pad_layout=load_pad_layout(pad_layout_fn) if pad_layout_fn else None)
 
         self.silence_in_frames = 2
         self.silent_frames = 0
 
-        self.start_time = time.time()
+        # frame time of first processed frame
+        self.start_time = None
 
         self.tempo_bpm = 110.
         self.numerator = 8
@@ -54,11 +86,35 @@ class IHDController(Leap.Listener):
 
         self.num_random_notes = 5
 
+        # process frames in worker thread, the Leap callback only hands over a snapshot of the hand state (and of the
+        # fingertips with finger tracking), or the frame itself if the per-hand memory reads its hand objects
+        self.frame_worker = IHDFrameWorker(self.process_frame, fingers=tracking == 'fingers',
+                                           frame_references=self.gesture_detector.per_hand_access) \
+            if threaded else None
 
+        # frames skipped between two callbacks are recovered from the controller frame history
+        self.last_frame_id = None
+        self.max_catch_up_frames = 10
+        self.num_recovered_frames = 0
+        self.num_lost_frames = 0
 
+        # optional capture of IR images alongside hand tracking
+        self.image_writer = IHDImageCaptureWriter(image_capture_fn) if image_capture_fn is not None else None
+
+        # layout file is reloaded while running whenever it is modified
+        self.layout_watcher = IHDPadLayoutWatcher(pad_layout_fn, self.gesture_detector.set_pad_layout) \
+            if pad_layout_fn else None
 
     def on_init(self, controller):
         print "Initialized"
+        if self.player.scheduler is not None:
+            self.player.scheduler.start()
+        if self.player.sampler is not None:
+            self.player.sampler.start()
+        if self.frame_worker is not None:
+            self.frame_worker.start()
+        if self.layout_watcher is not None:
+            self.layout_watcher.start()
 
     def on_connect(self, controller):
         print "Connected"
@@ -69,6 +125,9 @@ class IHDController(Leap.Listener):
         # controller.enable_gesture(Leap.Gesture.TYPE_SCREEN_TAP)
         controller.enable_gesture(Leap.Gesture.TYPE_SWIPE)
 
+        if self.image_writer is not None:
+            controller.set_policy(Leap.Controller.POLICY_IMAGES)
+
         # todo place parameters to class arguments
         controller.config.set("Gesture.KeyTap.MinDownVelocity", 20)# 40.0)
         controller.config.set("Gesture.KeyTap.HistorySeconds", .1) #.2)
@@ -84,31 +143,114 @@ class IHDController(Leap.Listener):
         print "Disconnected"
 
     def on_exit(self, controller):
+        if self.layout_watcher is not None:
+            self.layout_watcher.stop()
+        if self.frame_worker is not None:
+            self.frame_worker.stop()
+            print(self.frame_worker.report())
+        # no hanging notes on the synthesizer
+        self.player.voices.flush()
+        print(self.player.voices.report())
+        if self.player.scheduler is not None:
+            self.player.scheduler.stop()
+            print(self.player.scheduler.report())
+        if self.player.sampler is not None:
+            self.player.sampler.stop()
+            print(self.player.sampler.report())
+        print('Clock drift %.1f ppm, %d resyncs' % (self.clock.drift_ppm, self.clock.num_resyncs))
+        print('%d frames recovered from history, %d frames lost' % (self.num_recovered_frames, self.num_lost_frames))
+        lifecycle = getattr(self.gesture_detector.hand_memory, 'lifecycle', None)
+        if lifecycle is not None:
+            print(lifecycle.report())
+        if self.gesture_detector.impact_predictor is not None:
+            print(self.gesture_detector.impact_predictor.report())
+        if self.image_writer is not None:
+            self.image_writer.close()
+            print(self.image_writer.report())
         print "Exited"
 
     def on_frame(self, controller):
         """ Callback which is called every frame with leap motion controller data """
 
-        curr_time = time.time()
+        arrival_time = host_time()
 
         # get current data from motion sensor
         frame = controller.frame()
 
+        if frame.id == self.last_frame_id:
+            return
+
+        # process frames which were skipped since the last callback in order
+        if self.last_frame_id is not None and frame.id > self.last_frame_id + 1:
+            self.catch_up(controller, frame.id, arrival_time)
+        self.last_frame_id = frame.id
+
+        self.handle_frame(frame, arrival_time)
+
+        # images are copied here as the image buffers are only valid during the callback
+        if self.image_writer is not None:
+            for image in frame.images:
+                self.image_writer.submit(image, frame.id, frame.timestamp)
+
+    def handle_frame(self, frame, arrival_time):
+        """ Process frame directly or hand it over to the worker thread """
+        if self.frame_worker is not None:
+            # with frame references, the worker reads the swipes of the frame
+            self.frame_worker.submit(frame, arrival_time,
+                                     IHDTools.get_swipes(frame) if not self.frame_worker.frame_references else ())
+        else:
+            self.process_frame(frame, arrival_time)
+
+    def catch_up(self, controller, frame_id, arrival_time):
+        """ Recover frames between last processed frame and current frame from controller frame history
+            (callbacks are skipped if the process stalls, e.g. for garbage collection or terminal output).
+            At most max_catch_up_frames of the most recent missing frames are processed.
+        """
+        num_missing = frame_id - self.last_frame_id - 1
+        num_catch_up = min(num_missing, self.max_catch_up_frames)
+        self.num_lost_frames += num_missing - num_catch_up
+
+        for history in range(num_catch_up, 0, -1):
+            frame = controller.frame(history)
+            if not frame.is_valid or frame.id <= self.last_frame_id or frame.id >= frame_id:
+                self.num_lost_frames += 1
+                continue
+            self.handle_frame(frame, arrival_time)
+            self.num_recovered_frames += 1
+
+    def process_frame(self, frame, arrival_time):
+        """ Detect strokes in frame and update player and metronome (in worker thread if enabled) """
+
+        # one timestamp per frame for all subsystems
+        curr_time = self.clock.frame_time(frame.timestamp, arrival_time)
+        if self.start_time is None:
+            self.start_time = curr_time
+            if not self.clock.sync_to_host:
+                # frame time is device time, map onto host time of the output thread / sampler
+                for output in (self.player.scheduler, self.player.sampler):
+                    if output is not None:
+                        output.time_offset = arrival_time - curr_time
+
         # hand stroke detection
         command = self.gesture_detector.analyze_frame(frame, curr_time)
 
         if command is not None:
-            self.player.play(command)
+            self.player.play(command, curr_time)
+
+        # notes of forecast strokes which are due in this frame
+        due_commands = self.gesture_detector.pop_due_commands()
+        if due_commands:
+            self.player.play_all(due_commands, curr_time)
 
         # start metronome after initial delay
-        if curr_time > self.start_time_first_beat and not self.metronome_started:
+        if curr_time - self.start_time > self.start_time_first_beat and not self.metronome_started:
             print('METRONOME STARTED')
             self.metronome_started = True
             self.metronome_start_time = curr_time
 
         if self.metronome_started:
             if self.last_bar_start_time is not None:
-                curr_time_in_beat = curr_time - self.last_bar_start_time
+                curr_time_in_beat = curr_time + self.player.lookahead_sec - self.last_bar_start_time
                 beats_passed = self.beat_times_in_bar < curr_time_in_beat
                 self.beats_passed[beats_passed] = True
 
@@ -116,13 +258,16 @@ class IHDController(Leap.Listener):
             # self.beats_passed = np.zeros(self.numerator, dtype=bool)
 
         if self.metronome_started:
-            self.check_for_beat()
+            self.check_for_beat(curr_time)
 
-        self.player.update()
+        self.player.update(curr_time)
 
     def quantize_user_played_notes(self):
-        self.quant_mat = np.zeros((7, self.numerator*2))
+        self.quant_mat = np.zeros((self.gesture_detector.pad_layout.num_pads, self.numerator*2))
         for note in self.user_played_notes:
+            # pads of a previous layout
+            if note[1] >= len(self.quant_mat):
+                continue
             # print("%f mod %f = %f" % (note[0], self.beat_duration, note[0] / self.beat_duration))
             self.quant_mat[note[1], int(note[0] / (.5*self.beat_duration))] = 1
 
@@ -133,12 +278,12 @@ class IHDController(Leap.Listener):
             c = int(np.floor(np.random.random()*nc))
             self.quant_mat[r, c] = np.logical_not(self.quant_mat[r, c])
 
-    def play_click(self):
+    def play_click(self, curr_time):
         """ Play click sound depending on beat position """
         command = IHDPlayCommand(instrument='click', level=0.8)
         if self.beat_idx == 0:
             self.bar_number += 1
-            self.last_bar_start_time = time.time()
+            self.last_bar_start_time = curr_time
             self.beats_passed = np.zeros(self.numerator*2, dtype=bool)
             # switch between user and computer
             if self.bar_number % 2 == 1:
@@ -153,17 +298,19 @@ class IHDController(Leap.Listener):
         else:
             command.note_id = 1
 
-        self.player.play(command)
+        self.player.play(command, curr_time)
 
         self.beat_idx += 1
         self.beat_idx %= self.numerator
 
-    def check_for_beat(self):
-        """ Check if current frame time is close to beat time and play click sound if so"""
-        curr_time = time.time() - self.metronome_start_time
-        curr_time_mod = curr_time % self.beat_duration
+    def check_for_beat(self, curr_time):
+        """ Check if current frame time is close to beat time and play click sound if so (with output thread or
+            sampler, lookahead_sec ahead at the beat time)
+        """
+        lookahead_sec = self.player.lookahead_sec
+        curr_time_mod = (curr_time + lookahead_sec - self.metronome_start_time) % self.beat_duration
         if curr_time_mod < self.prev_time_mod:
-            self.play_click()
+            self.play_click(curr_time + lookahead_sec - curr_time_mod if lookahead_sec > 0 else curr_time)
         self.prev_time_mod = curr_time_mod
 
 
@@ -175,42 +322,110 @@ class IHDHandTracking:
                  position,
                  downwards=False,
                  hit_detected=False,
-                 min_movement_per_frame_check=None):
+                 min_movement_per_frame_check=None,
+                 timestamp=None,
+                 window_size=32,
+                 is_left=None):
         self.prev_max_height = height
         self.prev_frame_id = frame_id
         self.prev_position = position
+        self.prev_timestamp = timestamp
         self.downwards = downwards
         self.hit_detected = hit_detected
         self.min_movement_per_frame_check = min_movement_per_frame_check
-        self.all_distance_per_frame = []
+        self.is_left = is_left
+        # downward movement per frame (mm) or downward speed (mm/s) of the most recent frames of the current downward
+        # movement (ring buffer with running sum, see ihd_kinematics.py)
+        self.recent_distance_per_frame = IHDMovementWindow(window_size)
 
 
 class IHDHandTrackingMemory:
-    """ Class implements memory over hand position to detect hand strokes from tracking data """
+    """ Class implements memory over hand position to detect hand strokes from tracking data
 
-    def __init__(self):
+        Minimum downward velocity and stroke velocity are measured either
+            - in mm per frame (units='mm_per_frame'), which depends on the current Leap frame rate, or
+            - in mm/s (units='mm_per_sec') from the palm velocity reported by the SDK or from the height difference
+              between frames normalized by their timestamp difference, which is independent of the frame rate
+
+        With reassociate_hands, hands which are missing in a frame are kept for a while and a new hand ID is
+        re-associated with a lost hand nearby (see ihd_hand_lifecycle.py), and the hands are kept across idle periods,
+        as in IHDStrokeStateTable. Otherwise hands are removed as soon as they are missing in a frame and on_idle()
+        resets all hands.
+    """
+
+    def __init__(self, units='mm_per_frame', use_palm_velocity=True, window_size=32, thresholds=None,
+                 reassociate_hands=True):
         self.memory = None
         self.delta_height = None
         self.delta_height_per_frame_threshold = None
+        self.downward_speed_threshold = None
+        self.max_downward_speed = None
+        self.max_downward_movement_per_frame = None
+        self.velocity_exponent = None
+        if units not in ('mm_per_frame', 'mm_per_sec'):
+            raise Exception('Non-valid detector units')
+        self.units = units
+        self.use_palm_velocity = use_palm_velocity
+        # number of most recent frames of a downward motion used for the stroke velocity
+        self.window_size = window_size
+        # thresholds which differ from the defaults of reset_all (see IHDStrokeStateTable)
+        self.thresholds = thresholds if thresholds is not None else {}
+        # lost hands (requires device timestamps)
+        self.lifecycle = IHDLostHands() if reassociate_hands else None
         self.reset_all()
 
     def reset_all(self):
         self.memory = {}
+        if self.lifecycle is not None:
+            self.lifecycle.reset()
         self.delta_height = 15
         self.delta_height_per_frame_threshold = 3
-
-    def check_for_hand_stroke(self, _id, position, frame_id):
-        """ Check current and previous hand positions to detect hand stroke"""
+        # thresholds for units 'mm_per_sec', calibrated with simulated strokes from 30 to 200 fps
+        self.downward_speed_threshold = 300.
+        self.max_downward_speed = 1000.
+        # velocity curve: (mean downward movement / maximum)^velocity_exponent, clipped at 1
+        self.max_downward_movement_per_frame = 9.
+        self.velocity_exponent = 1.
+        for name, value in self.thresholds.items():
+            if not hasattr(self, name):
+                raise Exception('Non-valid threshold %s' % name)
+            setattr(self, name, value)
+
+    def check_for_hand_stroke(self, _id, position, frame_id, timestamp=None, palm_velocity=None, is_left=None):
+        """ Check current and previous hand positions to detect hand stroke
+        Args:
+            _id (int): Hand ID
+            position (tuple): Palm position (x, y, z) in mm
+            frame_id (int): Frame counter
+            timestamp (int): Device timestamp (microseconds), required for units 'mm_per_sec' and re-association
+            palm_velocity (tuple): Palm velocity (x, y, z) in mm/s, used for units 'mm_per_sec' if given
+            is_left (bool): Handedness, a new hand ID is only re-associated with a lost hand of same handedness
+        Returns:
+            check (bool): True if hand stroke was detected
+            velocity (float): Stroke velocity between 0 and 1
+        """
         height = position[1]
         check = False
         velocity = 0
 
+        # remove old entries (before the update, a hand which reappears after an interruption starts from scratch
+        # unless it is re-associated)
+        self.remove_hands_from_memory_after_interuption(frame_id, timestamp)
+
+        if _id not in self.memory and self.lifecycle is not None:
+            # new ID continues the state of a lost hand
+            entry = self.lifecycle.reassociate(position, is_left)
+            if entry is not None:
+                self.memory[_id] = entry
+
         # check if hand with ID is already saved in the hand memory
         if _id not in self.memory:
             # create new entry for new hand ID
-            self.memory[_id] = IHDHandTracking(height, frame_id, position)
+            self.memory[_id] = IHDHandTracking(height, frame_id, position, timestamp=timestamp,
+                                               window_size=self.window_size, is_left=is_left)
         else:
-            # update existing entry
+            # update existing entry (hands re-associated after a tracking loss moved over all frames of the loss)
+            frame_gap = max(frame_id - self.memory[_id].prev_frame_id, 1)
             self.memory[_id].prev_frame_id = frame_id
             # get direction of movement (upwards / downwards)
             self.memory[_id].downwards = height < self.memory[_id].prev_max_height
@@ -218,14 +433,24 @@ class IHDHandTrackingMemory:
             if self.memory[_id].downwards:
                 # check height distance since last frame
                 delta_height = self.memory[_id].prev_position[1] - height
-                self.memory[_id].all_distance_per_frame.append(delta_height)
-                if delta_height > self.delta_height_per_frame_threshold:
-                    self.memory[_id].min_movement_per_frame_check = True
+                if self.units == 'mm_per_sec':
+                    downward_speed = self.get_downward_speed(delta_height, self.memory[_id].prev_timestamp,
+                                                             timestamp, palm_velocity)
+                    self.memory[_id].recent_distance_per_frame.append(downward_speed)
+                    if downward_speed > self.downward_speed_threshold:
+                        self.memory[_id].min_movement_per_frame_check = True
+                else:
+                    if frame_gap > 1:
+                        delta_height /= frame_gap
+                    self.memory[_id].recent_distance_per_frame.append(delta_height)
+                    if delta_height > self.delta_height_per_frame_threshold:
+                        self.memory[_id].min_movement_per_frame_check = True
             else:
                 # reset if hand goes upwards again
                 self.reset_id(_id, height)
             # save current hand position for next frame
             self.memory[_id].prev_position = position
+            self.memory[_id].prev_timestamp = timestamp
 
         # detect hand stroke if three conditions are fulfilled (during current downwards movement):
         #   1) overall vertical moving distance exceeds threshold
@@ -236,35 +461,89 @@ class IHDHandTrackingMemory:
            self.memory[_id].min_movement_per_frame_check:
             check = True
 
-            mean_vertical_distance_per_frame = np.mean(np.array(self.memory[_id].all_distance_per_frame))
-            velocity = self.compute_velocity(mean_vertical_distance_per_frame)
+            velocity = self.compute_velocity(self.memory[_id].recent_distance_per_frame.mean())
             print('velo = %f' % velocity)
             self.memory[_id].prev_max_height = height
             self.memory[_id].hit_detected = True
 
-        # remove old entries
-        self.remove_hands_from_memory_after_interuption(frame_id)
         return check, velocity
 
+    def on_idle(self):
+        """ Called if no hand stroke was detected for a while (same interface as IHDStrokeStateTable.on_idle)
+
+            Without re-association, all hands are reset. Otherwise the hands are kept and only the reference height
+            of hands which are not in a downward motion (or already hit) is set to their current height.
+        """
+        if self.lifecycle is None:
+            self.reset_all()
+            return
+        for _id, entry in self.memory.items():
+            if not entry.downwards or entry.hit_detected:
+                entry.downwards = False
+                self.reset_id(_id, entry.prev_position[1])
+
+    def detect_strokes(self, hand_array, frame_id):
+        """ Check all hands of a frame for hand strokes (same interface as IHDStrokeStateTable.detect_strokes)
+        Args:
+            hand_array (np.ndarray): Hands of current frame (see ihd_frame.extract_hand_array)
+            frame_id (int): Frame counter
+        Returns:
+            stroke_rows (np.ndarray): Indices of hand array rows with detected hand stroke
+            velocities (np.ndarray): Stroke velocities between 0 and 1
+        """
+        stroke_rows = []
+        velocities = []
+        for row_idx, hand in enumerate(hand_array):
+            # copy, hand array is reused for the next frame
+            position = hand[HAND_PALM_X:HAND_PALM_Z + 1].copy()
+            check, velocity = self.check_for_hand_stroke(int(hand[HAND_ID]), position, frame_id,
+                                                         timestamp=hand[HAND_TIMESTAMP],
+                                                         palm_velocity=hand[HAND_VELOCITY_X:HAND_VELOCITY_Z + 1],
+                                                         is_left=bool(hand[HAND_IS_LEFT]))
+            if check:
+                stroke_rows.append(row_idx)
+                velocities.append(velocity)
+        return np.array(stroke_rows, dtype=int), np.array(velocities)
+
+    def get_downward_speed(self, delta_height, prev_timestamp, timestamp, palm_velocity):
+        """ Downward speed (mm/s) from SDK palm velocity or from height difference and timestamps """
+        if self.use_palm_velocity and palm_velocity is not None:
+            return -palm_velocity[1]
+        if prev_timestamp is None or timestamp is None or timestamp <= prev_timestamp:
+            return 0
+        return delta_height / ((timestamp - prev_timestamp)*1e-6)
+
     def compute_velocity(self, mean_vertical_distance_per_frame):
         """ Map hand movement mean vertical distance per frame (vertical velocity) to velocity measure between 0 and 1.
             Based on tests, slow hand strokes are around 1...3, fast ones around 6..9
+            For units 'mm_per_sec', the mean downward speed is mapped relative to max_downward_speed.
         """
-        return min((1, mean_vertical_distance_per_frame / 9))
+        if self.units == 'mm_per_sec':
+            velocity = min((1, mean_vertical_distance_per_frame / self.max_downward_speed))
+        else:
+            velocity = min((1, mean_vertical_distance_per_frame / self.max_downward_movement_per_frame))
+        if self.velocity_exponent != 1:
+            velocity = max(velocity, 0)**self.velocity_exponent
+        return velocity
 
-    def remove_hands_from_memory_after_interuption(self, frame_id):
+    def remove_hands_from_memory_after_interuption(self, frame_id, timestamp=None):
         """ Remove "old" hands, whose IDs were not tracked in the previous frame
-            (if hand tracking is interrupted, hand gets new ID, old one gets obsolete
+            (if hand tracking is interrupted, hand gets new ID, old one gets obsolete)
+            With re-association, they are kept as lost hands until max_lost_sec has passed (see IHDLostHands)
         """
         for _key in self.memory.keys():
             if frame_id - self.memory[_key].prev_frame_id > 1:
-                self.memory.pop(_key)
+                entry = self.memory.pop(_key)
+                if self.lifecycle is not None and entry.prev_timestamp is not None:
+                    self.lifecycle.mark_lost(_key, entry)
+        if self.lifecycle is not None and timestamp is not None:
+            self.lifecycle.expire(timestamp)
 
     def reset_id(self, _id, height):
         """ Reset memory entry (after hand starts moving upwards) """
         self.memory[_id].prev_max_height = height
         self.memory[_id].hit_detected = False
-        self.memory[_id].all_distance_per_frame = []
+        self.memory[_id].recent_distance_per_frame.clear()
 
 
 class IHDTools:
@@ -300,31 +579,100 @@ class IHDTools:
 
     @staticmethod
     def get_pitches_for_scale(scale):
-        if scale == 'ionian':
-            return np.arange(36, 43)
-        elif scale == 'ionian_inv':
-            return np.arange(42, 35, -1)
-        elif scale == 'random':
-            pitches = np.arange(36, 43)
-            np.random.shuffle(pitches)
-            return pitches
-        else:
-            raise Exception('Undefined scale')
+        """ Pitches of the scale notes (see ihd_scales.py, IHDPlayer uses the precomputed tables) """
+        table = create_scale(scale)
+        return np.array(table.pitch_table[:len(table)])
+
+    @staticmethod
+    def get_swipes(frame):
+        """ Get swipe gestures in frame
+        Args:
+            frame (Leap.Frame or IHDFrameState): Frame
+        Returns:
+            swipes (list): List of (dx, is_left_hand) with horizontal distance dx between start and current position
+        """
+        if isinstance(frame, IHDFrameState):
+            return frame.swipes
+        swipes = []
+        for gesture in frame.gestures():
+            if gesture.type == Leap.Gesture.TYPE_SWIPE:
+                swipe = SwipeGesture(gesture)
+                swipes.append((swipe.start_position[0] - swipe.position[0], swipe.pointable.hand.is_left))
+        return swipes
 
 
 class IHDGestureDetector:
     """ Main class to detect drumming gestures based on LeapMotion controller data """
 
-    def __init__(self, controller):
-        self.start_time = time.time()
+    def __init__(self, controller, units='mm_per_frame', hand_memory=None, impact_predictor=None, smoothing=None,
+                 thresholds=None, tracking='palm', pad_positions=None, pad_layout=None):
+        """ Initialize detector
+        Args:
+            controller (IHDController): Controller
+            units (string): Units of downward movement, 'mm_per_frame' or 'mm_per_sec' (see IHDHandTrackingMemory)
+            hand_memory (string): 'table' for the vectorized IHDStrokeStateTable, 'dict' for the per-hand
+                                  IHDHandTrackingMemory, default: 'table' for impact prediction and finger tracking,
+                                  otherwise 'dict' (faster up to about 8 hands, see ihd_benchmark.py stroke_detection).
+                                  Both support units, thresholds, the stroke velocity window, re-association of lost
+                                  hands with expiry and keeping hand state across idle periods. Impact prediction and
+                                  finger tracking require the table, only the dict memory reads Leap hand objects
+                                  without hand array extraction.
+            impact_predictor (IHDImpactPredictor): Forecast stroke impacts (table only), default: reactive detection
+            smoothing (string): Smoothing of palm positions before stroke detection, 'one_euro' or 'kalman' (see
+                                ihd_smoothing.py), default: raw palm positions
+            thresholds (dict): Stroke thresholds which differ from the defaults (see IHDStrokeStateTable)
+            tracking (string): 'palm' (one stroke per frame is played) or 'fingers' (all ten fingertips are tracked
+                               as one batch, each fingertip plays the pad below it, table only)
+            pad_positions (np.ndarray): Pad centres (x, z) as rows, e.g. ihd_pad_lookup.ring_layout(),
+                                        default: hexagon layout (see IHDTools.get_drum_positions_hexagon_layout)
+            pad_layout (IHDPadLayout): Pad layout with radii, dead zones and pitches (see ihd_pad_layout.py),
+                                       replaces pad_positions
+        """
         self.last_event_time_sec = 0
         self.reset_after_time_sec = 2
         self.frame_id = 0
+        self.num_strokes = 0
         self.controller = controller
-        self.hand_memory = IHDHandTrackingMemory()
+
+        # forecast strokes per slot (impact position, velocity, impact frame time) until their note is due
+        self.impact_predictor = impact_predictor
+        self.pending_strokes = {}
+        self.due_commands = []
+
+        if tracking not in ('palm', 'fingers'):
+            raise Exception('Non-valid tracking')
+        self.tracking = tracking
+        self.hand_extractor = IHDHandArrayExtractor(fingers=tracking == 'fingers')
+        # strokes of further fingertips in the same frame (position, velocity)
+        self.simultaneous_strokes = []
+
+        if hand_memory is None:
+            hand_memory = 'table' if impact_predictor is not None or tracking != 'palm' else 'dict'
+        if hand_memory == 'table':
+            self.hand_memory = IHDStrokeStateTable(capacity=max(16, self.hand_extractor.max_rows), units=units,
+                                                   impact_predictor=impact_predictor, thresholds=thresholds,
+                                                   finger_groups=tracking == 'fingers')
+        elif impact_predictor is not None or tracking != 'palm':
+            raise Exception('Impact prediction and finger tracking require hand memory table')
+        elif hand_memory == 'dict':
+            self.hand_memory = IHDHandTrackingMemory(units=units, thresholds=thresholds)
+        else:
+            raise Exception('Non-valid hand memory')
+        self.smoother = IHDHandSmoother(smoothing, capacity=max(16, self.hand_extractor.max_rows)) \
+            if smoothing is not None else None
+        # the per-hand memory reads the hand objects of Leap frames directly, for the few hands of a frame attribute
+        # access is cheaper than extracting the hand array (see ihd_benchmark.py hand_extraction)
+        self.per_hand_access = hand_memory == 'dict' and smoothing is None
 
         self.hexagon_positions_radius = 100
         self.hexagon_positions = IHDTools.get_drum_positions_hexagon_layout(self.hexagon_positions_radius)
+        # compiled layout with nearest pad lookup, replaced as a whole (see set_pad_layout)
+        if pad_layout is None:
+            pad_layout = IHDPadLayout.from_positions(pad_positions if pad_positions is not None
+                                                     else self.hexagon_positions, name='hexagon')
+        self.pad_layout = pad_layout
+        # strokes outside of the pads (radius, dead zone, height of the layout)
+        self.num_strokes_outside_pads = 0
 
         self.swipe_min_abs_dx = 80
         self.last_swipe_detected_sec = 0
@@ -336,7 +684,7 @@ class IHDGestureDetector:
         """ Analyze current frame for relevant gestures from motion capture device """
         self.update_time(curr_time)
 
-        self.detect_swipe_gesture(frame)
+        self.detect_swipe_gesture(frame, curr_time)
 
         hand_stroke_position, hand_stroke_velocity = self.detect_hand_stroke(frame)
         command = None
@@ -344,77 +692,144 @@ class IHDGestureDetector:
         # if hand stroke was detected
         if hand_stroke_position is not None:
             self.last_event_time_sec = curr_time
-            command = IHDPlayCommand(note_id=self.stroke_position_to_note_id(hand_stroke_position),
-                                     level=hand_stroke_velocity)
+            self.num_strokes += 1
+            command = self.stroke_command(hand_stroke_position, hand_stroke_velocity, curr_time)
+            for position, velocity in self.simultaneous_strokes:
+                self.num_strokes += 1
+                self.append_due_command(self.stroke_command(position, velocity, curr_time))
+
+        if self.impact_predictor is not None:
+            self.schedule_predicted_strokes(frame.timestamp, curr_time)
 
         self.frame_id += 1
 
         return command
 
-    def detect_swipe_gesture(self, frame):
+    def detect_swipe_gesture(self, frame, curr_time):
         """ Customized function to detect swipe gestures of both hands in both directions (right / left) """
 
-        for gesture in frame.gestures():
-
-            if gesture.type == Leap.Gesture.TYPE_SWIPE:
-
-                if time.time() - self.last_swipe_detected_sec > self.min_time_between_swipes_sec:
+        for dx, is_left_hand in IHDTools.get_swipes(frame):
 
-                    swipe = SwipeGesture(gesture)
+            if curr_time - self.last_swipe_detected_sec > self.min_time_between_swipes_sec:
 
-                    start_position = swipe.start_position
-                    position = swipe.position
+                swipe_is_rightwards = dx < 0
+                if abs(dx) > self.swipe_min_abs_dx:
+                    self.last_swipe_detected_sec = curr_time
 
-                    dx = start_position[0] - position[0]
-
-                    is_left_hand = swipe.pointable.hand.is_left
-
-                    swipe_is_rightwards = dx < 0
-                    if abs(dx) > self.swipe_min_abs_dx:
-                        self.last_swipe_detected_sec = time.time()  # todo replace by time stamp from main class
-
-                        if not is_left_hand:
-                            self.controller.player.next_scale(next_=swipe_is_rightwards)
+                    if not is_left_hand:
+                        self.controller.player.next_scale(next_=swipe_is_rightwards)
 
     def detect_hand_stroke(self, frame):
         """ Use internal hand memory to detect hand strokes """
+        if self.per_hand_access and not (isinstance(frame, IHDFrameState) and frame.hand_array is not None):
+            return self.detect_hand_stroke_per_hand(frame)
+
+        # all hands of the frame as rows (id, is_left, palm position, palm velocity, timestamp), or all fingertips
+        hands = self.hand_extractor.extract(frame)
+        if self.smoother is not None:
+            self.smoother.smooth(hands)
+        stroke_rows, velocities = self.hand_memory.detect_strokes(hands, self.frame_id)
+        if len(stroke_rows) == 0:
+            return None, 0
+
+        if self.tracking == 'fingers':
+            self.simultaneous_strokes = [(hands[row, HAND_PALM_X:HAND_PALM_Z + 1].copy(), velocity)
+                                         for row, velocity in zip(stroke_rows[:-1], velocities[:-1])]
+
+        # if several hands strike in the same frame, the last one is played
+        # copy, hand array is reused for the next frame
+        return hands[stroke_rows[-1], HAND_PALM_X:HAND_PALM_Z + 1].copy(), velocities[-1]
+
+    def detect_hand_stroke_per_hand(self, frame):
+        """ Detect hand strokes with the per-hand memory on the hand objects of the frame """
         hand_stroke_position = None
+        hand_stroke_velocity = 0
+        timestamp = frame.timestamp
+        for hand in frame.hands:
+            position = hand.palm_position
+            check, velocity = self.hand_memory.check_for_hand_stroke(hand.id, position, self.frame_id,
+                                                                     timestamp=timestamp,
+                                                                     palm_velocity=hand.palm_velocity,
+                                                                     is_left=hand.is_left)
+            # if several hands strike in the same frame, the last one is played
+            if check:
+                hand_stroke_position = position.to_tuple()
+                hand_stroke_velocity = velocity
+        return hand_stroke_position, hand_stroke_velocity
+
+    def schedule_predicted_strokes(self, timestamp, curr_time):
+        """ Keep strokes forecast in the current frame until their note is due, drop cancelled forecasts
+        Args:
+            timestamp (float): Device timestamp (microseconds) of the current frame
+            curr_time (float): Frame time (s)
+        """
+        slots, impact_positions, velocities = self.hand_memory.predicted_strokes
+        for slot, position, velocity in zip(slots, impact_positions, velocities):
+            send_timestamp = self.impact_predictor.send_timestamp[slot]
+            impact_time = curr_time + (send_timestamp + self.impact_predictor.latency_us - timestamp)*1e-6
+            self.pending_strokes[slot] = (position, velocity, impact_time)
+        for slot in self.hand_memory.cancelled_slots:
+            self.pending_strokes.pop(slot, None)
+
+        for slot in self.impact_predictor.pop_due(timestamp):
+            if slot not in self.pending_strokes:
+                continue
+            position, velocity, impact_time = self.pending_strokes.pop(slot)
+            self.last_event_time_sec = curr_time
+            self.num_strokes += 1
+            self.append_due_command(self.stroke_command(position, velocity, impact_time))
+
+    def stroke_command(self, position, velocity, stroke_time):
+        """ Play command of stroke, None if the stroke is outside of the pads """
+        note_id = self.stroke_position_to_note_id(position, stroke_time)
+        if note_id is None:
+            self.num_strokes_outside_pads += 1
+            return None
+        return IHDPlayCommand(note_id=note_id, level=velocity)
+
+    def append_due_command(self, command):
+        if command is not None:
+            self.due_commands.append(command)
 
-        # check that at least one hand is in the frame
-        hands = frame.hands
-        velocity = 0
-        if len(hands) > 0:
-            for hand in hands:
-                _id = hand.id
-                position = hand.palm_position
-
-                check, velocity = self.hand_memory.check_for_hand_stroke(_id, position, self.frame_id)
-                if check:
-                    hand_stroke_position = position
-
-        return hand_stroke_position, velocity
+    def pop_due_commands(self):
+        """ Further commands of the frame: notes of forecast strokes which are due (see schedule_predicted_strokes)
+            and strokes of further fingertips
+        """
+        commands = self.due_commands
+        self.due_commands = []
+        return commands
 
     def update_time(self, curr_time):
-        # check for hand memory reset
+        # check for idle period (hand memory reset or rebase, see IHDStrokeStateTable.on_idle)
         if curr_time - self.last_event_time_sec > self.reset_after_time_sec:
-            self.hand_memory.reset_all()
+            self.hand_memory.on_idle()
             self.last_event_time_sec = curr_time
 
-    def stroke_position_to_note_id(self, position):
-        """ Convert spatial position into drum number based on hexagon drum layout
+    def set_pad_layout(self, pad_layout):
+        """ Replace pad layout, e.g. from IHDPadLayoutWatcher thread (strokes are mapped with one layout or the
+            other, the layout itself is not modified)
+        """
+        self.pad_layout = pad_layout
+        print('Changed pad layout to %s (%d pads)' % (pad_layout.name, pad_layout.num_pads))
+
+    def stroke_position_to_note_id(self, position, curr_time):
+        """ Convert spatial position into drum number based on pad layout
         Args:
             position (tuple): Spatial hand_position (x, y, z)
+            curr_time (float): Frame time (s) of the stroke
         Returns
-            drum_id
+            drum_id (None if the stroke is outside of the pads)
             """
-        curr_pos = np.array((position[0], position[2]))
-
         # nearest neighbor search
-        dist = np.sqrt(np.sum(np.square(self.hexagon_positions - curr_pos), axis=1))
+        drum_id = self.pad_layout.map_stroke(position)
+        if drum_id is None:
+            return None
 
-        drum_id = np.argmin(dist)
-
-        self.controller.user_played_notes.append((time.time() - self.controller.last_bar_start_time, drum_id))
+        # strokes before the first bar has started cannot be quantized
+        if self.controller.last_bar_start_time is not None:
+            # strokes shortly before a bar start which was scheduled ahead are quantized to its first beat
+            self.controller.user_played_notes.append((max(0., curr_time - self.controller.last_bar_start_time),
+                                                      drum_id))
 
         return drum_id
 
@@ -429,32 +844,69 @@ class IHDPlayCommand:
 
 class IHDPlayer:
 
-    def __init__(self, controller):
+    def __init__(self, controller, midi_out=None, scales=None, seed=None, gate_sec=.3, click_gate_sec=.05,
+                 output_thread=False, lookahead_sec=.05, sampler=None):
+        """ Initialize player
+        Args:
+            controller (IHDController): Controller
+            midi_out (rtmidi.MidiOut): MIDI output, default: first port or virtual port (none with sampler)
+            scales (list): Scale names (see ihd_scales.py) or IHDScale objects selectable by swipes,
+                           default: 'ionian', 'ionian_inv', 'random' (microtonal scales require the sampler, MIDI
+                           output plays the nearest pitches)
+            seed (int): Seed of the permutation of scale 'random'
+            gate_sec (float): Time between note-on and note-off of drum notes
+            click_gate_sec (float): Time between note-on and note-off of clicks
+            output_thread (bool): Send messages at their time from an output thread (see ihd_midi_scheduler.py)
+            lookahead_sec (float): Time by which clicks, notes of the computer player and note-offs are scheduled
+                                   ahead (output thread or sampler only)
+            sampler (IHDSampler): Play notes with the in-process sampler instead of MIDI (see ihd_sampler.py)
+        """
         self.controller = controller
 
-        self.midi_out = rtmidi.MidiOut()
-        available_ports = self.midi_out.get_ports()
+        # MIDI output can be replaced, e.g. by IHDNullMidiOut for headless replay
+        self.midi_out = midi_out if midi_out is not None or sampler is not None else rtmidi.MidiOut()
+        if self.midi_out is not None:
+            available_ports = self.midi_out.get_ports()
 
-        if available_ports:
-            self.midi_out.open_port(0)
-        else:
-            self.midi_out.open_virtual_port("virtual_hand_drum")
+            if available_ports:
+                self.midi_out.open_port(0)
+            else:
+                self.midi_out.open_virtual_port("virtual_hand_drum")
 
-        self.scale_id = 0
-        self.scales = ['ionian', 'ionian_inv', 'random']
+        self.sampler = sampler
+        self.scheduler = IHDMidiScheduler(self.midi_out) if output_thread and sampler is None else None
+        self.lookahead_sec = lookahead_sec if self.scheduler is not None or sampler is not None else 0.
+
+        # every note-on is followed by a note-off after the gate length of its instrument
+        self.voices = IHDVoiceManager(self.midi_out, gate_sec=gate_sec, scheduler=self.scheduler)
+        self.gate_sec = {'drum': gate_sec, 'click': click_gate_sec}
+
+        # pitch tables are compiled once, 'random' is permuted once per selection
+        self.random_state = np.random.RandomState(seed)
+        self.scale_tables = [scale if isinstance(scale, IHDScale) else create_scale(scale, self.random_state)
+                             for scale in (scales if scales is not None else ['ionian', 'ionian_inv', 'random'])]
+        self.scales = [scale.name for scale in self.scale_tables]
         self.num_scales = len(self.scales)
+        self.scale_id = 0
+        self.scale = self.scale_tables[0]
+        self.check_tuning()
+        self.click_pitches = (48, 49)
         self.active_player = None
 
     def drum_id_to_pitch(self, instrument, drum_id):
         if instrument == 'drum':
-            pitches = IHDTools.get_pitches_for_scale(self.scales[self.scale_id])
+            # pitch assigned to the pad by the layout file
+            pitch = self.controller.gesture_detector.pad_layout.pitch(drum_id)
+            if pitch != NO_PITCH:
+                return pitch
+            return self.scale.pitch_table[drum_id]
         elif instrument == 'click':
-            pitches = np.array((48, 49))
-        else:
-            raise Exception('Non-valid instrument')
-        return pitches[drum_id]
+            return self.click_pitches[drum_id]
+        raise Exception('Non-valid instrument')
 
-    def update(self):
+    def update(self, curr_time):
+        # note-offs which are due in this frame (or within the lookahead)
+        self.voices.update(curr_time, self.lookahead_sec)
 
         if self.active_player == "COMPUTER":
             beats_passed = np.where(self.controller.beats_passed)[0]
@@ -462,10 +914,14 @@ class IHDPlayer:
                 last_beat_passed = beats_passed[-1]
                 active_pitches = np.where(self.controller.quant_mat[:, last_beat_passed])[0]
                 if len(active_pitches) > 0:
-                    for note_id in active_pitches:
-                        command = IHDPlayCommand(note_id, 1, instrument='drum')
-                        self.controller.player.play(command)
-                        self.controller.quant_mat[note_id, last_beat_passed] = False
+                    # with output thread, scheduled ahead at the beat time
+                    note_time = curr_time
+                    if self.lookahead_sec > 0:
+                        note_time = max(curr_time, self.controller.last_bar_start_time +
+                                        self.controller.beat_times_in_bar[last_beat_passed])
+                    self.play_all([IHDPlayCommand(note_id, 1, instrument='drum') for note_id in active_pitches],
+                                  note_time)
+                    self.controller.quant_mat[active_pitches, last_beat_passed] = False
 
     def next_scale(self, next_=True):
         if next_:
@@ -481,17 +937,54 @@ class IHDPlayer:
 
     def change_scale(self, scale_id):
         """ Change internal scale to change mapping from note ids to pitches """
+        if self.scales[scale_id] == 'random':
+            self.scale_tables[scale_id] = create_scale('random', self.random_state)
         self.scale_id = scale_id
+        self.scale = self.scale_tables[scale_id]
         print('Changed scale to %s' % self.scales[self.scale_id])
-
-    def play(self, command):
-        """ Translate instrument, drum_id, and level to MIDI note event """
-        pitch = self.drum_id_to_pitch(command.instrument, command.note_id)
-        velocity = int(122.*(.5 + .5*command.level))
+        self.check_tuning()
+
+    def check_tuning(self):
+        """ Warn if the microtonal offsets of the current scale cannot be played (MIDI output, see ihd_scales.py) """
+        if self.sampler is None and self.scale.is_microtonal:
+            print('Warning: MIDI output plays scale %s at the nearest pitches, microtonal offsets require the sampler'
+                  % self.scale.name)
+
+    def play(self, command, curr_time):
+        """ Translate instrument, drum_id, and level to MIDI note event (note-off after gate length) or sampler note """
+        if self.sampler is not None:
+            sample, cents = self.sampler_note(command)
+            self.sampler.note_on(self.drum_id_to_pitch(command.instrument, command.note_id),
+                                 self.command_velocity(command), cents=cents, sample=sample, start_time=curr_time)
+            return
+        self.voices.note_on(self.drum_id_to_pitch(command.instrument, command.note_id), self.command_velocity(command),
+                            curr_time, gate_sec=self.gate_sec[command.instrument])
+
+    def play_all(self, commands, curr_time):
+        """ Play simultaneous commands, their MIDI messages are sent in one bulk call """
+        if self.sampler is not None:
+            for command in commands:
+                self.play(command, curr_time)
+            return
+        self.voices.note_ons([(self.drum_id_to_pitch(command.instrument, command.note_id),
+                               self.command_velocity(command), self.gate_sec[command.instrument])
+                              for command in commands], curr_time)
+
+    def sampler_note(self, command):
+        """ Sample (None: nearest to the pitch) and microtonal offset (cents) of command for the sampler """
+        if command.instrument == 'click':
+            return CLICK_SAMPLES[command.note_id][0], 0.
+        layout = self.controller.gesture_detector.pad_layout
+        sample = layout.samples[command.note_id] if command.note_id < layout.num_pads else ''
+        # offsets of the scale apply to pads without pitch of their own
+        cents = self.scale.cents_table[command.note_id] if layout.pitch(command.note_id) == NO_PITCH else 0.
+        return sample or None, cents
+
+    def command_velocity(self, command):
         # todo remove
         if command.instrument == 'click':
-            velocity = 100
-        self.midi_out.send_message([0x90, pitch, velocity])
+            return 100
+        return level_to_velocity(command.level)
 
 
 def main():